@@ -1,10 +1,14 @@
 #!/bin/bash
 #
 # This script builds AWS lambda layers that contain the scikit-image and joblib
-# dependency for arbitrary versions of Python and scikit-image. By default, it
-# builds for Python 3.6 - 3.8 and scikit-image versions 0.22+, and publishes to
-# all US regions. The dependency size is optimized by removing some unnecessary
-# files from site-packages (__pycache__, *.pyc, tests...).
+# dependency for arbitrary versions of Python and scikit-image, along with the
+# gevent and aiofiles dependencies of the greenlet and asyncio implementations of
+# the image processor. With --with-aiobotocore the layers also contain aiobotocore
+# and the boto3 version it works with; without it the asyncio implementation makes
+# its S3 and SQS calls on a thread pool. By default, it builds for Python 3.6 - 3.8
+# and scikit-image versions 0.22+, and publishes to all US regions. The
+# dependency size is optimized by removing some unnecessary files from
+# site-packages (__pycache__, *.pyc, tests...).
 #
 # Prerequisities: Install the AWS cli, jq, and Docker
 #
@@ -15,6 +19,9 @@
 # Example 2: Build lambda layer for Python 3.8 and scikit-image 0.23.0, publish
 # to us-east-2.
 #  ./build-layers.sh --python=3.8 --scikit-image==0.21.0 --region=us-east-2
+#
+# Example 3: Same, with aiobotocore for the asyncio implementation.
+#  ./build-layers.sh --python=3.8 --scikit-image==0.21.0 --region=us-east-2 --with-aiobotocore
 
 set -e
 set -o pipefail
@@ -22,6 +29,7 @@ set -o pipefail
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 BUILD_CACHE_DIR="${SCRIPT_DIR}/build"
 OUTPUT_CSV="layers.csv"
+EXTRA_PACKAGES="gevent aiofiles"
 
 for arg in "$@"
 do
@@ -31,6 +39,7 @@ do
         --region=*) declare -a REGIONS=("${arg#*=}") shift;;
         --output-csv=*) declare OUTPUT_CSV="${arg#*=}" shift;;
         --public) declare PUBLIC=true shift;;
+        --with-aiobotocore) EXTRA_PACKAGES="${EXTRA_PACKAGES} aiobotocore[boto3]" shift;;
         *) echo "ERROR: Invalid argument ${arg}" && exit 1;;
     esac
 done
@@ -76,7 +85,7 @@ do
         docker run \
             -v ${SCRIPT_DIR}:/var/task \
             "lambci/lambda:build-python$p" \
-            /var/task/install-pip-packages.sh "scikit-image==${s} joblib" /var/task/build/python/lib/python${p}/site-packages
+            /var/task/install-pip-packages.sh "scikit-image==${s} joblib ${EXTRA_PACKAGES}" /var/task/build/python/lib/python${p}/site-packages
 
         layer_name=$(echo "python-${p}-scikit-image-${s}" | tr '.' '-')
         zip_name="scikit-image-${skimage_version}.zip"
@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_clients import CLIENT_CONFIG_OPTIONS, get_client
+
+logger = logging.getLogger(__name__)
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:  # pragma: no cover - aiobotocore ships in the function's dependency layer
+    AioConfig = get_session = None
+    logger.info("aiobotocore is not available, running S3/SQS calls on a thread pool")
+
+
+class AsyncAwsClients:
+    """
+    S3 and SQS calls that can be awaited on the event loop. With aiobotocore the requests are made by its aiohttp
+    transport on the loop itself, so hundreds of transfers overlap without a thread each and without a thread hop
+    per call. The clients use the same connection pool, keep-alive and retry settings as aws_clients.
+
+    Without aiobotocore the shared boto3 clients are called on a dedicated thread pool sized to their connection
+    pool, rather than on the loop's default executor whose size is derived from the CPU count.
+
+    aiobotocore clients belong to the loop they were opened on. The handler uses default_aws_clients() on
+    run_on_container_loop(), so both live as long as the container and warm invocations reuse the open connections;
+    `async with AsyncAwsClients()` scopes a set of clients to a block instead.
+    """
+
+    def __init__(self):
+        self.s3_client = None
+        self.sqs_client = None
+        self.exit_stack = None
+        self.executor = None
+        self.opened = False
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """
+        Create the clients, unless they are open already.
+        """
+        if self.opened:
+            return self
+        if get_session is not None:
+            self.exit_stack = contextlib.AsyncExitStack()
+            session = get_session()
+            config = AioConfig(**CLIENT_CONFIG_OPTIONS)
+            self.s3_client = await self.exit_stack.enter_async_context(session.create_client('s3', config=config))
+            self.sqs_client = await self.exit_stack.enter_async_context(session.create_client('sqs', config=config))
+        else:
+            self.s3_client = get_client('s3')
+            self.sqs_client = get_client('sqs')
+            self.executor = ThreadPoolExecutor(max_workers=CLIENT_CONFIG_OPTIONS["max_pool_connections"],
+                                               thread_name_prefix="aws-io")
+        self.opened = True
+        return self
+
+    async def close(self):
+        if self.exit_stack is not None:
+            await self.exit_stack.aclose()
+            self.exit_stack = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.opened = False
+
+    async def _run_blocking(self, function):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function)
+
+    async def s3(self, operation, **kwargs):
+        """
+        Await any S3 operation, by its boto3 method name, e.g. s3("upload_part", ...).
+        """
+        if self.executor is not None:
+            return await self._run_blocking(lambda: getattr(self.s3_client, operation)(**kwargs))
+        return await getattr(self.s3_client, operation)(**kwargs)
+
+    async def get_object(self, **kwargs):
+        """
+        Return the GetObject response together with the object's bytes.
+        """
+        if self.executor is not None:
+            def get_object():
+                response = self.s3_client.get_object(**kwargs)
+                return response, response["Body"].read()
+            return await self._run_blocking(get_object)
+        response = await self.s3_client.get_object(**kwargs)
+        async with response["Body"] as stream:
+            return response, await stream.read()
+
+    async def head_object(self, **kwargs):
+        if self.executor is not None:
+            return await self._run_blocking(lambda: self.s3_client.head_object(**kwargs))
+        return await self.s3_client.head_object(**kwargs)
+
+    async def put_object(self, **kwargs):
+        if self.executor is not None:
+            return await self._run_blocking(lambda: self.s3_client.put_object(**kwargs))
+        return await self.s3_client.put_object(**kwargs)
+
+    async def receive_message(self, **kwargs):
+        if self.executor is not None:
+            return await self._run_blocking(lambda: self.sqs_client.receive_message(**kwargs))
+        return await self.sqs_client.receive_message(**kwargs)
+
+
+_container_loop = None
+_default_aws_clients = AsyncAwsClients()
+
+
+def run_on_container_loop(coroutine):
+    """
+    Run coroutine to completion on the container's event loop, created on first use. Unlike asyncio.run() the loop
+    is not closed afterwards, so clients opened on it by one invocation are still usable by the next.
+    """
+    global _container_loop
+    if _container_loop is None or _container_loop.is_closed():
+        _container_loop = asyncio.new_event_loop()
+    return _container_loop.run_until_complete(coroutine)
+
+
+def default_aws_clients():
+    # One set of clients per container, opened on the container loop by the first invocation that needs them
+    return _default_aws_clients
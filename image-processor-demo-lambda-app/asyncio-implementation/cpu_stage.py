@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+
+from image_editor import ImageEditor
+from image_encoder import default_image_encoder
+
+logger = logging.getLogger(__name__)
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover - platforms without POSIX shared memory
+    shared_memory = None
+
+
+def available_vcpus():
+    # Lambda scales vCPUs with the memory setting; the affinity mask is what this process may actually use
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _attach_shared_array(name, shape, dtype):
+    # The parent owns and unlinks the block. Workers share its resource tracker, where attaching registers the
+    # block a second time to no effect and the parent's unlink unregisters it once; unregistering it here as well
+    # made the tracker fail on the parent's unlink. Python 3.13 can skip the registration altogether.
+    if sys.version_info >= (3, 13):
+        block = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _encode_outputs(source, transforms, encoder, keep_decoded_bytes=0):
+    """
+    Worker entry point: decode (or attach to) the source image once, run every transform and return the encoded
+    bytes, with the seconds spent per stage. Only compressed bytes travel back to the event loop process, and the
+    image decoded here only if it takes up at most keep_decoded_bytes.
+    """
+    block = None
+    decoded = None
+    if isinstance(source, tuple):
+        block, source = _attach_shared_array(*source)
+    try:
+        timings = {}
+        if not isinstance(source, np.ndarray):
+            started_at = time.perf_counter()
+            source = decoded = ImageEditor.decode(BytesIO(source))
+            timings["decode"] = time.perf_counter() - started_at
+        buffers = [BytesIO() for _ in transforms]
+        ImageEditor.apply(source, list(zip(transforms, buffers)), encoder, timings)
+        if decoded is not None and decoded.nbytes > keep_decoded_bytes:
+            decoded = None
+        return [buffer.getvalue() for buffer in buffers], timings, decoded
+    finally:
+        if block is not None:
+            # Drop the ndarray view before closing, otherwise the exported buffer keeps the mapping alive
+            del source
+            block.close()
+
+
+class CpuStage:
+    """
+    Runs the decode/transform/encode work of ImageEditor off the event loop thread so downloads and uploads keep
+    flowing while images are processed.
+
+    With more than one vCPU a ProcessPoolExecutor with one worker per vCPU is used. Decoded images are handed to
+    it through POSIX shared memory rather than pickled, and encoded images are passed as they are. Where
+    multiprocessing primitives are unavailable (AWS Lambda has no /dev/shm) or only one vCPU is available, a
+    thread pool is used instead; numpy, the PNG codec and zlib release the GIL for most of their work.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or available_vcpus()
+        self.uses_processes = False
+        self.executor = None
+        if self.max_workers > 1 and shared_memory is not None:
+            try:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                self.uses_processes = True
+            except (OSError, NotImplementedError) as e:
+                logger.warning("Process pool unavailable, falling back to threads: %s", e)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cpu-stage")
+
+    def _share(self, image):
+        block = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+        np.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[...] = image
+        return block, (block.name, image.shape, image.dtype.str)
+
+    async def run(self, source, transforms, encoder=None, metrics=None):
+        """
+        Produce one encoded image per transform from source, which is either the encoded image bytes or an
+        already decoded numpy array. Outputs are encoded with encoder, or in the container's default format.
+        The time the worker spent decoding, transforming and encoding is recorded in metrics, a StageMetrics.
+        """
+        outputs, _ = await self.run_keeping_decoded(source, transforms, 0, encoder, metrics)
+        return outputs
+
+    async def run_keeping_decoded(self, source, transforms, keep_decoded_bytes, encoder=None, metrics=None):
+        """
+        Same as run, but returns the encoded outputs together with the source image the worker decoded, for
+        callers that keep decoded images around. It is only returned when it takes up at most keep_decoded_bytes,
+        so an image that will not be kept is not pickled back from a worker process; otherwise it is None, as it
+        is for a source that was already decoded.
+        """
+        loop = asyncio.get_running_loop()
+        block = None
+        if self.uses_processes and isinstance(source, np.ndarray):
+            block, source = self._share(source)
+        try:
+            outputs, timings, decoded = await loop.run_in_executor(self.executor, _encode_outputs, source,
+                                                                   list(transforms), encoder or default_image_encoder(),
+                                                                   keep_decoded_bytes)
+            if metrics is not None:
+                metrics.record_all(timings)
+            return outputs, decoded
+        finally:
+            if block is not None:
+                block.close()
+                block.unlink()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_default_cpu_stage = None
+
+
+def default_cpu_stage():
+    # Created on first use and kept for the life of the container, so warm invocations reuse the workers
+    global _default_cpu_stage
+    if _default_cpu_stage is None:
+        _default_cpu_stage = CpuStage()
+    return _default_cpu_stage
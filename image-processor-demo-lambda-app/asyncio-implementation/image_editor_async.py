@@ -1,38 +1,71 @@
+import logging
+
 import aiofiles
-import imageio
-from skimage import exposure
-from skimage import img_as_ubyte
-from skimage.color import rgb2gray, rgba2rgb
-from io import BytesIO
 
+import image_editor
+from cpu_stage import default_cpu_stage
+
+logger = logging.getLogger(__name__)
+
+
+class ImageEditor(image_editor.ImageEditor):
+    """
+    Async flavour of image_editor.ImageEditor: the brighten and grayscale transforms and the output encoders are
+    shared, reading sources and writing targets is done asynchronously and apply runs the CPU work on the CPU
+    stage.
+    """
 
-class ImageEditor:
     @staticmethod
-    async def brighten_image(source_filename, target_filename):
-        try:
-            async with aiofiles.open(source_filename, 'rb') as source_file:
-                image_data = await source_file.read()
+    async def _read(source):
+        # Sources are either a filename or the encoded image bytes already held in memory
+        if not isinstance(source, str):
+            return source
+        async with aiofiles.open(source, 'rb') as source_file:
+            return await source_file.read()
+
+    @staticmethod
+    async def _write(target, data):
+        # Targets are either a filename or a writable buffer such as BytesIO
+        if not isinstance(target, str):
+            target.write(data)
+            return
+        async with aiofiles.open(target, 'wb') as target_file:
+            await target_file.write(data)
 
-            image = imageio.imread(BytesIO(image_data))
-            brightened_image = exposure.adjust_gamma(image, 0.1)
+    @staticmethod
+    async def apply(source, operations, cpu_stage=None, encoder=None, metrics=None, keep_decoded_bytes=0):
+        """
+        Read source and hand it to the CPU stage, which decodes it once and encodes every (transform, target)
+        pair in operations from that same image off the event loop thread, with encoder or in the container's
+        default output format. The encoded outputs are then written to their targets. With metrics, a
+        StageMetrics, the CPU stage's decode, transform and encode times are recorded. Returns the decoded source
+        image if it takes up at most keep_decoded_bytes, and None otherwise or when source was already decoded.
+        """
+        try:
+            image_data = await ImageEditor._read(source)
 
-            async with aiofiles.open(target_filename, 'wb') as target_file:
-                await target_file.write(img_as_ubyte(brightened_image).tobytes())
+            cpu_stage = cpu_stage or default_cpu_stage()
+            outputs, decoded = await cpu_stage.run_keeping_decoded(
+                image_data, [transform for transform, _ in operations], keep_decoded_bytes, encoder, metrics)
+            for (_, target), target_data in zip(operations, outputs):
+                await ImageEditor._write(target, target_data)
+            return decoded
         except Exception as e:
-            print(f"Error in brighten_image: {e}")
+            logger.error("Error in apply: %s", e)
             raise
 
     @staticmethod
-    async def monochrome(source_filename, target_filename):
+    async def brighten_image(source, target, encoder=None):
         try:
-            async with aiofiles.open(source_filename, 'rb') as source_file:
-                image_data = await source_file.read()
-
-            image = imageio.imread(BytesIO(image_data))
-            image_grey = rgb2gray(rgba2rgb(image))
+            await ImageEditor.apply(source, [(ImageEditor.brighten, target)], encoder=encoder)
+        except Exception as e:
+            logger.error("Error in brighten_image: %s", e)
+            raise
 
-            async with aiofiles.open(target_filename, 'wb') as target_file:
-                await target_file.write(img_as_ubyte(image_grey).tobytes())
+    @staticmethod
+    async def monochrome(source, target, encoder=None):
+        try:
+            await ImageEditor.apply(source, [(ImageEditor.grayscale, target)], encoder=encoder)
         except Exception as e:
-            print(f"Error in monochrome: {e}")
+            logger.error("Error in monochrome: %s", e)
             raise
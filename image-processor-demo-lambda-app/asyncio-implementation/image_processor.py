@@ -1,208 +1,341 @@
-import os
-import random
 import time
-import boto3
 import asyncio
+import logging
+from io import BytesIO
 
-from image_editor import ImageEditor
+from aws_clients import get_client
+from aws_clients_async import default_aws_clients, run_on_container_loop
+from deadline import InvocationDeadline
+from decoded_image_cache import default_decoded_image_cache
+from cpu_stage import default_cpu_stage
+from image_editor import BRIGHTEN_GAMMA
+from image_editor_async import ImageEditor
+from image_encoder import default_image_encoder
+from result_cache import default_result_cache, fingerprint, is_missing
+from s3_transfer_async import AsyncS3Transfer
+from stage_metrics import StageMetrics
+from task_receiver import (DEFAULT_VISIBILITY_TIMEOUT, MAX_MESSAGES_PER_RECEIVE, MAX_WAIT_TIME_SECONDS,
+                           TaskAcknowledger)
+
+logger = logging.getLogger(__name__)
 
 BW_FOLDER = "bw-images/"
 BRIGHTEN_FOLDER = "brighten-images/"
 
-
-def print_tmp_files():
-    tmp_directory = '/tmp'
-
-    try:
-        # List all files in the /tmp directory
-        files = os.listdir(tmp_directory)
-
-        if files:
-            print("Files in /tmp directory:")
-            for file in files:
-                print(os.path.join(tmp_directory, file))
-        else:
-            print("No files found in /tmp directory.")
-    except Exception as e:
-        print("Error:", str(e))
-        print("Failed to list files in /tmp directory.")
-
-
-def delete_file(file_path):
-    # print("file_path=", file_path)
-    # print_tmp_files()
-    # Construct the full file path inside /tmp directory
-    tmp_file_path = os.path.join('/tmp', file_path)
-    try:
-        print("Removing file from " + tmp_file_path)
-        os.remove(tmp_file_path)
-        print("Successfully removed file from " + tmp_file_path)
-    except Exception as e:
-        print("Error:", str(e))
-        print("Failed to remove file from" + tmp_file_path)
+RECEIVE_CONCURRENCY = 2
+DOWNLOAD_CONCURRENCY = 8
+UPLOAD_CONCURRENCY = 8
+# A failed receive is retried after 1, 2, 4... seconds; after this many failures in a row (access denied, a deleted
+# queue) the receive stage gives up instead of retrying for as long as the invocation lasts
+MAX_RECEIVE_ATTEMPTS = 5
+RECEIVE_RETRY_DELAY_SECONDS = 1
+# Messages waiting between stages
+PREFETCH_SIZE = RECEIVE_CONCURRENCY * MAX_MESSAGES_PER_RECEIVE
+STAGE_QUEUE_SIZE = 8
 
 
 class ImageProcessor:
     def __init__(self, sqs_queue_url, s3_bucket_name):
-        self.sqs_client = boto3.client('sqs')
-        self.s3_client = boto3.client('s3')
+        # Receives, downloads and uploads are awaited on the loop; acknowledgements are batched on their own thread.
+        # The clients are container wide, so warm invocations reuse their open connections
+        self.aws_clients = default_aws_clients()
+        self.sqs_client = get_client('sqs')
         self.sqs_queue_url = sqs_queue_url
         self.s3_bucket_name = s3_bucket_name
-        self.bw_image_processor = self.BWImageProcessor(self.s3_client, self.sqs_queue_url, self.s3_bucket_name)
-        self.brighten_image_processor = self.BrightenImageProcessor(self.s3_client, self.sqs_queue_url,
-                                                                    self.s3_bucket_name)
+        self.image_encoder = default_image_encoder()
+        # Whole-object transfers, as a single request or in concurrent parts depending on the object's size
+        self.s3_transfer = AsyncS3Transfer(self.aws_clients)
+        self.bw_image_processor = self.BWImageProcessor(self.s3_transfer, self.sqs_queue_url, self.s3_bucket_name,
+                                                        self.image_encoder)
+        self.brighten_image_processor = self.BrightenImageProcessor(self.s3_transfer, self.sqs_queue_url,
+                                                                    self.s3_bucket_name, self.image_encoder)
+        # Per-stage latencies and message counts, written as one EMF log line per invocation by close()
+        self.metrics = StageMetrics("asyncio")
+        self.task_acknowledger = TaskAcknowledger(self.sqs_client, self.sqs_queue_url, metrics=self.metrics)
+        # Shared by every processor in the container, so warm invocations skip outputs that already exist
+        self.result_cache = default_result_cache()
+        # Also container wide, so messages for the same source image reuse one download and decode
+        self.decoded_image_cache = default_decoded_image_cache()
 
-    def _extract_tasks(self):
+    async def _extract_tasks(self, wait_seconds=MAX_WAIT_TIME_SECONDS):
         try:
-            print("Extracting tasks from sqs queue - " + self.sqs_queue_url)
-            response = self.sqs_client.receive_message(QueueUrl=self.sqs_queue_url, MaxNumberOfMessages=10)
-            if "Messages" not in response:
-                print("No messages exists in SQS queue at the moment, retry later.")
+            logger.debug("Extracting tasks from sqs queue - %s", self.sqs_queue_url)
+            # Long poll for a full batch; the wait costs nothing but an open connection on the loop
+            with self.metrics.time("receive"):
+                response = await self.aws_clients.receive_message(QueueUrl=self.sqs_queue_url,
+                                                                  MaxNumberOfMessages=MAX_MESSAGES_PER_RECEIVE,
+                                                                  WaitTimeSeconds=wait_seconds,
+                                                                  VisibilityTimeout=DEFAULT_VISIBILITY_TIMEOUT)
+            response_messages = response.get("Messages", [])
+            if len(response_messages) == 0:
+                logger.info("No messages exists in SQS queue at the moment, retry later.")
                 return []
-            messages = list(map(lambda x: x["Body"], response["Messages"]))
-            print("Extracted tasks from sqs queue successfully")
-            return messages
+            # Keep the receipt handles so every message can be acknowledged or handed back once it is settled
+            self.task_acknowledger.track(response_messages)
+            logger.debug("Extracted tasks from sqs queue successfully")
+            return response_messages
         except Exception as e:
-            print("Failed to extract task from sqs queue - " + str(self.sqs_queue_url))
-            print("Error in _extract_tasks():", str(e))
+            logger.error("Failed to extract task from sqs queue - %s", self.sqs_queue_url)
+            logger.error("Error in _extract_tasks(): %s", e)
             raise
 
+    def close(self):
+        # Send the pending acknowledgements and hand back anything that was never settled
+        self.task_acknowledger.close()
+        logger.info("%s", self.result_cache.summary())
+        logger.info("%s", self.decoded_image_cache.summary())
+        logger.info("%s", self.s3_transfer.stats.summary())
+        self.metrics.flush()
+
     @staticmethod
     def _get_name_from_key(key):
         return key.split("/")[-1]
 
-    async def _download_image(self, image_key, file_path):
-        tmp_file_path = os.path.join('/tmp', file_path)
+    async def _download_image(self, image_key, etag=None):
+        # Fetch the object straight into memory instead of going through /tmp
+        try:
+            logger.debug("Downloading %s into memory", image_key)
+            # With an ETag, fail rather than transform different bytes than the ones the output keys were derived from
+            kwargs = {} if etag is None else {"IfMatch": etag}
+            with self.metrics.time("download"):
+                image_data = await self.s3_transfer.download(self.s3_bucket_name, image_key, **kwargs)
+            logger.debug("Downloaded %s successfully", image_key)
+            return image_data
+        except Exception as e:
+            logger.error("Failed to download image %s: %s", image_key, e)
+            raise
+
+    async def _get_image_etag(self, image_key):
+        response = await self.aws_clients.head_object(Bucket=self.s3_bucket_name, Key=image_key)
+        return response["ETag"]
+
+    async def _output_exists(self, output_key):
+        if self.result_cache.contains(output_key):
+            return True
         try:
-            print("Downloading " + image_key + " to " + tmp_file_path)
-            await asyncio.get_event_loop().run_in_executor(
-                None,  # Use the default executor
-                lambda: self.s3_client.download_file(
-                    Bucket=self.s3_bucket_name,
-                    Key=image_key,
-                    Filename=tmp_file_path
-                )
-            )
-            print("Downloaded " + image_key + " to " + tmp_file_path + " successfully")
+            await self.aws_clients.head_object(Bucket=self.s3_bucket_name, Key=output_key)
         except Exception as e:
-            print("Failed to download image " + image_key + " to " + tmp_file_path)
-            print("Error:", str(e))
+            if is_missing(e):
+                return False
             raise
+        self.result_cache.add([output_key])
+        return True
 
     class BWImageProcessor:
-        def __init__(self, s3_client, sqs_queue_url, s3_bucket_name):
-            self.s3_client = s3_client
+        TRANSFORM_PARAMS = "monochrome"
+
+        def __init__(self, s3_transfer, sqs_queue_url, s3_bucket_name, image_encoder):
+            self.s3_transfer = s3_transfer
             self.sqs_queue_url = sqs_queue_url
             self.s3_bucket_name = s3_bucket_name
+            self.image_encoder = image_encoder
 
-        async def _upload_file(self, filename, bucket, key):
-            try:
-                print("Uploading file " + filename + " into " + bucket + " with key: " + key)
-                await asyncio.get_event_loop().run_in_executor(
-                    None,  # Use the default executor
-                    lambda: self.s3_client.upload_file(filename, bucket, key)
-                )
-                # self.s3_client.upload_file(filename, bucket, key)
-                print("Uploaded file " + filename + " into " + bucket + " with key: " + key + " successfully")
-            except Exception as e:
-                print("Failed to upload file " + filename + " into " + bucket + " with key: " + key)
-                print(e)
-
-        async def monochrome_and_upload(self, source_image):
-            # print("inside monochrome and upload")
-            image_name = source_image.split(".")[-2]
-            # print("image_name=", image_name)
-            target_file_path = source_image + "-monochrome.png"
-            # print("target_file_path=", target_file_path)
-            # Construct the full file path inside /tmp directory
-            tmp_target_file_path = os.path.join('/tmp', target_file_path)
-
+        async def _upload_file(self, image_buffer, bucket, key):
             try:
-                # print("source_image=", source_image)
-                # Construct the full file path inside /tmp directory
-                tmp_source_image = os.path.join('/tmp', source_image)
-                await ImageEditor.monochrome(tmp_source_image, tmp_target_file_path)
-                await self._upload_file(tmp_target_file_path, self.s3_bucket_name,
-                                        BW_FOLDER + image_name + "-monochrome-" + str(
-                                            int(round(time.time() * 1000))) + ".png")
+                logger.debug("Uploading image into %s with key: %s", bucket, key)
+                await self.s3_transfer.upload(bucket, key, image_buffer.getvalue(),
+                                              ContentType=self.image_encoder.content_type)
+                logger.debug("Uploaded image into %s with key: %s successfully", bucket, key)
             except Exception as e:
-                print("Error in monochrome_and_upload:", str(e))
+                logger.error("Failed to upload image into %s with key: %s: %s", bucket, key, e)
                 raise
-            finally:
-                delete_file(tmp_target_file_path)
+
+        def output_key(self, image_name, result_fingerprint=None):
+            # Outputs without a fingerprint are not content addressed and get a unique, time based key
+            suffix = result_fingerprint or str(int(round(time.time() * 1000)))
+            return BW_FOLDER + image_name + "-monochrome-" + suffix + self.image_encoder.extension
+
+        async def upload(self, image_name, image_buffer, result_fingerprint=None):
+            await self._upload_file(image_buffer, self.s3_bucket_name, self.output_key(image_name, result_fingerprint))
 
     class BrightenImageProcessor:
-        def __init__(self, s3_client, sqs_queue_url, s3_bucket_name):
-            self.s3_client = s3_client
+        TRANSFORM_PARAMS = "brighten-gamma-" + str(BRIGHTEN_GAMMA)
+
+        def __init__(self, s3_transfer, sqs_queue_url, s3_bucket_name, image_encoder):
+            self.s3_transfer = s3_transfer
             self.sqs_queue_url = sqs_queue_url
             self.s3_bucket_name = s3_bucket_name
+            self.image_encoder = image_encoder
 
-        async def _upload_file(self, filename, bucket, key):
+        async def _upload_file(self, image_buffer, bucket, key):
             try:
-                print("Uploading file " + filename + " into " + bucket + " with key: " + key)
-                await asyncio.get_event_loop().run_in_executor(
-                    None,  # Use the default executor
-                    lambda: self.s3_client.upload_file(filename, bucket, key)
-                )
-                # self.s3_client.upload_file(filename, bucket, key)
-                print("Uploaded file " + filename + " into " + bucket + " with key: " + key + " successfully")
+                logger.debug("Uploading image into %s with key: %s", bucket, key)
+                await self.s3_transfer.upload(bucket, key, image_buffer.getvalue(),
+                                              ContentType=self.image_encoder.content_type)
+                logger.debug("Uploaded image into %s with key: %s successfully", bucket, key)
             except Exception as e:
-                print("Failed to upload file " + filename + " into " + bucket + " with key: " + key)
-                print(e)
+                logger.error("Failed to upload image into %s with key: %s: %s", bucket, key, e)
+                raise
+
+        def output_key(self, image_name, result_fingerprint=None):
+            suffix = result_fingerprint or str(int(round(time.time() * 1000)))
+            return BW_FOLDER + image_name + "-bright-" + suffix + self.image_encoder.extension
+
+        async def upload(self, image_name, image_buffer, result_fingerprint=None):
+            await self._upload_file(image_buffer, self.s3_bucket_name, self.output_key(image_name, result_fingerprint))
+
+    async def _look_up_results(self, image_key):
+        """
+        Output keys are derived from the source's ETag and the transform parameters, so an image that was processed
+        before (a redelivered message, or the same image queued again) is recognised from a HEAD request, or from
+        the result cache without any request. Returns the target image name, the ETag, the fingerprint of each
+        output and whether all outputs already exist.
+        """
+        image_name = self._get_name_from_key(image_key)
+        image_name_without_file_suffix = image_name.split(".")[-2]
+        etag = await self._get_image_etag(image_key)
+        processors = (self.bw_image_processor, self.brighten_image_processor)
+        fingerprints = tuple(fingerprint(etag, processor.TRANSFORM_PARAMS + "|" + self.image_encoder.params)
+                             for processor in processors)
+        output_keys = [processor.output_key(image_name_without_file_suffix, image_fingerprint)
+                       for processor, image_fingerprint in zip(processors, fingerprints)]
+        exists = all(await asyncio.gather(*[self._output_exists(output_key) for output_key in output_keys]))
+        self.result_cache.record(hit=exists)
+        return image_name_without_file_suffix, etag, fingerprints, exists
+
+    def _fail(self, message, stage, error):
+        logger.error("Failed to %s image %s, returning it to the queue: %s", stage, message["Body"], error)
+        self.task_acknowledger.nack(message)
+        self.metrics.count("MessagesFailed")
 
-        async def brighten_and_upload(self, source_image):
-            # print("inside brighten and upload")
-            image_name = source_image.split(".")[-2]
-            target_file_path = source_image + "-bright.png"
-            # Construct the full file path inside /tmp directory
-            tmp_target_file_path = os.path.join('/tmp', target_file_path)
+    async def _receive_stage(self, download_queue, deadline):
+        received = 0
+        failures = 0
+        while self.remaining_receives is None or self.remaining_receives > 0:
+            # Latencies are measured from receive to ack, so they already include the wait behind earlier batches
+            if not deadline.has_time_for():
+                logger.info("Not enough time left in this invocation for another batch")
+                break
+            if self.remaining_receives is not None:
+                self.remaining_receives -= 1
+            try:
+                messages = await self._extract_tasks(deadline.receive_wait_seconds())
+            except Exception:
+                failures += 1
+                if failures == MAX_RECEIVE_ATTEMPTS:
+                    logger.error("Giving up on receiving from sqs queue - %s after %d failed attempts",
+                                 self.sqs_queue_url, failures)
+                    break
+                await asyncio.sleep(RECEIVE_RETRY_DELAY_SECONDS * 2 ** (failures - 1))
+                continue
+            failures = 0
+            if len(messages) == 0:
+                # A full long poll came back empty, the queue is drained
+                break
+            received += len(messages)
+            received_at = time.monotonic()
+            for message in messages:
+                await download_queue.put((message, received_at))
+        return received
 
+    async def _download_stage(self, download_queue, transform_queue, deadline):
+        while True:
+            message, received_at = await download_queue.get()
             try:
-                # Construct the full file path inside /tmp directory
-                tmp_source_image = os.path.join('/tmp', source_image)
-                await ImageEditor.brighten_image(tmp_source_image, tmp_target_file_path)
-                await self._upload_file(tmp_target_file_path, self.s3_bucket_name,
-                                        BW_FOLDER + image_name + "-bright-" + str(
-                                            int(round(time.time() * 1000))) + ".png")
+                if not deadline.has_time_for():
+                    logger.warning("Not enough time left to process image %s, returning it to the queue",
+                                   message["Body"])
+                    self.task_acknowledger.nack(message)
+                    continue
+                image_name, etag, fingerprints, exists = await self._look_up_results(message["Body"])
+                if exists:
+                    logger.debug("Outputs of %s already exist, skipping it", message["Body"])
+                    self.task_acknowledger.ack(message)
+                    self.metrics.count("MessagesSkipped")
+                    deadline.record(received_at)
+                    continue
+                # The source goes on as the decoded image when it is cached, and as its encoded bytes otherwise
+                source = self.decoded_image_cache.get(self.s3_bucket_name, message["Body"], etag)
+                if source is None:
+                    source = await self._download_image(message["Body"], etag)
             except Exception as e:
-                print("Error in brighten_and_upload():", str(e))
-                raise
+                self._fail(message, "download", e)
+            else:
+                await transform_queue.put((message, received_at, image_name, etag, fingerprints, source))
             finally:
-                delete_file(tmp_target_file_path)
-
-    async def process_image(self, image_key):
-        try:
-            image_name = self._get_name_from_key(image_key)
-            image_name_without_file_suffix = image_name.split(".")[-2]
-            image_file_suffix = image_name.split(".")[-1]
-            temp_image_path = image_name_without_file_suffix + "-" + str(random.randrange(100000))
+                download_queue.task_done()
 
-            await self._download_image(image_key, temp_image_path + "." + image_file_suffix)
+    async def _transform_stage(self, transform_queue, upload_queue):
+        while True:
+            message, received_at, image_name, etag, fingerprints, source = await transform_queue.get()
+            try:
+                # Decode, transform and encode both outputs in one call on the CPU stage. The decoded image only
+                # comes back from the worker when the cache has room for it
+                bw_image_buffer = BytesIO()
+                brighten_image_buffer = BytesIO()
+                decoded = await ImageEditor.apply(source, [(ImageEditor.grayscale, bw_image_buffer),
+                                                           (ImageEditor.brighten, brighten_image_buffer)],
+                                                  encoder=self.image_encoder, metrics=self.metrics,
+                                                  keep_decoded_bytes=self.decoded_image_cache.max_bytes)
+                if decoded is not None:
+                    self.decoded_image_cache.put(self.s3_bucket_name, message["Body"], etag, decoded)
+            except Exception as e:
+                self._fail(message, "transform", e)
+            else:
+                await upload_queue.put((message, received_at, image_name, fingerprints, bw_image_buffer,
+                                        brighten_image_buffer))
+            finally:
+                transform_queue.task_done()
 
-            tasks = [
-                self.bw_image_processor.monochrome_and_upload(temp_image_path + "." + image_file_suffix),
-                self.brighten_image_processor.brighten_and_upload(temp_image_path + "." + image_file_suffix)
-            ]
+    async def _upload_stage(self, upload_queue, deadline):
+        while True:
+            message, received_at, image_name, fingerprints, bw_image_buffer, brighten_image_buffer = \
+                await upload_queue.get()
+            try:
+                with self.metrics.time("upload"):
+                    await asyncio.gather(
+                        self.bw_image_processor.upload(image_name, bw_image_buffer, fingerprints[0]),
+                        self.brighten_image_processor.upload(image_name, brighten_image_buffer, fingerprints[1]))
+            except Exception as e:
+                self._fail(message, "upload", e)
+            else:
+                self.result_cache.add([self.bw_image_processor.output_key(image_name, fingerprints[0]),
+                                       self.brighten_image_processor.output_key(image_name, fingerprints[1])])
+                self.task_acknowledger.ack(message)
+                self.metrics.count("MessagesProcessed")
+                self.metrics.record("message", time.monotonic() - received_at)
+                deadline.record(received_at)
+            finally:
+                upload_queue.task_done()
 
-            await asyncio.gather(*tasks)
-            delete_file(temp_image_path + "." + image_file_suffix)
-        except Exception as e:
-            print("Failed to process images sent from process_messages...")
-            print(e)
+    async def process_messages(self, number_of_receives=None, deadline=None):
+        """
+        Run receive -> download -> transform -> upload -> ack as concurrent stages connected by bounded queues,
+        for up to number_of_receives SQS receives (unlimited if None) or until the queue is drained or the
+        deadline leaves no time for another batch. Each stage works on whatever the previous one has handed over,
+        so the next batch is received and downloaded while the current one is still being transformed and
+        uploaded, and a slow stage makes the ones before it wait instead of piling up images in memory.
+        """
+        deadline = deadline or InvocationDeadline()
+        download_queue = asyncio.Queue(PREFETCH_SIZE)
+        transform_queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+        upload_queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+        self.remaining_receives = number_of_receives
 
-    async def process_messages(self):
+        workers = [asyncio.create_task(self._download_stage(download_queue, transform_queue, deadline))
+                   for _ in range(DOWNLOAD_CONCURRENCY)]
+        # More transforms in flight than the CPU stage has workers would only queue up decoded images
+        workers += [asyncio.create_task(self._transform_stage(transform_queue, upload_queue))
+                    for _ in range(default_cpu_stage().max_workers)]
+        workers += [asyncio.create_task(self._upload_stage(upload_queue, deadline)) for _ in range(UPLOAD_CONCURRENCY)]
         try:
-            messages = self._extract_tasks()
-            print("Number of messages extracted from SQS: ", len(messages))
-            if len(messages) == 0:
-                return
+            received = sum(await asyncio.gather(*[self._receive_stage(download_queue, deadline)
+                                                  for _ in range(RECEIVE_CONCURRENCY)]))
+            # Each stage has handed everything on to the next one once its queue is joined
+            for queue in (download_queue, transform_queue, upload_queue):
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-            # Process messages concurrently
-            await asyncio.gather(*[self.process_image(image_key) for image_key in messages])
+        return received
 
-        except Exception as e:
-            print("Failed to process messages from SQS queue...")
-            print(e)
+    async def _run(self, number_of_receives, deadline):
+        await self.aws_clients.open()
+        return await self.process_messages(number_of_receives, deadline)
 
-    def run(self):
-        asyncio.run(self.process_messages())
+    def run(self, number_of_receives=None, deadline=None):
+        # The container's event loop, which the clients were opened on, for the whole run however many batches it
+        # covers; it and the clients stay open for the next invocation
+        return run_on_container_loop(self._run(number_of_receives, deadline))
@@ -6,10 +6,14 @@ import sys
 # Path to the libraries stored in your EFS file system
 sys.path.append("/mnt/access")
 
+from deadline import InvocationDeadline
 from image_processor import ImageProcessor
+from log_config import configure_logging
 
-# logging.getLogger('botocore').setLevel(logging.DEBUG)
+logger = logging.getLogger(__name__)
 
+# Log levels and debug sampling from the DEMO_APP_LOG_* environment variables
+configure_logging()
 
 DEMO_APP_SQS_URL = os.environ['DEMO_APP_SQS_URL']
 DEMO_APP_BUCKET_NAME = os.environ['DEMO_APP_BUCKET_NAME']
@@ -19,11 +23,15 @@ def lambda_handler(event, context):
     sqs_queue_url = DEMO_APP_SQS_URL
     s3_bucket_name = DEMO_APP_BUCKET_NAME
     image_processor = ImageProcessor(sqs_queue_url, s3_bucket_name)
-    number_of_extractions = 90  # In each extraction it retrieves 10 messages i.e. for 50 it gets 500 messages
-
-    for i in range(number_of_extractions):
-        image_processor.run()  # Run the image processing logic
-        print("Number of messages processed: ", ((i + 1) * 10))
+    # Batches are taken for as long as the invocation's remaining time fits another one
+    deadline = InvocationDeadline(context)
+
+    try:
+        # A single pipelined run: the next batch is received and downloaded while the current one is processed
+        number_of_messages = image_processor.run(deadline=deadline)
+        logger.info("Number of messages processed: %d", number_of_messages)
+    finally:
+        image_processor.close()
 
     return {
         'statusCode': 200,
@@ -0,0 +1,74 @@
+import collections
+import hashlib
+import threading
+
+from botocore.exceptions import ClientError
+
+DEFAULT_MAX_ENTRIES = 4096
+# Part of every fingerprint; bump it when a transform's output changes so earlier results are not reused
+RESULT_VERSION = "1"
+
+
+def fingerprint(etag, transform_params):
+    """
+    Content address of one output: the same source bytes (ETag) put through the same transform always give the
+    same fingerprint, and so the same output key.
+    """
+    digest = hashlib.sha256((RESULT_VERSION + "|" + etag + "|" + transform_params).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def is_missing(error):
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey",
+                                                                                              "NotFound")
+
+
+class ResultCache:
+    """
+    Remembers which content-addressed outputs are already in S3, so an image that was transformed before is not
+    downloaded, decoded and uploaded again. Lookups check a local LRU of known output keys first; on a local miss
+    the caller asks S3 with a HEAD request and records what it finds here.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.known_outputs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, output_key):
+        with self.lock:
+            if output_key not in self.known_outputs:
+                return False
+            self.known_outputs.move_to_end(output_key)
+            return True
+
+    def add(self, output_keys):
+        with self.lock:
+            for output_key in output_keys:
+                self.known_outputs[output_key] = True
+                self.known_outputs.move_to_end(output_key)
+            while len(self.known_outputs) > self.max_entries:
+                self.known_outputs.popitem(last=False)
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return "Result cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses (" + \
+            "%.0f" % (hit_rate * 100) + "% hit rate)"
+
+
+_default_result_cache = ResultCache()
+
+
+def default_result_cache():
+    # One cache per container, so warm invocations keep what earlier ones learned about existing outputs
+    return _default_result_cache
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+from s3_transfer import TRANSFER_CONFIG, default_transfer_stats, object_size, part_ranges
+
+
+class AsyncS3Transfer:
+    """
+    Async flavour of s3_transfer.S3Transfer: the same size thresholds, part size, concurrency and stats, with
+    the requests awaited through AsyncAwsClients. Concurrent parts of one object are limited to max_concurrency
+    with a semaphore instead of a thread pool.
+    """
+
+    def __init__(self, aws_clients, multipart_threshold=None, part_size=None, max_concurrency=None, stats=None):
+        self.aws_clients = aws_clients
+        self.multipart_threshold = multipart_threshold or TRANSFER_CONFIG["multipart_threshold"]
+        self.part_size = part_size or TRANSFER_CONFIG["part_size"]
+        self.max_concurrency = max_concurrency or TRANSFER_CONFIG["max_concurrency"]
+        self.stats = stats or default_transfer_stats()
+
+    async def _gather_limited(self, coroutines):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[limited(coroutine) for coroutine in coroutines])
+
+    async def _get_range(self, bucket, key, first_byte, last_byte, get_kwargs):
+        return await self.aws_clients.get_object(Bucket=bucket, Key=key,
+                                                 Range="bytes=%d-%d" % (first_byte, last_byte), **get_kwargs)
+
+    async def download(self, bucket, key, **get_kwargs):
+        started_at = time.monotonic()
+        response, data = await self._get_range(bucket, key, 0, self.part_size - 1, get_kwargs)
+        size = object_size(response)
+        if size is None or len(data) >= size:
+            self.stats.record("download", "single", len(data), time.monotonic() - started_at)
+            return data
+
+        parts = await self._gather_limited([self._get_range(bucket, key, first_byte, last_byte, get_kwargs)
+                                            for first_byte, last_byte in part_ranges(size, self.part_size,
+                                                                                     start=len(data))])
+        data = b"".join([data, *(part_data for _, part_data in parts)])
+        self.stats.record("download", "ranged", len(data), time.monotonic() - started_at)
+        return data
+
+    async def _upload_part(self, bucket, key, upload_id, part_number, body, first_byte, last_byte):
+        response = await self.aws_clients.s3("upload_part", Bucket=bucket, Key=key, UploadId=upload_id,
+                                             PartNumber=part_number, Body=body[first_byte:last_byte + 1])
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    async def upload(self, bucket, key, body, **put_kwargs):
+        started_at = time.monotonic()
+        if len(body) < self.multipart_threshold:
+            await self.aws_clients.put_object(Body=body, Bucket=bucket, Key=key, **put_kwargs)
+            self.stats.record("upload", "single", len(body), time.monotonic() - started_at)
+            return
+
+        response = await self.aws_clients.s3("create_multipart_upload", Bucket=bucket, Key=key, **put_kwargs)
+        upload_id = response["UploadId"]
+        try:
+            parts = await self._gather_limited([
+                self._upload_part(bucket, key, upload_id, part_number, body, first_byte, last_byte)
+                for part_number, (first_byte, last_byte) in enumerate(part_ranges(len(body), self.part_size),
+                                                                      start=1)])
+            await self.aws_clients.s3("complete_multipart_upload", Bucket=bucket, Key=key, UploadId=upload_id,
+                                      MultipartUpload={"Parts": parts})
+        except Exception:
+            # Parts of an unfinished upload are stored (and billed) until the upload is aborted
+            await self.aws_clients.s3("abort_multipart_upload", Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+        self.stats.record("upload", "multipart", len(body), time.monotonic() - started_at)
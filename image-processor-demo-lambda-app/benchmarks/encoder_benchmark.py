@@ -0,0 +1,71 @@
+"""
+Compares encode time against output size for each output format and compression level, on the outputs the image
+processor actually produces (monochrome and brightened), e.g.
+
+    python benchmarks/encoder_benchmark.py example-image.png --scale 8 --repeat 5
+
+--scale tiles the input image to simulate larger photos. Pick DEMO_APP_OUTPUT_FORMAT / DEMO_APP_OUTPUT_LEVEL
+from the results.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+APP_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(APP_ROOT, "original-implementation"))
+
+from image_editor import ImageEditor  # noqa: E402
+from image_encoder import FAST_PNG_LEVEL, ImageEncoder  # noqa: E402
+
+ENCODERS = [
+    ImageEncoder("png", 9),
+    ImageEncoder("png"),
+    ImageEncoder("png", FAST_PNG_LEVEL),
+    ImageEncoder("png", 0),
+    ImageEncoder("webp", 6),
+    ImageEncoder("webp"),
+    ImageEncoder("webp", 0),
+    ImageEncoder("jpeg"),
+    ImageEncoder("jpeg", 75),
+]
+
+
+def time_encode(encoder, image, repeat):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        data = encoder.encode_to_bytes(image)
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings), len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?", default=os.path.join(APP_ROOT, "example-image.png"))
+    parser.add_argument("--scale", type=int, default=4, help="tile the image this many times in each direction")
+    parser.add_argument("--repeat", type=int, default=3, help="encodes per measurement; the median is reported")
+    args = parser.parse_args()
+
+    image = ImageEditor.decode(args.image)
+    image = np.tile(image, (args.scale, args.scale) + (1,) * (image.ndim - 2))
+    outputs = {"monochrome": ImageEditor.grayscale(image), "brighten": ImageEditor.brighten(image)}
+    print("Source %dx%d, %.1f MiB decoded" % (image.shape[1], image.shape[0], image.nbytes / 2 ** 20))
+
+    print("%-10s %-8s %10s %12s %10s" % ("output", "encoder", "encode ms", "bytes", "vs png-6"))
+    for name, output in outputs.items():
+        baseline = None
+        results = [(encoder, *time_encode(encoder, output, args.repeat)) for encoder in ENCODERS]
+        for encoder, seconds, size in results:
+            if encoder.params == ImageEncoder("png").params:
+                baseline = (seconds, size)
+        for encoder, seconds, size in results:
+            print("%-10s %-8s %10.1f %12d %9.2fx size, %.2fx time" % (
+                name, encoder.params, seconds * 1000, size, size / baseline[1], seconds / baseline[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+In-process stand-ins for the S3 and SQS operations the image processors use, so they can be benchmarked without an
+AWS account or network. install() makes boto3.client() return them.
+
+Every call waits request_latency seconds, plus the time its payload takes at bandwidth bytes/second, so variants
+that overlap I/O have something to overlap; the wait is a time.sleep(), which gevent makes cooperative once it has
+patched the process. Long polls return as soon as a message is visible but wait at most max_wait_seconds, rather
+than SQS's 20, so a drained queue is noticed quickly.
+"""
+import hashlib
+import itertools
+import threading
+import time
+from io import BytesIO
+
+import boto3
+from botocore.exceptions import ClientError
+
+MiB = 1024 * 1024
+
+
+def _client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class _Service:
+    def __init__(self, request_latency=0.0, bandwidth=None):
+        self.request_latency = request_latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def _request(self, operation, payload_size=0):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        delay = self.request_latency
+        if self.bandwidth:
+            delay += payload_size / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+
+class FakeS3(_Service):
+    """
+    A single bucket's objects in memory. GetObject honours Range and IfMatch, and put_times records when each object
+    was stored, which is when the benchmark considers an output finished.
+    """
+
+    def __init__(self, request_latency=0.0, bandwidth=None):
+        super().__init__(request_latency, bandwidth)
+        self.objects = {}
+        self.put_times = {}
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+
+    @staticmethod
+    def _etag(data):
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    def _store(self, key, data):
+        with self.lock:
+            self.objects[key] = data
+            self.put_times[key] = time.monotonic()
+        return {"ETag": self._etag(data)}
+
+    def _load(self, key, operation):
+        with self.lock:
+            data = self.objects.get(key)
+        if data is None:
+            raise _client_error("404" if operation == "HeadObject" else "NoSuchKey", "Not Found", operation)
+        return data
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._request("head_object")
+        data = self._load(Key, "HeadObject")
+        return {"ETag": self._etag(data), "ContentLength": len(data)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        data = self._load(Key, "GetObject")
+        etag = self._etag(data)
+        if IfMatch is not None and IfMatch != etag:
+            self._request("get_object")
+            raise _client_error("PreconditionFailed", "At least one of the pre-conditions you specified did not hold",
+                                "GetObject")
+        response = {"ETag": etag}
+        if Range is not None:
+            first_byte, last_byte = (int(value) for value in Range[len("bytes="):].split("-"))
+            last_byte = min(last_byte, len(data) - 1)
+            response["ContentRange"] = "bytes %d-%d/%d" % (first_byte, last_byte, len(data))
+            data = data[first_byte:last_byte + 1]
+        self._request("get_object", len(data))
+        response.update(Body=BytesIO(data), ContentLength=len(data))
+        return response
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self._request("put_object", len(data))
+        return self._store(Key, data)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, "rb") as file:
+            self.put_object(Bucket=Bucket, Key=Key, Body=file.read())
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._request("create_multipart_upload")
+        upload_id = str(next(self.upload_ids))
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self._request("upload_part", len(data))
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = data
+        return {"ETag": self._etag(data)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request("complete_multipart_upload")
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+        return self._store(Key, b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"]))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request("abort_multipart_upload")
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, **kwargs):
+        self._request("list_objects_v2")
+        with self.lock:
+            keys = sorted(key for key in self.objects if key.startswith(Prefix) and key > (ContinuationToken or ""))
+        response = {"Contents": [{"Key": key, "Size": len(self.objects[key])} for key in keys[:MaxKeys]],
+                    "IsTruncated": len(keys) > MaxKeys}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = keys[MaxKeys - 1]
+        return response
+
+
+class FakeSQS(_Service):
+    """
+    One queue with visibility timeouts. Deleted messages are gone; messages whose visibility times out or is set to
+    0 are received again under a new receipt handle. received_at records the first receive of each message body.
+    """
+
+    def __init__(self, request_latency=0.0, bandwidth=None, max_wait_seconds=0.2):
+        super().__init__(request_latency, bandwidth)
+        self.max_wait_seconds = max_wait_seconds
+        self.condition = threading.Condition(self.lock)
+        # Message id -> [body, monotonic time it becomes visible]
+        self.messages = {}
+        self.receipt_handles = {}
+        self.received_at = {}
+        self.deleted = 0
+        self.ids = itertools.count(1)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._request("send_message_batch", sum(len(entry["MessageBody"]) for entry in Entries))
+        with self.condition:
+            for entry in Entries:
+                self.messages[str(next(self.ids))] = [entry["MessageBody"], 0.0]
+            self.condition.notify_all()
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def _take_visible(self, max_messages, visibility_timeout):
+        now = time.monotonic()
+        taken = []
+        for message_id, message in self.messages.items():
+            if len(taken) == max_messages:
+                break
+            if message[1] <= now:
+                message[1] = now + visibility_timeout
+                receipt_handle = message_id + "-" + str(next(self.ids))
+                self.receipt_handles[receipt_handle] = message_id
+                self.received_at.setdefault(message[0], now)
+                taken.append({"MessageId": message_id, "ReceiptHandle": receipt_handle, "Body": message[0]})
+        return taken
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30, **kwargs):
+        self._request("receive_message")
+        give_up_at = time.monotonic() + min(WaitTimeSeconds, self.max_wait_seconds)
+        with self.condition:
+            while True:
+                messages = self._take_visible(MaxNumberOfMessages, VisibilityTimeout)
+                remaining = give_up_at - time.monotonic()
+                if messages or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+        return {"Messages": messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._request("delete_message_batch")
+        with self.condition:
+            for entry in Entries:
+                message_id = self.receipt_handles.pop(entry["ReceiptHandle"], None)
+                if self.messages.pop(message_id, None) is not None:
+                    self.deleted += 1
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self._request("change_message_visibility_batch")
+        now = time.monotonic()
+        with self.condition:
+            for entry in Entries:
+                message = self.messages.get(self.receipt_handles.get(entry["ReceiptHandle"]))
+                if message is not None:
+                    message[1] = now + entry["VisibilityTimeout"]
+            self.condition.notify_all()
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def send(self, bodies):
+        """
+        Queue bodies directly, without the request latency, to set up a run.
+        """
+        with self.condition:
+            for body in bodies:
+                self.messages[str(next(self.ids))] = [body, 0.0]
+            self.condition.notify_all()
+
+
+def install(s3, sqs):
+    """
+    Make boto3.client("s3") and boto3.client("sqs") return s3 and sqs from now on.
+    """
+    services = {"s3": s3, "sqs": sqs}
+    boto3.client = lambda service_name, *args, **kwargs: services[service_name]
@@ -0,0 +1,275 @@
+"""
+Drains a queue of image transform tasks with each implementation of the image processor, against the in-process
+S3 and SQS stand-ins in fake_aws.py, and reports throughput, message latency, peak memory and CPU time, e.g.
+
+    python benchmarks/processor_benchmark.py --messages 200 --sizes 640x480,1920x1080,4000x3000 \\
+        --request-latency-ms 20 --output results.json
+
+The sources are synthetic images of the given sizes, taken in turn, and every message names its own source
+object, so neither the result cache nor the decoded image cache can answer for it. Each implementation runs in a
+process of its own: they share module names, and the greenlet ones patch the process with gevent.
+
+Latency is from a message's first receive until both of its outputs are stored; acknowledgements are batched and
+flushed on their own schedule, so they are counted but not timed. Messages per second are over the same span, from
+the start of the run until the last output is stored.
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import redirect_stdout
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_ROOT = os.path.join(BENCHMARKS_DIR, "..")
+QUEUE_URL = "https://sqs.local/123456789000/BenchmarkQueue"
+BUCKET_NAME = "benchmark-bucket"
+INPUT_FOLDER = "input-images/"
+OUTPUTS_PER_MESSAGE = 2
+MiB = 1024 * 1024
+
+Variant = namedtuple("Variant", ["directory", "module", "uses_gevent"])
+
+VARIANTS = {
+    "original": Variant("original-implementation", "image_processor", False),
+    "greenlet": Variant("greenlet-implementation", "image_processor", True),
+    "asyncio": Variant("asyncio-implementation", "image_processor", False),
+    "legacy": Variant("legacy-single-function", "image_processor", False),
+    "legacy-concurrent": Variant("legacy-single-function", "concurrent_lambda_function", True),
+    "sample-app": Variant(os.path.join("..", "sample-demo-app", "aws_python_sample_application"),
+                          "image_processor", False),
+}
+
+
+def parse_sizes(value):
+    return [tuple(int(side) for side in size.split("x")) for size in value.split(",")]
+
+
+def synthetic_png(width, height, seed):
+    """
+    A PNG of smooth gradients with some noise on top, which compresses about as well as a photo does.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    channels = [(x * (64 + 32 * c) // max(width, 1) + y * (192 - 32 * c) // max(height, 1)) % 256 for c in range(3)]
+    image = np.stack(channels, axis=-1) + rng.integers(-12, 13, size=(height, width, 3))
+    target = BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(target, format="PNG")
+    return target.getvalue()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return float(np.percentile(values, fraction * 100))
+
+
+class BenchmarkContext:
+    """
+    Stands in for the Lambda context: plenty of time is left until every message has its outputs (or timeout
+    seconds have passed), and none after that, so the handler loop ends the way it ends at a real deadline.
+    """
+
+    def __init__(self, finished, timeout):
+        self.finished = finished
+        self.give_up_at = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        if self.finished() or time.monotonic() > self.give_up_at:
+            return 0
+        return 15 * 60 * 1000
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_peak_rss():
+    """
+    Start the peak resident set size over from the current one, so the peak covers the run and not setting it up.
+    Only Linux can; elsewhere the peak is that of the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mib():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MiB if sys.platform == "darwin" else peak / 1024
+
+
+def run_variant(name, args):
+    """
+    Run one implementation in this process and return its measurements.
+    """
+    variant = VARIANTS[name]
+    if variant.uses_gevent:
+        # As in the variant's own entry point, before boto3 is loaded
+        from gevent import monkey
+        monkey.patch_all()
+    sys.path.insert(0, os.path.join(APP_ROOT, variant.directory))
+    os.environ.update(DEMO_APP_SQS_URL=QUEUE_URL, DEMO_APP_BUCKET_NAME=BUCKET_NAME)
+
+    import fake_aws
+    bandwidth = args.bandwidth_mib * MiB if args.bandwidth_mib else None
+    s3 = fake_aws.FakeS3(args.request_latency_ms / 1000, bandwidth)
+    sqs = fake_aws.FakeSQS(args.request_latency_ms / 1000)
+    fake_aws.install(s3, sqs)
+
+    module = importlib.import_module(variant.module)
+    if name == "asyncio":
+        # aiobotocore makes its own clients, which would bypass the stand-ins
+        import aws_clients_async
+        aws_clients_async.get_session = None
+    from deadline import InvocationDeadline
+
+    sources = [synthetic_png(width, height, seed) for seed, (width, height) in enumerate(args.sizes)]
+    keys = []
+    for i in range(args.messages):
+        key = INPUT_FOLDER + "img%05d.png" % i
+        s3.objects[key] = sources[i % len(sources)]
+        keys.append(key)
+    sqs.send(keys)
+
+    expected_outputs = OUTPUTS_PER_MESSAGE * len(keys)
+    context = BenchmarkContext(lambda: len(s3.put_times) >= expected_outputs, args.timeout)
+    processor = module.ImageProcessor(QUEUE_URL, BUCKET_NAME)
+    reset_peak_rss()
+    rss_before_mib = peak_rss_mib()
+    cpu_before = cpu_seconds()
+    started_at = time.monotonic()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        deadline = InvocationDeadline(context)
+        try:
+            # The handler loop of the Lambda functions: batches for as long as the deadline allows
+            while processor.run(deadline=deadline):
+                pass
+        finally:
+            processor.close()
+    cpu = cpu_seconds() - cpu_before
+
+    finished_at = {}
+    for key, put_at in s3.put_times.items():
+        image_name = key.split("/")[-1].split("-")[0]
+        finished_at[image_name] = max(finished_at.get(image_name, put_at), put_at)
+    latencies = []
+    for key in keys:
+        image_name = key.split("/")[-1].split(".")[0]
+        if image_name in finished_at and key in sqs.received_at:
+            latencies.append(finished_at[image_name] - sqs.received_at[key])
+    completed = len(latencies)
+    elapsed = (max(finished_at.values()) - started_at) if finished_at else time.monotonic() - started_at
+    return {
+        "variant": name,
+        "messages": len(keys),
+        "completed": completed,
+        "acknowledged": sqs.deleted,
+        "elapsed_seconds": elapsed,
+        "messages_per_second": completed / elapsed if elapsed else None,
+        "latency_p50_seconds": percentile(latencies, 0.5),
+        "latency_p99_seconds": percentile(latencies, 0.99),
+        "cpu_seconds": cpu,
+        "cpu_ms_per_message": cpu * 1000 / completed if completed else None,
+        "peak_rss_mib": peak_rss_mib(),
+        "rss_before_run_mib": rss_before_mib,
+        "source_bytes": [len(source) for source in sources],
+        "requests": dict([("s3." + operation, count) for operation, count in s3.calls.items()] +
+                         [("sqs." + operation, count) for operation, count in sqs.calls.items()]),
+    }
+
+
+def benchmark(name, args, passthrough):
+    with tempfile.TemporaryDirectory() as directory:
+        result_path = os.path.join(directory, "result.json")
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", name,
+                                    "--result", result_path] + passthrough,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if completed.returncode != 0 or not os.path.exists(result_path):
+            last_lines = completed.stderr.strip().splitlines()[-1:] or ["exit status " + str(completed.returncode)]
+            return {"variant": name, "error": last_lines[0]}
+        with open(result_path) as result:
+            return json.load(result)
+
+
+def print_table(results):
+    print("%-18s %8s %9s %9s %9s %9s %10s" % ("variant", "msgs/s", "p50 ms", "p99 ms", "CPU s", "peak MiB",
+                                             "completed"))
+    for result in results:
+        if "error" in result:
+            print("%-18s failed: %s" % (result["variant"], result["error"]))
+            continue
+        print("%-18s %8.2f %9.1f %9.1f %9.2f %9.1f %6d/%d" % (
+            result["variant"], result["messages_per_second"] or 0, (result["latency_p50_seconds"] or 0) * 1000,
+            (result["latency_p99_seconds"] or 0) * 1000, result["cpu_seconds"], result["peak_rss_mib"],
+            result["completed"], result["messages"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", default=",".join(VARIANTS),
+                        help="comma separated, from: " + ", ".join(VARIANTS))
+    parser.add_argument("--messages", type=int, default=60, help="messages (and source objects) per run")
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("640x480,1920x1080"),
+                        help="comma separated WIDTHxHEIGHT of the synthetic source images")
+    parser.add_argument("--request-latency-ms", type=float, default=10, help="added to every S3 and SQS call")
+    parser.add_argument("--bandwidth-mib", type=float, default=0, help="MiB/s per transfer, 0 for unlimited")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a run is cut short")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.result, "w") as result:
+            json.dump(run_variant(args.worker, args), result)
+        return
+
+    passthrough = ["--messages", str(args.messages),
+                   "--sizes", ",".join("%dx%d" % size for size in args.sizes),
+                   "--request-latency-ms", str(args.request_latency_ms),
+                   "--bandwidth-mib", str(args.bandwidth_mib),
+                   "--timeout", str(args.timeout)]
+    results = []
+    for name in args.variants.split(","):
+        if name not in VARIANTS:
+            parser.error("unknown variant " + name)
+        results.append(benchmark(name, args, passthrough))
+    print_table(results)
+
+    if args.output:
+        report = {
+            "config": {"messages": args.messages, "sizes": ["%dx%d" % size for size in args.sizes],
+                       "request_latency_ms": args.request_latency_ms, "bandwidth_mib": args.bandwidth_mib},
+            "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+            "results": results,
+        }
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print("Results written to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,54 @@
+import logging
 import os
 import threading
 import time
-import boto3
-import random
+import math
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 sys.path.append("/mnt/access")
 
-import gevent
+# Make sockets cooperative before boto3 is loaded so S3/SQS calls yield to the other greenlets
 from gevent import monkey
-from skimage import io, exposure
-from skimage import img_as_ubyte
-from skimage.color import rgb2gray, rgba2rgb
+monkey.patch_all()
+
+from aws_clients import get_client
+from deadline import InvocationDeadline
+from decoded_image_cache import default_decoded_image_cache
+from image_editor import BRIGHTEN_GAMMA, ImageEditor
+from image_key_index import get_image_key_index
+from image_encoder import default_image_encoder
+from log_config import configure_logging
+from result_cache import default_result_cache, fingerprint, is_missing
+from s3_transfer import S3Transfer
+from stage_metrics import StageMetrics
+from task_receiver import MAX_MESSAGES_PER_RECEIVE, MAX_WAIT_TIME_SECONDS, TaskAcknowledger, TaskReceiver
+from worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Log levels and debug sampling from the DEMO_APP_LOG_* environment variables
+configure_logging()
 
 DEMO_APP_SQS_URL = os.environ['DEMO_APP_SQS_URL'] # "https://sqs.REGION.amazonaws.com/ACCOUNT_ID/DemoApplicationQueueLambdaOriginal"
 DEMO_APP_BUCKET_NAME = os.environ['DEMO_APP_BUCKET_NAME'] #"python-lambda-imageprocessor-demo-app-test-bucket-original"
+# Optional fixed number of greenlets; when unset the pool adapts to the I/O vs CPU mix
+DEMO_APP_POOL_SIZE = os.environ.get('DEMO_APP_POOL_SIZE')
 
 BW_FOLDER = "bw-images/"
 BRIGHTEN_FOLDER = "brighten-images/"
 
 SAMPLE_IMAGES_FOLDER = "input-images/"
+# SendMessageBatch accepts at most 10 entries per call
+SEND_BATCH_SIZE = 10
+DEFAULT_CONCURRENT_BATCHES = 8
+MAX_SEND_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.1
 EXAMPLE_IMAGE_LOCAL_PATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "../..", "resources", "example-image.png"
 )
 
+
 def _get_environment_variable(key, example_value):
     value = os.getenv(key)
     if value is None:
@@ -30,308 +56,385 @@ def _get_environment_variable(key, example_value):
     return value
 
 
-def print_tmp_files():
-    tmp_directory = '/tmp'
-
-    try:
-        # List all files in the /tmp directory
-        files = os.listdir(tmp_directory)
-
-        if files:
-            print("Files in /tmp directory:")
-            for file in files:
-                print(os.path.join(tmp_directory, file))
-        else:
-            print("No files found in /tmp directory.")
-    except Exception as e:
-        print("Error:", str(e))
-        print("Failed to list files in /tmp directory.")
-
-
-def delete_file(file_path):
-    print("file_path=", file_path)
-    # print_tmp_files()
-    # Construct the full file path inside /tmp directory
-    tmp_file_path = os.path.join('/tmp', file_path)
-    try:
-        print("Removing file from " + tmp_file_path)
-        os.remove(tmp_file_path)
-        print("Successfully removed file from " + tmp_file_path)
-    except Exception as e:
-        print("Error:", str(e))
-        print("Failed to remove file from" + tmp_file_path)
-
-
-class ImageEditor:
-    @staticmethod
-    def brighten_image(source_filename, target_filename):
-        image = io.imread(source_filename)
-        brightened_image = exposure.adjust_gamma(image, 0.1)
-        io.imsave(fname=target_filename, arr=img_as_ubyte(brightened_image))
-
-    @staticmethod
-    def monochrome(source_filename, target_filename):
-        image = io.imread(source_filename)
-        image_grey = rgb2gray(rgba2rgb(image))
-        io.imsave(fname=target_filename, arr=img_as_ubyte(image_grey))
-
-
 class ImageProcessor:
-    def __init__(self, sqs_queue_url, s3_bucket_name):
-        self.sqs_client = boto3.client('sqs')
-        self.s3_client = boto3.client('s3')
+    def __init__(self, sqs_queue_url, s3_bucket_name, pool_size=None):
+        self.sqs_client = get_client('sqs')
+        self.s3_client = get_client('s3')
         self.sqs_queue_url = sqs_queue_url
         self.s3_bucket_name = s3_bucket_name
-        self.bw_image_processor = self.BWImageProcessor(self.s3_client, self.sqs_queue_url, self.s3_bucket_name)
-        self.brighten_image_processor = self.BrightenImageProcessor(self.s3_client, self.sqs_queue_url,
-                                                                    self.s3_bucket_name)
-
-    def _extract_tasks(self):
+        self.image_encoder = default_image_encoder()
+        # Whole-object transfers, as a single request or in concurrent parts depending on the object's size
+        self.s3_transfer = S3Transfer(self.s3_client)
+        self.bw_image_processor = self.BWImageProcessor(self.s3_transfer, self.sqs_queue_url, self.s3_bucket_name,
+                                                        self.image_encoder)
+        self.brighten_image_processor = self.BrightenImageProcessor(self.s3_transfer, self.sqs_queue_url,
+                                                                    self.s3_bucket_name, self.image_encoder)
+        # Per-stage latencies and message counts, written as one EMF log line per invocation by close()
+        self.metrics = StageMetrics("legacy-concurrent")
+        self.task_acknowledger = TaskAcknowledger(self.sqs_client, self.sqs_queue_url, metrics=self.metrics)
+        # Tracks prefetched messages from the moment they are received, so they are heartbeated while buffered
+        self.task_receiver = TaskReceiver(self.sqs_client, self.sqs_queue_url, acknowledger=self.task_acknowledger)
+        # Shared by every processor in the container, so warm invocations skip outputs that already exist
+        self.result_cache = default_result_cache()
+        # Also container wide, so messages for the same source image reuse one download and decode
+        self.decoded_image_cache = default_decoded_image_cache()
+        # pool_size=None lets the pool size itself from the observed I/O vs CPU mix
+        self.worker_pool = WorkerPool(pool_size)
+
+    def _extract_tasks(self, wait_seconds=MAX_WAIT_TIME_SECONDS, deadline=None):
         try:
-            print("Extracting tasks from sqs queue - " + self.sqs_queue_url)
-            response = self.sqs_client.receive_message(QueueUrl=self.sqs_queue_url, MaxNumberOfMessages=1)
-            if "Messages" not in response:
-                print("No messages exists in SQS queue at the moment, retry later.")
+            logger.debug("Extracting tasks from sqs queue - %s", self.sqs_queue_url)
+            # Long-polled full batches are prefetched in the background; this only waits if the buffer is empty
+            with self.metrics.time("receive"):
+                response_messages = self.task_receiver.receive(timeout=wait_seconds, deadline=deadline)
+            if len(response_messages) == 0:
+                logger.info("No messages exists in SQS queue at the moment, retry later.")
                 return []
-            messages = list(map(lambda x: x["Body"], response["Messages"]))
-            print("Extracted tasks from sqs queue successfully")
-            return messages
+            logger.debug("Extracted tasks from sqs queue successfully")
+            return response_messages
         except Exception:
-            print("Failed to extract task from sqs queue - " + str(self.sqs_queue_url))
+            logger.error("Failed to extract task from sqs queue - %s", self.sqs_queue_url)
             raise
 
+    def close(self):
+        # Stop prefetching and hand any buffered messages straight back to the queue
+        self.task_receiver.stop()
+        self.task_acknowledger.close()
+        logger.info("%s", self.result_cache.summary())
+        logger.info("%s", self.decoded_image_cache.summary())
+        self.s3_transfer.close()
+        logger.info("%s", self.s3_transfer.stats.summary())
+        self.metrics.flush()
+
     @staticmethod
     def _get_name_from_key(key):
         return key.split("/")[-1]
 
-    def _download_image(self, image_key, file_path):
-        # Construct the full file path inside /tmp directory
-        tmp_file_path = os.path.join('/tmp', file_path)
+    def _download_image(self, image_key, etag=None):
+        # Fetch the object straight into memory instead of going through /tmp
+        try:
+            logger.debug("Downloading %s into memory", image_key)
+            kwargs = {}
+            if etag is not None:
+                # Fail rather than transform different bytes than the ones the output keys were derived from
+                kwargs["IfMatch"] = etag
+            with self.metrics.time("download"):
+                image_data = self.s3_transfer.download(self.s3_bucket_name, image_key, **kwargs)
+            logger.debug("Downloaded %s successfully", image_key)
+            return image_data
+        except Exception as e:
+            logger.error("Failed to download image %s: %s", image_key, e)
+            raise
+
+    def _load_image(self, image_key, etag):
+        image = self.decoded_image_cache.get(self.s3_bucket_name, image_key, etag)
+        if image is not None:
+            logger.debug("Using decoded %s from memory", image_key)
+            return image
+        image_data = self._download_image(image_key, etag)
+        with self.metrics.time("decode"):
+            image = ImageEditor.decode(BytesIO(image_data))
+        self.decoded_image_cache.put(self.s3_bucket_name, image_key, etag, image)
+        return image
+
+    def _get_image_etag(self, image_key):
+        return self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=image_key)["ETag"]
+
+    def _output_exists(self, output_key):
+        if self.result_cache.contains(output_key):
+            return True
         try:
-            print("Downloading " + image_key + " to " + tmp_file_path)
-            self.s3_client.download_file(Bucket=self.s3_bucket_name, Key=image_key, Filename=tmp_file_path)
-            print("Downloaded " + image_key + " to " + tmp_file_path + " successfully")
+            self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=output_key)
         except Exception as e:
-            print("Failed to download image " + image_key + " to " + tmp_file_path)
-            print("Error:", str(e))
+            if is_missing(e):
+                return False
             raise
+        self.result_cache.add([output_key])
+        return True
 
     class BWImageProcessor:
-        def __init__(self, s3_client, sqs_queue_url, s3_bucket_name):
-            self.s3_client = s3_client
+        TRANSFORM_PARAMS = "monochrome"
+
+        def __init__(self, s3_transfer, sqs_queue_url, s3_bucket_name, image_encoder):
+            self.s3_transfer = s3_transfer
             self.sqs_queue_url = sqs_queue_url
             self.s3_bucket_name = s3_bucket_name
+            self.image_encoder = image_encoder
 
-        def _upload_file(self, filename, bucket, key):
+        def _upload_file(self, image_buffer, bucket, key):
             try:
-                print("Uploading file " + filename + " into " + bucket + " with key: " + key)
-                self.s3_client.upload_file(filename, bucket, key)
-                print("Uploaded file " + filename + " into " + bucket + " with key: " + key + " successfully")
+                logger.debug("Uploading image into %s with key: %s", bucket, key)
+                self.s3_transfer.upload(bucket, key, image_buffer.getvalue(),
+                                        ContentType=self.image_encoder.content_type)
+                logger.debug("Uploaded image into %s with key: %s successfully", bucket, key)
             except Exception:
-                print("Failed to upload file " + filename + " into " + bucket + " with key: " + key)
+                logger.error("Failed to upload image into %s with key: %s", bucket, key)
+                raise
 
-        def monochrome_and_upload(self, source_image):
-            print("inside monochrome and upload")
-            image_name = source_image.split(".")[-2]
-            print("image_name=", image_name)
-            target_file_path = source_image + "-monochrome.png"
-            print("target_file_path=", target_file_path)
-            # Construct the full file path inside /tmp directory
-            tmp_target_file_path = os.path.join('/tmp', target_file_path)
+        def output_key(self, image_name, result_fingerprint=None):
+            # Outputs without a fingerprint are not content addressed and get a unique, time based key
+            suffix = result_fingerprint or str(int(round(time.time() * 1000)))
+            return BW_FOLDER + image_name + "-monochrome-" + suffix + self.image_encoder.extension
 
-            try:
-                print("source_image=", source_image)
-                # Construct the full file path inside /tmp directory
-                tmp_source_image = os.path.join('/tmp', source_image)
-                ImageEditor.monochrome(tmp_source_image, tmp_target_file_path)
-                print("Calling upload")
-                self._upload_file(tmp_target_file_path, self.s3_bucket_name,
-                                  BW_FOLDER + image_name + "-monochrome-" + str(
-                                      int(round(time.time() * 1000))) + ".png")
-            except Exception as e:
-                print("Error in monochrome_and_upload:", str(e))
-                raise
-            finally:
-                delete_file(tmp_target_file_path)
+        def upload(self, image_name, image_buffer, result_fingerprint=None):
+            self._upload_file(image_buffer, self.s3_bucket_name, self.output_key(image_name, result_fingerprint))
 
     class BrightenImageProcessor:
-        def __init__(self, s3_client, sqs_queue_url, s3_bucket_name):
-            self.s3_client = s3_client
+        TRANSFORM_PARAMS = "brighten-gamma-" + str(BRIGHTEN_GAMMA)
+
+        def __init__(self, s3_transfer, sqs_queue_url, s3_bucket_name, image_encoder):
+            self.s3_transfer = s3_transfer
             self.sqs_queue_url = sqs_queue_url
             self.s3_bucket_name = s3_bucket_name
+            self.image_encoder = image_encoder
 
-        def _upload_file(self, filename, bucket, key):
+        def _upload_file(self, image_buffer, bucket, key):
             try:
-                print("Uploading file " + filename + " into " + bucket + " with key: " + key)
-                self.s3_client.upload_file(filename, bucket, key)
-                print("Uploaded file " + filename + " into " + bucket + " with key: " + key + " successfully")
-            except Exception:
-                print("Failed to upload file " + filename + " into " + bucket + " with key: " + key)
-
-        def brighten_and_upload(self, source_image):
-            print("inside brighten and upload")
-            image_name = source_image.split(".")[-2]
-            target_file_path = source_image + "-bright.png"
-            # Construct the full file path inside /tmp directory
-            tmp_target_file_path = os.path.join('/tmp', target_file_path)
-
-            try:
-                # Construct the full file path inside /tmp directory
-                tmp_source_image = os.path.join('/tmp', source_image)
-                ImageEditor.brighten_image(tmp_source_image, tmp_target_file_path)
-                self._upload_file(tmp_target_file_path, self.s3_bucket_name,
-                                  BW_FOLDER + image_name + "-bright-" + str(int(round(time.time() * 1000))) + ".png")
+                logger.debug("Uploading image into %s with key: %s", bucket, key)
+                self.s3_transfer.upload(bucket, key, image_buffer.getvalue(),
+                                        ContentType=self.image_encoder.content_type)
+                logger.debug("Uploaded image into %s with key: %s successfully", bucket, key)
             except Exception:
+                logger.error("Failed to upload image into %s with key: %s", bucket, key)
                 raise
-            finally:
-                delete_file(tmp_target_file_path)
-
-    def process_image(self, messages, bw_image_processor, brighten_image_processor):
-        for image_key in messages:
-            image_name = self._get_name_from_key(image_key)
-            print("Image name: " + image_name)
-            image_name_without_file_suffix = image_name.split(".")[-2]
-            image_file_suffix = image_name.split(".")[-1]
-            temp_image_path = image_name_without_file_suffix + "-" + str(random.randrange(100000))
-            self._download_image(image_key, temp_image_path + "." + image_file_suffix)
-            bw_image_processor.monochrome_and_upload(temp_image_path + "." + image_file_suffix)
-            brighten_image_processor.brighten_and_upload(temp_image_path + "." + image_file_suffix)
-            delete_file(temp_image_path + "." + image_file_suffix)
 
-    def concurrent_processing(self, messages, bw_image_processor, brighten_image_processor):
-        greenlets = []
-        number_of_greenlets = 2
+        def output_key(self, image_name, result_fingerprint=None):
+            suffix = result_fingerprint or str(int(round(time.time() * 1000)))
+            return BW_FOLDER + image_name + "-bright-" + suffix + self.image_encoder.extension
 
-        # Calculate the number of messages per greenlet
-        messages_per_greenlet = len(messages) // number_of_greenlets
+        def upload(self, image_name, image_buffer, result_fingerprint=None):
+            self._upload_file(image_buffer, self.s3_bucket_name, self.output_key(image_name, result_fingerprint))
 
-        for i in range(number_of_greenlets):
-            start_idx = i * messages_per_greenlet
-            end_idx = start_idx + messages_per_greenlet
-            sub_messages = messages[start_idx:end_idx]
+    def _transform_and_upload(self, image, image_name, bw_image_processor, brighten_image_processor,
+                              fingerprints=(None, None)):
+        """
+        Produce both the monochrome and the brightened output from the same decoded image, encoding each into
+        its own in-memory buffer.
+        """
+        try:
+            bw_image_buffer = BytesIO()
+            brighten_image_buffer = BytesIO()
+            timings = {}
+            ImageEditor.apply(image, [(ImageEditor.grayscale, bw_image_buffer),
+                                      (ImageEditor.brighten, brighten_image_buffer)], self.image_encoder, timings)
+            self.metrics.record_all(timings)
+            with self.metrics.time("upload"):
+                bw_image_processor.upload(image_name, bw_image_buffer, fingerprints[0])
+                brighten_image_processor.upload(image_name, brighten_image_buffer, fingerprints[1])
+        except Exception as e:
+            logger.error("Error in _transform_and_upload: %s", e)
+            raise
 
-            greenlets.append(
-                gevent.spawn(self.process_image, sub_messages, bw_image_processor, brighten_image_processor))
+    def _process_image_key(self, image_key, bw_image_processor, brighten_image_processor):
+        """
+        Transform one input image, unless its outputs already exist. Output keys are derived from the source's ETag
+        and the transform parameters, so an image that was processed before (a redelivered message, or the same
+        image queued again) is recognised from a HEAD request, or from the result cache without any request, and is
+        neither downloaded nor uploaded again.
+        """
+        image_name = self._get_name_from_key(image_key)
+        image_name_without_file_suffix = image_name.split(".")[-2]
+        etag = self._get_image_etag(image_key)
+        processors = (bw_image_processor, brighten_image_processor)
+        fingerprints = tuple(fingerprint(etag, processor.TRANSFORM_PARAMS + "|" + self.image_encoder.params)
+                             for processor in processors)
+        output_keys = [processor.output_key(image_name_without_file_suffix, image_fingerprint)
+                       for processor, image_fingerprint in zip(processors, fingerprints)]
+        if all(self._output_exists(output_key) for output_key in output_keys):
+            self.result_cache.record(hit=True)
+            self.metrics.count("MessagesSkipped")
+            logger.debug("Outputs of %s already exist, skipping it", image_key)
+            return
+        self.result_cache.record(hit=False)
+        image = self._load_image(image_key, etag)
+        self._transform_and_upload(image, image_name_without_file_suffix, bw_image_processor,
+                                   brighten_image_processor, fingerprints)
+        self.result_cache.add(output_keys)
 
-        gevent.joinall(greenlets)
+    def process_image(self, messages, bw_image_processor, brighten_image_processor):
+        for image_key in messages:
+            self._process_image_key(image_key, bw_image_processor, brighten_image_processor)
 
-    def run(self):
+    def _process_message(self, message, bw_image_processor, brighten_image_processor, deadline):
+        image_key = message["Body"]
+        if not deadline.has_time_for():
+            logger.warning("Not enough time left to process image %s, returning it to the queue", image_key)
+            self.task_acknowledger.nack(message)
+            return
+        started_at = time.monotonic()
         try:
-            messages = self._extract_tasks()
+            self.process_image([image_key], bw_image_processor, brighten_image_processor)
+        except Exception as e:
+            logger.error("Failed to process image %s, returning it to the queue: %s", image_key, e)
+            self.task_acknowledger.nack(message)
+            self.metrics.count("MessagesFailed")
+            return
+        self.task_acknowledger.ack(message)
+        self.metrics.count("MessagesProcessed")
+        self.metrics.record("message", time.monotonic() - started_at)
+        deadline.record(started_at)
+
+    def concurrent_processing(self, messages, bw_image_processor, brighten_image_processor, deadline=None):
+        deadline = deadline or InvocationDeadline()
+        # Idle greenlets pull the next message from a shared queue, so no batch size leaves messages behind
+        self.worker_pool.map(lambda message: self._process_message(message, bw_image_processor,
+                                                                   brighten_image_processor, deadline), messages)
+
+    def run(self, deadline=None):
+        deadline = deadline or InvocationDeadline()
+        messages = []
+        try:
+            # pool_size messages are processed at a time, so a batch takes this many message latencies
+            rounds = math.ceil(MAX_MESSAGES_PER_RECEIVE / self.worker_pool.pool_size)
+            if not deadline.has_time_for(rounds):
+                logger.info("Not enough time left in this invocation for another batch")
+                return 0
+            messages = self._extract_tasks(deadline.receive_wait_seconds(rounds), deadline)
             if len(messages) == 0:
-                return
+                return 0
 
             # Call concurrent_processing function
-            self.concurrent_processing(messages, self.bw_image_processor, self.brighten_image_processor)
+            self.concurrent_processing(messages, self.bw_image_processor, self.brighten_image_processor, deadline)
         except Exception as e:
-            print("Failed to process message from SQS queue...")
-            print(e)
+            logger.error("Failed to process message from SQS queue...: %s", e)
+        return len(messages)
 
 
 class TaskPublisher:
-    def __init__(self, sqs_queue_url, s3_bucket_name):
-        self.s3_client = boto3.client('s3')
-        self.sqs_client = boto3.client('sqs')
+    def __init__(self, sqs_queue_url, s3_bucket_name, concurrent_batches=DEFAULT_CONCURRENT_BATCHES):
+        self.s3_client = get_client('s3')
+        self.sqs_client = get_client('sqs')
         self.sqs_queue_url = sqs_queue_url
         self.s3_bucket_name = s3_bucket_name
+        self.concurrent_batches = concurrent_batches
+        # Container wide, so the listing is reused by later invocations until it expires
+        self.image_index = get_image_key_index(self.s3_client, self.s3_bucket_name, SAMPLE_IMAGES_FOLDER)
 
     def _list_image_on_s3(self):
-        try:
-            print("Listing image in " + self.s3_bucket_name + " under " + SAMPLE_IMAGES_FOLDER)
-            response = self.s3_client.list_objects_v2(Bucket=self.s3_bucket_name, Prefix=SAMPLE_IMAGES_FOLDER)
-            print("response=",response)
-
-            objects_in_s3 = list(map(lambda x: x["Key"], response["Contents"]))
-            print("Listed image in " + self.s3_bucket_name + " under " + SAMPLE_IMAGES_FOLDER + " successfully.")
-            return list(filter(lambda x: x != SAMPLE_IMAGES_FOLDER, objects_in_s3))
-        except Exception:
-            print("Failed to list images in " + self.s3_bucket_name + " under " + SAMPLE_IMAGES_FOLDER)
-            return []
+        # Served from the cached index, S3 is only listed again once it has expired
+        return self.image_index.keys()
 
     def _upload_images_onto_s3(self):
         try:
-            print("Uploading example image onto S3")
+            logger.info("Uploading example image onto S3")
             self.s3_client.upload_file(Filename=EXAMPLE_IMAGE_LOCAL_PATH, Bucket=self.s3_bucket_name,
                                        Key=SAMPLE_IMAGES_FOLDER + "example-image.png")
-            print("Successfully uploaded example image onto S3")
+            logger.info("Successfully uploaded example image onto S3")
         except Exception:
-            print("Failed to upload example image onto S3")
+            logger.error("Failed to upload example image onto S3")
             raise
 
-    def _send_sqs_message(self, message):
-        try:
-            print("sqs_queue_url=",self.sqs_queue_url)
-            print("message=", message)
-            self.sqs_client.send_message(
-                QueueUrl=self.sqs_queue_url,
-                MessageBody=message
-            )
-            print("Sent task to SQS.")
-        except Exception:
-            print("Failed to send message onto sqs queue")
+    def _send_sqs_message_batch(self, messages):
+        """
+        Send up to ten messages with one SendMessageBatch call. Entries that fail on the SQS side are retried on
+        their own with a short backoff, entries SQS rejects as invalid are not. Returns how many messages could
+        not be sent.
+        """
+        entries = [{"Id": str(i), "MessageBody": message} for i, message in enumerate(messages)]
+        rejected = 0
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            try:
+                response = self.sqs_client.send_message_batch(QueueUrl=self.sqs_queue_url, Entries=entries)
+            except Exception as e:
+                logger.error("Failed to send message batch onto sqs queue: %s", e)
+                continue
+
+            retry_ids = set()
+            for failure in response.get("Failed", []):
+                if failure.get("SenderFault"):
+                    rejected += 1
+                    logger.warning("Message rejected by sqs queue: %s", failure.get("Message", failure["Code"]))
+                else:
+                    retry_ids.add(failure["Id"])
+            entries = [entry for entry in entries if entry["Id"] in retry_ids]
+            if not entries:
+                break
+        if entries:
+            logger.error("Failed to send %d messages onto sqs queue after %d attempts", len(entries),
+                         MAX_SEND_ATTEMPTS)
+        return rejected + len(entries)
+
+    def publish_messages(self, messages):
+        """
+        Publish messages in SendMessageBatch calls of ten, with up to concurrent_batches calls in flight, and
+        report the throughput. Returns the number of messages sent.
+        """
+        batches = [messages[start:start + SEND_BATCH_SIZE] for start in range(0, len(messages), SEND_BATCH_SIZE)]
+        if not batches:
+            return 0
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.concurrent_batches, len(batches)),
+                                thread_name_prefix="task-publisher") as executor:
+            failed = sum(executor.map(self._send_sqs_message_batch, batches))
+        elapsed_time = time.perf_counter() - start_time
+
+        sent = len(messages) - failed
+        logger.info("Published %d of %d tasks onto sqs in %.2fs (%.1f tasks/s)", sent, len(messages), elapsed_time,
+                    sent / max(elapsed_time, 1e-9))
+        return sent
 
     def publish_image_transform_task(self, num_of_tasks=10):
         images = self._list_image_on_s3()
         if len(images) == 0:
-            print("No images in bucket.")
-            return
+            logger.warning("No images in bucket.")
+            return 0
 
-        print("Start publishing task onto sqs...")
-        for i in range(num_of_tasks):
-            lucky_number = random.randint(0, len(images)-1)
-            self._send_sqs_message(str(images[lucky_number]))
+        logger.info("Start publishing task onto sqs...")
+        messages = self.image_index.sample(num_of_tasks)
+        return self.publish_messages(messages)
 
 
 class SampleDemoApp:
-    def __init__(self):
+    def __init__(self, context=None):
         self.sqs_queue_url = DEMO_APP_SQS_URL
         self.s3_bucket_name = DEMO_APP_BUCKET_NAME
         self.task_publisher = TaskPublisher(self.sqs_queue_url, self.s3_bucket_name)
-        self.image_processor = ImageProcessor(self.sqs_queue_url, self.s3_bucket_name)
+        self.image_processor = ImageProcessor(self.sqs_queue_url, self.s3_bucket_name,
+                                              int(DEMO_APP_POOL_SIZE) if DEMO_APP_POOL_SIZE else None)
+        # Both loops run for as long as the invocation has time for another batch
+        self.deadline = InvocationDeadline(context)
+        self.stop_processing = False
+
+    def _has_time_for_batch(self):
+        return not self.stop_processing and self.deadline.has_time_for(MAX_MESSAGES_PER_RECEIVE)
 
     def _publish_task(self):
-        print("inside _publish_task")
-        self.stop_processing = False
-        start_time = time.time()  # Start time of the task_publisher thread
+        logger.debug("inside _publish_task")
         """
         Publish image transform task every 10 seconds
         """
-        while not self.stop_processing:
-            print("inside the loop")
+        while self._has_time_for_batch():
+            logger.debug("inside the loop")
             self.task_publisher.publish_image_transform_task()
 
             time.sleep(10)
 
-            # Check if 14 minutes have passed
-            elapsed_time = time.time() - start_time
-            if elapsed_time >= 20:
-                self.stop_processing = True  # Set the flag to stop processing
-                break  # Exit the loop to stop processing immediately
-
     def _process_message(self):
-        print("inside _process_message")
-        self.stop_processing = False
-        start_time = time.time()  # Start time of the image_processor thread
+        logger.debug("inside _process_message")
         """
         Process messages
         """
-        while not self.stop_processing:
-            print("inside the loop")
-            self.image_processor.run()
-
-            # Check if 14 minutes have passed
-            elapsed_time = time.time() - start_time
-            if elapsed_time >= 20:
-                self.stop_processing = True  # Set the flag to stop processing
-                break  # Exit the loop to stop processing immediately
+        try:
+            while self._has_time_for_batch():
+                logger.debug("inside the loop")
+                self.image_processor.run(self.deadline)
+        finally:
+            self.stop_processing = True  # Set the flag to stop publishing as well
+            # Hand any prefetched and unfinished messages back to the queue for the next invocation
+            self.image_processor.close()
 
     def run(self):
-        # Publisher
-        self._publish_task()
+        # Publisher, in its own greenlet so processing has the whole invocation rather than what publishing leaves
+        task_publisher_thread = threading.Thread(target=self._publish_task, name="task_publisher_scheduler",
+                                                 daemon=True)
+        task_publisher_thread.start()
 
         # Listener
         self._process_message()
 
 
 def lambda_handler(event, context):
-    SampleDemoApp().run()
+    SampleDemoApp(context).run()
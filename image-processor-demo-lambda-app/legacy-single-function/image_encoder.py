@@ -0,0 +1,90 @@
+import os
+from io import BytesIO
+
+from PIL import Image
+
+from png_encoder import StreamingPngEncoder
+
+# File extension and content type of each output format
+FORMATS = {
+    "png": (".png", "image/png"),
+    "webp": (".webp", "image/webp"),
+    "jpeg": (".jpg", "image/jpeg"),
+}
+# Valid levels of each format, inclusive. PNG: zlib level. WebP (lossless): effort. JPEG: quality.
+LEVEL_RANGES = {"png": (0, 9), "webp": (0, 6), "jpeg": (1, 95)}
+DEFAULT_LEVELS = {"png": 6, "webp": 4, "jpeg": 90}
+# Deflates several times faster than the default level for output that is only slightly larger
+FAST_PNG_LEVEL = 1
+MAX_WEBP_LEVEL = LEVEL_RANGES["webp"][1]
+
+
+class ImageEncoder:
+    """
+    Encodes transformed images (uint8 numpy arrays) in one output format at one compression level, into a
+    filename or a file-like object such as BytesIO. PNG and WebP are lossless; JPEG is lossy and has no alpha
+    channel, so images with transparency are composited over white first, as grayscale does.
+
+    The level trades encode time for output size; the benchmarks directory compares them on real images.
+    """
+
+    def __init__(self, image_format="png", level=None):
+        if image_format not in FORMATS:
+            raise ValueError("Unsupported output format " + image_format + ", expected one of " + ", ".join(FORMATS))
+        self.image_format = image_format
+        self.level = DEFAULT_LEVELS[image_format] if level is None else int(level)
+        lowest, highest = LEVEL_RANGES[image_format]
+        if not lowest <= self.level <= highest:
+            raise ValueError("Unsupported " + image_format + " level " + str(self.level) + ", expected " +
+                             str(lowest) + " to " + str(highest))
+        self.extension, self.content_type = FORMATS[image_format]
+
+    @property
+    def params(self):
+        # Part of the result fingerprint, so outputs of another format or level are never mistaken for these
+        return self.image_format + "-" + str(self.level)
+
+    @property
+    def streams(self):
+        """
+        Whether images can be encoded a strip of rows at a time through stream().
+        """
+        return self.image_format == "png"
+
+    def stream(self, target, width, height, channels):
+        return StreamingPngEncoder(target, width, height, channels, level=self.level)
+
+    def encode(self, image, target):
+        picture = Image.fromarray(image)
+        if self.image_format == "png":
+            picture.save(target, format="PNG", compress_level=self.level)
+        elif self.image_format == "webp":
+            if picture.mode == "LA":
+                picture = picture.convert("RGBA")
+            # For lossless WebP, quality is the effort spent on compression rather than a loss of detail; exact keeps
+            # the colour of fully transparent pixels, which the encoder would otherwise change to compress better
+            picture.save(target, format="WEBP", lossless=True, exact=True, method=self.level,
+                         quality=self.level * 100 // MAX_WEBP_LEVEL)
+        else:
+            if picture.mode in ("RGBA", "LA"):
+                background = Image.new("RGB", picture.size, (255, 255, 255))
+                background.paste(picture.convert("RGBA"), mask=picture.getchannel("A"))
+                picture = background
+            picture.save(target, format="JPEG", quality=self.level)
+
+    def encode_to_bytes(self, image):
+        target = BytesIO()
+        self.encode(image, target)
+        return target.getvalue()
+
+
+_default_image_encoder = None
+
+
+def default_image_encoder():
+    # Configured once per container from DEMO_APP_OUTPUT_FORMAT (png, webp or jpeg) and DEMO_APP_OUTPUT_LEVEL
+    global _default_image_encoder
+    if _default_image_encoder is None:
+        _default_image_encoder = ImageEncoder(os.environ.get("DEMO_APP_OUTPUT_FORMAT", "png"),
+                                              os.environ.get("DEMO_APP_OUTPUT_LEVEL"))
+    return _default_image_encoder
@@ -0,0 +1,94 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_TTL_SECONDS = 300
+
+
+class ImageKeyIndex:
+    """
+    Cached listing of the image keys under a prefix. The listing pages through every ListObjectsV2 response, so
+    prefixes with more than 1000 keys are complete, and is kept for ttl_seconds before S3 is listed again. The keys
+    are held in a list, so sampling a key is a constant time index instead of a scan.
+
+    ListObjectsV2 has no conditional form, so freshness is time based; callers that add images themselves call
+    invalidate() to have them picked up on the next lookup. Each key's ETag is kept alongside it, and a refresh that
+    comes back with the same keys and ETags is reported as unchanged.
+    """
+
+    def __init__(self, s3_client, s3_bucket_name, prefix, ttl_seconds=DEFAULT_INDEX_TTL_SECONDS):
+        self.s3_client = s3_client
+        self.s3_bucket_name = s3_bucket_name
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self.image_keys = []
+        self.etags = {}
+        self.expires_at = None
+        self.lock = threading.Lock()
+
+    def _list_all(self):
+        etags = {}
+        kwargs = {"Bucket": self.s3_bucket_name, "Prefix": self.prefix}
+        while True:
+            response = self.s3_client.list_objects_v2(**kwargs)
+            for s3_object in response.get("Contents", []):
+                # The folder placeholder object is not an image
+                if s3_object["Key"] != self.prefix:
+                    etags[s3_object["Key"]] = s3_object.get("ETag")
+            if not response.get("IsTruncated"):
+                return etags
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def refresh(self):
+        try:
+            logger.debug("Listing image in %s under %s", self.s3_bucket_name, self.prefix)
+            etags = self._list_all()
+            if etags == self.etags:
+                logger.debug("Images in %s under %s unchanged.", self.s3_bucket_name, self.prefix)
+            else:
+                self.etags = etags
+                self.image_keys = list(etags)
+            logger.info("Listed %d images in %s under %s successfully.", len(self.image_keys), self.s3_bucket_name,
+                        self.prefix)
+        except Exception as e:
+            # Keep serving the previous listing; it is retried on the next lookup
+            logger.error("Failed to list images in %s under %s: %s", self.s3_bucket_name, self.prefix, e)
+            return
+        self.expires_at = time.monotonic() + self.ttl_seconds
+
+    def invalidate(self):
+        self.expires_at = None
+
+    def keys(self):
+        with self.lock:
+            if self.expires_at is None or time.monotonic() >= self.expires_at:
+                self.refresh()
+            return self.image_keys
+
+    def sample(self, k):
+        """
+        Return k keys drawn uniformly at random, with replacement.
+        """
+        image_keys = self.keys()
+        if not image_keys:
+            return []
+        return [image_keys[random.randrange(len(image_keys))] for _ in range(k)]
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_image_key_index(s3_client, s3_bucket_name, prefix):
+    """
+    Return the container-wide index of prefix in s3_bucket_name, creating it on first use. Handlers build a new
+    publisher on every invocation, so an index of their own would be listed afresh each time and never serve a hit.
+    """
+    with _lock:
+        index = _indexes.get((s3_bucket_name, prefix))
+        if index is None:
+            index = _indexes[(s3_bucket_name, prefix)] = ImageKeyIndex(s3_client, s3_bucket_name, prefix)
+        return index
@@ -1,16 +1,19 @@
 import os
 import threading
 import time
-import logging
 import sys
 
 # Path to the libraries stored in your EFS file system
 sys.path.append("/mnt/access/python")
 
+from deadline import InvocationDeadline
 from image_processor import ImageProcessor
+from log_config import configure_logging
 from task_publisher import TaskPublisher
+from task_receiver import MAX_MESSAGES_PER_RECEIVE
 
-logging.getLogger('botocore').setLevel(logging.DEBUG)
+# Log levels and debug sampling from the DEMO_APP_LOG_* environment variables
+configure_logging()
 
 # "https://sqs.REGION.amazonaws.com/ACCOUNT_ID/DemoApplicationQueueLambdaOriginal"
 DEMO_APP_SQS_URL = os.environ['DEMO_APP_SQS_URL']
@@ -26,47 +29,43 @@ def _get_environment_variable(key, example_value):
 
 
 class SampleDemoApp:
-    def __init__(self):
+    def __init__(self, context=None):
         self.sqs_queue_url = DEMO_APP_SQS_URL
         self.s3_bucket_name = DEMO_APP_BUCKET_NAME
         self.task_publisher = TaskPublisher(self.sqs_queue_url, self.s3_bucket_name)
         self.image_processor = ImageProcessor(self.sqs_queue_url, self.s3_bucket_name)
+        # Both loops run for as long as the invocation has time for another batch
+        self.deadline = InvocationDeadline(context)
+        self.stop_processing = False
+
+    def _has_time_for_batch(self):
+        return not self.stop_processing and self.deadline.has_time_for(MAX_MESSAGES_PER_RECEIVE)
 
     def _publish_task(self):
-        self.stop_processing = False
-        start_time = time.time()  # Start time of the task_publisher thread
         """
         Setup a thread to publish 10 image transform task every 10 seconds
         """
-        while not self.stop_processing:
+        while self._has_time_for_batch():
             task_thread = threading.Thread(target=self.task_publisher.publish_image_transform_task,
                                            name="task-publisher")
             task_thread.start()
             task_thread.join()
             time.sleep(10)
 
-            # Check if 14 minutes have passed
-            elapsed_time = time.time() - start_time
-            if elapsed_time >= 20:
-                self.stop_processing = True  # Set the flag to stop processing
-                break  # Exit the loop to stop processing immediately
-
     def _process_message(self):
-        self.stop_processing = False
-        start_time = time.time()  # Start time of the image_processor thread
         """
         Setup a thread to process message
         """
-        while not self.stop_processing:
-            task_thread = threading.Thread(target=self.image_processor.run, name="task-publisher")
-            task_thread.start()
-            task_thread.join()
-
-            # Check if 14 minutes have passed
-            elapsed_time = time.time() - start_time
-            if elapsed_time >= 20:
-                self.stop_processing = True  # Set the flag to stop processing
-                break  # Exit the loop to stop processing immediately
+        try:
+            while self._has_time_for_batch():
+                task_thread = threading.Thread(target=self.image_processor.run, args=(self.deadline,),
+                                               name="task-publisher")
+                task_thread.start()
+                task_thread.join()
+        finally:
+            self.stop_processing = True  # Set the flag to stop publishing as well
+            # Hand any prefetched and unfinished messages back to the queue for the next invocation
+            self.image_processor.close()
 
     def run(self):
         # Publisher
@@ -79,4 +78,4 @@ class SampleDemoApp:
 
 
 def lambda_handler(event, context):
-    SampleDemoApp().run()
+    SampleDemoApp(context).run()
@@ -1,65 +1,110 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import logging
 import os
-import boto3
-import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_clients import get_client
+from image_key_index import get_image_key_index
+
+logger = logging.getLogger(__name__)
 
 SAMPLE_IMAGES_FOLDER = "input-images/"
+# SendMessageBatch accepts at most 10 entries per call
+SEND_BATCH_SIZE = 10
+DEFAULT_CONCURRENT_BATCHES = 8
+MAX_SEND_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.1
 EXAMPLE_IMAGE_LOCAL_PATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "../..", "resources", "example-image.png"
 )
 
 
+
 class TaskPublisher:
-    def __init__(self, sqs_queue_url, s3_bucket_name):
-        self.s3_client = boto3.client('s3')
-        self.sqs_client = boto3.client('sqs')
+    def __init__(self, sqs_queue_url, s3_bucket_name, concurrent_batches=DEFAULT_CONCURRENT_BATCHES):
+        self.s3_client = get_client('s3')
+        self.sqs_client = get_client('sqs')
         self.sqs_queue_url = sqs_queue_url
         self.s3_bucket_name = s3_bucket_name
+        self.concurrent_batches = concurrent_batches
+        # Container wide, so the listing is reused by later invocations until it expires
+        self.image_index = get_image_key_index(self.s3_client, self.s3_bucket_name, SAMPLE_IMAGES_FOLDER)
 
     def _list_image_on_s3(self):
-        try:
-            print("Listing image in " + self.s3_bucket_name + " under " + SAMPLE_IMAGES_FOLDER)
-            response = self.s3_client.list_objects_v2(Bucket=self.s3_bucket_name, Prefix=SAMPLE_IMAGES_FOLDER)
-            print("response=", response)
-
-            objects_in_s3 = list(map(lambda x: x["Key"], response["Contents"]))
-            print("Listed image in " + self.s3_bucket_name + " under " + SAMPLE_IMAGES_FOLDER + " successfully.")
-            return list(filter(lambda x: x != SAMPLE_IMAGES_FOLDER, objects_in_s3))
-        except Exception:
-            print("Failed to list images in " + self.s3_bucket_name + " under " + SAMPLE_IMAGES_FOLDER)
-            return []
+        # Served from the cached index, S3 is only listed again once it has expired
+        return self.image_index.keys()
 
     def _upload_images_onto_s3(self):
         try:
-            print("Uploading example image onto S3")
+            logger.info("Uploading example image onto S3")
             self.s3_client.upload_file(Filename=EXAMPLE_IMAGE_LOCAL_PATH, Bucket=self.s3_bucket_name,
                                        Key=SAMPLE_IMAGES_FOLDER + "example-image.png")
-            print("Successfully uploaded example image onto S3")
+            logger.info("Successfully uploaded example image onto S3")
         except Exception:
-            print("Failed to upload example image onto S3")
+            logger.error("Failed to upload example image onto S3")
             raise
 
-    def _send_sqs_message(self, message):
-        try:
-            print("sqs_queue_url=", self.sqs_queue_url)
-            print("message=", message)
-            self.sqs_client.send_message(
-                QueueUrl=self.sqs_queue_url,
-                MessageBody=message
-            )
-            print("Sent task to SQS.")
-        except Exception:
-            print("Failed to send message onto sqs queue")
+    def _send_sqs_message_batch(self, messages):
+        """
+        Send up to ten messages with one SendMessageBatch call. Entries that fail on the SQS side are retried on
+        their own with a short backoff, entries SQS rejects as invalid are not. Returns how many messages could
+        not be sent.
+        """
+        entries = [{"Id": str(i), "MessageBody": message} for i, message in enumerate(messages)]
+        rejected = 0
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            try:
+                response = self.sqs_client.send_message_batch(QueueUrl=self.sqs_queue_url, Entries=entries)
+            except Exception as e:
+                logger.error("Failed to send message batch onto sqs queue: %s", e)
+                continue
+
+            retry_ids = set()
+            for failure in response.get("Failed", []):
+                if failure.get("SenderFault"):
+                    rejected += 1
+                    logger.warning("Message rejected by sqs queue: %s", failure.get("Message", failure["Code"]))
+                else:
+                    retry_ids.add(failure["Id"])
+            entries = [entry for entry in entries if entry["Id"] in retry_ids]
+            if not entries:
+                break
+        if entries:
+            logger.error("Failed to send %d messages onto sqs queue after %d attempts", len(entries),
+                         MAX_SEND_ATTEMPTS)
+        return rejected + len(entries)
+
+    def publish_messages(self, messages):
+        """
+        Publish messages in SendMessageBatch calls of ten, with up to concurrent_batches calls in flight, and
+        report the throughput. Returns the number of messages sent.
+        """
+        batches = [messages[start:start + SEND_BATCH_SIZE] for start in range(0, len(messages), SEND_BATCH_SIZE)]
+        if not batches:
+            return 0
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.concurrent_batches, len(batches)),
+                                thread_name_prefix="task-publisher") as executor:
+            failed = sum(executor.map(self._send_sqs_message_batch, batches))
+        elapsed_time = time.perf_counter() - start_time
+
+        sent = len(messages) - failed
+        logger.info("Published %d of %d tasks onto sqs in %.2fs (%.1f tasks/s)", sent, len(messages), elapsed_time,
+                    sent / max(elapsed_time, 1e-9))
+        return sent
 
     def publish_image_transform_task(self, num_of_tasks=10):
         images = self._list_image_on_s3()
         if len(images) == 0:
-            print("No images in bucket.")
-            return
+            logger.warning("No images in bucket.")
+            return 0
 
-        print("Start publishing task onto sqs...")
-        for i in range(num_of_tasks):
-            lucky_number = random.randint(0, len(images) - 1)
-            self._send_sqs_message(str(images[lucky_number]))
+        logger.info("Start publishing task onto sqs...")
+        messages = self.image_index.sample(num_of_tasks)
+        return self.publish_messages(messages)
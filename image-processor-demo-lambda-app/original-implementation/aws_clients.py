@@ -0,0 +1,36 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Enough pooled connections for the largest greenlet pool (32) plus the SQS pollers, the acknowledger and the
+# publisher's concurrent batches, so no caller waits for a free connection
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+MAX_ATTEMPTS = 5
+
+CLIENT_CONFIG_OPTIONS = dict(
+    max_pool_connections=int(os.environ.get("DEMO_APP_MAX_POOL_CONNECTIONS", DEFAULT_MAX_POOL_CONNECTIONS)),
+    tcp_keepalive=True,
+    retries={"mode": "adaptive", "max_attempts": MAX_ATTEMPTS},
+)
+CLIENT_CONFIG = Config(**CLIENT_CONFIG_OPTIONS)
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """
+    Return the process-wide client for service_name, creating it on first use. Clients are created once per cold
+    start and shared by every component, so warm invocations reuse their pooled, already connected sockets.
+    Creating clients is not thread safe in boto3, which is why it happens under a lock; using them is.
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = boto3.client(service_name, config=CLIENT_CONFIG)
+                _clients[service_name] = client
+    return client
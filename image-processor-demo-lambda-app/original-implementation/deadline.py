@@ -0,0 +1,54 @@
+import collections
+import time
+
+from task_receiver import MAX_WAIT_TIME_SECONDS
+
+# Kept free at the end of an invocation to flush acknowledgements and hand unprocessed messages back to the queue
+DEFAULT_SAFETY_MARGIN_SECONDS = 2
+# Number of recent per-message latencies the estimate is taken from
+DEFAULT_LATENCY_HISTORY = 50
+
+
+class InvocationDeadline:
+    """
+    Tracks how much time the current Lambda invocation has left, from context.get_remaining_time_in_millis(), and
+    how long recent messages took from the start of their processing to their acknowledgement. Processing loops ask
+    it whether another batch (or message) still fits before taking it on, so an invocation does as much work as its
+    timeout allows and still ends cleanly instead of being killed mid-batch.
+
+    The estimate is the slowest of the recent latencies, so a single slow image makes the loop more careful for a
+    while rather than being averaged away. Without a context (outside Lambda) there is no deadline.
+    """
+
+    def __init__(self, context=None, safety_margin_seconds=DEFAULT_SAFETY_MARGIN_SECONDS,
+                 latency_history=DEFAULT_LATENCY_HISTORY):
+        self.context = context
+        self.safety_margin_seconds = safety_margin_seconds
+        self.latencies = collections.deque(maxlen=latency_history)
+
+    def remaining_seconds(self):
+        if self.context is None:
+            return float("inf")
+        return self.context.get_remaining_time_in_millis() / 1000
+
+    def record(self, started_at):
+        """
+        Record the latency of a message whose processing started at started_at (a time.monotonic() value).
+        """
+        self.latencies.append(time.monotonic() - started_at)
+
+    def message_latency(self):
+        return max(self.latencies, default=0)
+
+    def has_time_for(self, rounds=1):
+        """
+        Whether rounds more messages processed one after the other still finish before the safety margin.
+        """
+        return self.remaining_seconds() - self.safety_margin_seconds > self.message_latency() * rounds
+
+    def receive_wait_seconds(self, rounds=1):
+        """
+        How long a receive may long poll and still leave time to process what it returns.
+        """
+        spare_seconds = self.remaining_seconds() - self.safety_margin_seconds - self.message_latency() * rounds
+        return int(max(0, min(MAX_WAIT_TIME_SECONDS, spare_seconds)))
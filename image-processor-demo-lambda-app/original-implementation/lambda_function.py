@@ -6,9 +6,14 @@ import sys
 # Path to the libraries stored in your EFS file system
 sys.path.append("/mnt/access/python")
 
+from deadline import InvocationDeadline
 from image_processor import ImageProcessor
+from log_config import configure_logging
 
-# logging.getLogger('botocore').setLevel(logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Log levels and debug sampling from the DEMO_APP_LOG_* environment variables
+configure_logging()
 
 DEMO_APP_SQS_URL = os.environ['DEMO_APP_SQS_URL']
 DEMO_APP_BUCKET_NAME = os.environ['DEMO_APP_BUCKET_NAME']
@@ -18,11 +23,21 @@ def lambda_handler(event, context):
     sqs_queue_url = DEMO_APP_SQS_URL
     s3_bucket_name = DEMO_APP_BUCKET_NAME
     image_processor = ImageProcessor(sqs_queue_url, s3_bucket_name)
-    number_of_extractions = 90  # In each extraction it retrieves 10 messages i.e. for 50 it gets 500 messages
-
-    for i in range(number_of_extractions):
-        image_processor.run()  # Run the image processing logic
-        print("Number of messages processed: ", ((i + 1) * 10))
+    # Batches are taken for as long as the invocation's remaining time fits another one
+    deadline = InvocationDeadline(context)
+
+    number_of_messages = 0
+
+    try:
+        while True:
+            extracted = image_processor.run(deadline)  # Run the image processing logic
+            if not extracted:
+                # Either the queue is drained or there is no time left for another batch
+                break
+            number_of_messages += extracted
+            logger.info("Number of messages processed: %d", number_of_messages)
+    finally:
+        image_processor.close()
 
     return {
         'statusCode': 200,
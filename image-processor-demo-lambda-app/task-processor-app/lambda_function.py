@@ -1,8 +1,15 @@
 import json
+import logging
 import os
 
+from log_config import configure_logging
 from task_publisher import TaskPublisher
 
+logger = logging.getLogger(__name__)
+
+# Log levels and debug sampling from the DEMO_APP_LOG_* environment variables
+configure_logging()
+
 DEMO_APP_SQS_URL = os.environ['DEMO_APP_SQS_URL']
 DEMO_APP_BUCKET_NAME = os.environ['DEMO_APP_BUCKET_NAME']
 
@@ -14,9 +21,9 @@ def lambda_handler(event, context):
     # Set number of tasks. If number_of_tasks=10 it will create 100 sqs messages
     number_of_tasks = 10
 
-    for i in range(number_of_tasks):
-        task_publisher.publish_image_transform_task()
-        print("Total Number of tasks created: ", ((i + 1) * 10))
+    # One call lists the images once and sends all tasks in concurrent batches of ten
+    number_of_tasks_created = task_publisher.publish_image_transform_task(number_of_tasks * 10)
+    logger.info("Total Number of tasks created: %d", number_of_tasks_created)
 
     return {
         'statusCode': 200,
@@ -0,0 +1,41 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+# The Lambda variants import their modules flat (e.g. `from image_editor import ImageEditor`), exactly as they are
+# laid out inside the deployment package, so the tests do the same against the original implementation and the
+# task publisher app.
+APP_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(APP_ROOT, "original-implementation"))
+sys.path.insert(0, os.path.join(APP_ROOT, "task-processor-app"))
+
+
+@pytest.fixture
+def import_implementation():
+    """
+    Import modules of another implementation directory, e.g. import_implementation("asyncio-implementation",
+    "image_processor"). Its modules share their names with the original implementation's, so those are set aside
+    for the test and put back, along with sys.path, afterwards.
+    """
+    saved_path = list(sys.path)
+    saved_modules = {}
+
+    def import_modules(directory, *names):
+        path = os.path.join(APP_ROOT, directory)
+        for file_name in os.listdir(path):
+            name, extension = os.path.splitext(file_name)
+            if extension == ".py" and name not in saved_modules:
+                saved_modules[name] = sys.modules.pop(name, None)
+        sys.path.insert(0, path)
+        modules = [importlib.import_module(name) for name in names]
+        return modules[0] if len(modules) == 1 else modules
+
+    yield import_modules
+    sys.path[:] = saved_path
+    for name, module in saved_modules.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
@@ -0,0 +1,23 @@
+import threading
+
+import boto3
+
+import aws_clients
+
+
+def test_clients_are_created_once_and_shared(monkeypatch):
+    created = []
+    monkeypatch.setattr(aws_clients, "_clients", {})
+    monkeypatch.setattr(boto3, "client", lambda service_name, config: created.append((service_name, config)) or
+                        object())
+
+    threads = [threading.Thread(target=aws_clients.get_client, args=("s3",)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert aws_clients.get_client("s3") is aws_clients.get_client("s3")
+    assert aws_clients.get_client("sqs") is not aws_clients.get_client("s3")
+    assert created == [("s3", aws_clients.CLIENT_CONFIG), ("sqs", aws_clients.CLIENT_CONFIG)]
+    assert aws_clients.CLIENT_CONFIG.retries["mode"] == "adaptive"
@@ -0,0 +1,178 @@
+import asyncio
+import contextlib
+import os
+import sys
+
+import pytest
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_aws import FakeS3, FakeSQS  # noqa: E402
+
+
+class AsyncBody:
+    def __init__(self, data):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self):
+        return self.data
+
+
+class AsyncClient:
+    """
+    An aiobotocore-like client: every operation of the wrapped stand-in is a coroutine, and bodies are streams.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, operation):
+        method = getattr(self.client, operation)
+
+        async def call(**kwargs):
+            response = method(**kwargs)
+            if isinstance(response, dict) and "Body" in response:
+                response = dict(response, Body=AsyncBody(response["Body"].read()))
+            return response
+
+        return call
+
+
+class FakeSession:
+    def __init__(self, clients):
+        self.clients = clients
+        self.created = []
+        self.closed = []
+
+    @contextlib.asynccontextmanager
+    async def _client(self, service_name):
+        self.created.append(service_name)
+        try:
+            yield AsyncClient(self.clients[service_name])
+        finally:
+            self.closed.append(service_name)
+
+    def create_client(self, service_name, config=None):
+        return self._client(service_name)
+
+
+@pytest.fixture
+def fakes():
+    sqs = FakeSQS(max_wait_seconds=0)
+    sqs.send(["input-images/a.png"])
+    return {"s3": FakeS3(), "sqs": sqs}
+
+
+@pytest.fixture(params=["aiobotocore", "thread-pool"])
+def async_modules(request, import_implementation, fakes, monkeypatch):
+    aws_clients_async, s3_transfer_async, s3_transfer = import_implementation(
+        "asyncio-implementation", "aws_clients_async", "s3_transfer_async", "s3_transfer")
+    monkeypatch.setattr(aws_clients_async, "get_client", lambda service_name: fakes[service_name])
+    if request.param == "aiobotocore":
+        session = FakeSession(fakes)
+        monkeypatch.setattr(aws_clients_async, "get_session", lambda: session)
+        monkeypatch.setattr(aws_clients_async, "AioConfig", lambda **options: options)
+    else:
+        monkeypatch.setattr(aws_clients_async, "get_session", None)
+    return aws_clients_async, s3_transfer_async, s3_transfer
+
+
+def test_clients_await_s3_and_sqs_calls(async_modules, fakes):
+    aws_clients_async = async_modules[0]
+    clients = aws_clients_async.AsyncAwsClients()
+
+    async def exercise():
+        async with clients:
+            await clients.put_object(Bucket="bucket", Key="input-images/a.png", Body=b"image")
+            response, data = await clients.get_object(Bucket="bucket", Key="input-images/a.png")
+            head = await clients.head_object(Bucket="bucket", Key="input-images/a.png")
+            listing = await clients.s3("list_objects_v2", Bucket="bucket", Prefix="input-images/")
+            received = await clients.receive_message(QueueUrl="queue-url", MaxNumberOfMessages=10)
+            assert clients.opened
+        return response, data, head, listing, received
+
+    response, data, head, listing, received = asyncio.run(exercise())
+
+    assert data == b"image"
+    assert response["ETag"] == head["ETag"]
+    assert [item["Key"] for item in listing["Contents"]] == ["input-images/a.png"]
+    assert [message["Body"] for message in received["Messages"]] == ["input-images/a.png"]
+    assert not clients.opened and clients.executor is None and clients.exit_stack is None
+
+
+def test_container_loop_keeps_the_default_clients_open_between_runs(async_modules):
+    aws_clients_async = async_modules[0]
+    clients = aws_clients_async.default_aws_clients()
+
+    async def invocation():
+        await clients.open()
+        await clients.put_object(Bucket="bucket", Key="output.png", Body=b"x")
+        return asyncio.get_running_loop(), clients.s3_client, clients.executor
+
+    first = aws_clients_async.run_on_container_loop(invocation())
+    second = aws_clients_async.run_on_container_loop(invocation())
+
+    assert first == second
+    assert aws_clients_async.default_aws_clients() is clients
+    if aws_clients_async.get_session is not None:
+        assert aws_clients_async.get_session().created == ["s3", "sqs"]
+    aws_clients_async.run_on_container_loop(clients.close())
+    first[0].close()
+
+
+def test_async_transfers_switch_to_ranges_and_parts_by_size(async_modules, fakes):
+    aws_clients_async, s3_transfer_async, s3_transfer = async_modules
+    data = bytes(range(256)) * 4
+    fakes["s3"].put_object(Bucket="bucket", Key="large.png", Body=data)
+    fakes["s3"].put_object(Bucket="bucket", Key="small.png", Body=b"x" * 7)
+    stats = s3_transfer.TransferStats()
+
+    async def exercise():
+        async with aws_clients_async.AsyncAwsClients() as clients:
+            transfer = s3_transfer_async.AsyncS3Transfer(clients, multipart_threshold=100, part_size=100,
+                                                         max_concurrency=3, stats=stats)
+            small = await transfer.download("bucket", "small.png")
+            large = await transfer.download("bucket", "large.png")
+            await transfer.upload("bucket", "copy.png", large, ContentType="image/png")
+            await transfer.upload("bucket", "tiny.png", small)
+            return small, large
+
+    small, large = asyncio.run(exercise())
+
+    assert small == b"x" * 7 and large == data
+    assert fakes["s3"].objects["copy.png"] == data
+    assert fakes["s3"].objects["tiny.png"] == small
+    assert fakes["s3"].calls["get_object"] == 1 + 11
+    assert fakes["s3"].calls["upload_part"] == 11
+    assert fakes["s3"].calls["put_object"] == 3
+
+
+def test_failed_async_multipart_uploads_are_aborted(async_modules, fakes):
+    aws_clients_async, s3_transfer_async, s3_transfer = async_modules
+    upload_part = fakes["s3"].upload_part
+
+    def failing_upload_part(PartNumber, **kwargs):
+        if PartNumber == 2:
+            raise RuntimeError("part failed")
+        return upload_part(PartNumber=PartNumber, **kwargs)
+
+    fakes["s3"].upload_part = failing_upload_part
+
+    async def exercise():
+        async with aws_clients_async.AsyncAwsClients() as clients:
+            transfer = s3_transfer_async.AsyncS3Transfer(clients, multipart_threshold=10, part_size=10,
+                                                         stats=s3_transfer.TransferStats())
+            await transfer.upload("bucket", "broken.png", b"y" * 35)
+
+    with pytest.raises(RuntimeError, match="part failed"):
+        asyncio.run(exercise())
+    assert fakes["s3"].calls["abort_multipart_upload"] == 1
+    assert "broken.png" not in fakes["s3"].objects
+    assert fakes["s3"].uploads == {}
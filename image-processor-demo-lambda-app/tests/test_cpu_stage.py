@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+
+ASYNCIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "asyncio-implementation")
+
+# Runs in a process of its own: the asyncio implementation's modules share their names with the original ones, and
+# the resource tracker reports on the stderr of the process that owns the shared memory
+CPU_STAGE_SCRIPT = """
+import asyncio
+import json
+from io import BytesIO
+
+import numpy as np
+
+from cpu_stage import CpuStage
+from image_editor import ImageEditor
+
+image = np.random.default_rng(3).integers(0, 256, size=(40, 60, 3), dtype=np.uint8)
+encoded = BytesIO()
+ImageEditor.apply(image, [(ImageEditor.brighten, encoded)])
+transforms = [ImageEditor.grayscale, ImageEditor.brighten]
+
+
+def expected(source):
+    buffers = [BytesIO() for _ in transforms]
+    ImageEditor.apply(source, list(zip(transforms, buffers)))
+    return [buffer.getvalue() for buffer in buffers]
+
+
+async def run(stage):
+    results = []
+    for source in (image, encoded.getvalue()) * 3:
+        results.append(await stage.run(source, transforms) == expected(
+            source if isinstance(source, np.ndarray) else BytesIO(source)))
+    # The decoded source only comes back when it fits the budget, and only if it was decoded in the worker
+    outputs, decoded = await stage.run_keeping_decoded(encoded.getvalue(), transforms, image.nbytes)
+    results.append(outputs == expected(BytesIO(encoded.getvalue())) and
+                   bool((decoded == ImageEditor.decode(BytesIO(encoded.getvalue()))).all()))
+    results.append((await stage.run_keeping_decoded(encoded.getvalue(), transforms, image.nbytes - 1))[1] is None)
+    results.append((await stage.run_keeping_decoded(image, transforms, image.nbytes))[1] is None)
+    return results
+
+
+report = {}
+for name, workers in (("processes", 2), ("threads", 1)):
+    stage = CpuStage(max_workers=workers)
+    report[name] = {"uses_processes": stage.uses_processes, "matches": asyncio.run(run(stage))}
+    stage.shutdown()
+print(json.dumps(report))
+"""
+
+
+def test_cpu_stage_outputs_match_the_editor_in_process_and_thread_mode():
+    result = subprocess.run([sys.executable, "-c", CPU_STAGE_SCRIPT], cwd=ASYNCIO_DIR, capture_output=True,
+                            text=True, timeout=120)
+
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout)
+    assert report["processes"]["uses_processes"]
+    assert not report["threads"]["uses_processes"]
+    assert all(report["processes"]["matches"]) and all(report["threads"]["matches"])
+    # Shared memory blocks are unregistered from the resource tracker exactly once
+    assert "Traceback" not in result.stderr and "leaked" not in result.stderr
@@ -0,0 +1,48 @@
+import pytest
+
+import deadline
+from deadline import InvocationDeadline
+
+
+class FakeContext:
+    def __init__(self, remaining_millis):
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(deadline.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_without_context_there_is_no_deadline():
+    invocation_deadline = InvocationDeadline()
+
+    assert invocation_deadline.has_time_for(10 ** 6)
+    assert invocation_deadline.receive_wait_seconds() == 20
+
+
+def test_batches_stop_fitting_as_the_remaining_time_runs_out(clock):
+    context = FakeContext(30000)
+    invocation_deadline = InvocationDeadline(context, safety_margin_seconds=2)
+    for latency in (0.5, 2.5, 1.0):
+        started_at = clock[0]
+        clock[0] += latency
+        invocation_deadline.record(started_at)
+
+    # The slowest recent message sets the estimate: ten messages in a row need 25 of the 28 spare seconds
+    assert invocation_deadline.message_latency() == 2.5
+    assert invocation_deadline.has_time_for(10)
+    assert invocation_deadline.receive_wait_seconds(10) == 3
+
+    context.remaining_millis = 20000
+    assert not invocation_deadline.has_time_for(10)
+    assert invocation_deadline.has_time_for(7)
+    assert invocation_deadline.receive_wait_seconds(10) == 0
+
+    context.remaining_millis = 4000
+    assert not invocation_deadline.has_time_for()
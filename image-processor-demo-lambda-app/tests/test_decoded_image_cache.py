@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from decoded_image_cache import DEFAULT_MAX_BYTES, MiB, DecodedImageCache, default_max_bytes
+
+
+def image(size_bytes):
+    return np.zeros(size_bytes, dtype=np.uint8)
+
+
+def test_entries_are_keyed_by_etag():
+    decoded_image_cache = DecodedImageCache(max_bytes=100)
+    decoded_image_cache.put("bucket", "a.png", '"1"', image(10))
+
+    assert decoded_image_cache.get("bucket", "a.png", '"1"') is not None
+    assert decoded_image_cache.get("bucket", "a.png", '"2"') is None
+    assert (decoded_image_cache.hits, decoded_image_cache.misses) == (1, 1)
+
+
+def test_least_recently_used_images_are_evicted_to_stay_within_the_byte_budget():
+    decoded_image_cache = DecodedImageCache(max_bytes=100)
+    decoded_image_cache.put("bucket", "a.png", '"1"', image(40))
+    decoded_image_cache.put("bucket", "b.png", '"1"', image(40))
+    decoded_image_cache.get("bucket", "a.png", '"1"')
+
+    decoded_image_cache.put("bucket", "c.png", '"1"', image(40))
+
+    assert decoded_image_cache.get("bucket", "a.png", '"1"') is not None
+    assert decoded_image_cache.get("bucket", "b.png", '"1"') is None
+    assert decoded_image_cache.size_bytes == 80
+    assert decoded_image_cache.evictions == 1
+
+
+def test_images_larger_than_the_budget_are_not_cached():
+    decoded_image_cache = DecodedImageCache(max_bytes=100)
+    decoded_image_cache.put("bucket", "a.png", '"1"', image(101))
+
+    assert decoded_image_cache.get("bucket", "a.png", '"1"') is None
+    assert decoded_image_cache.size_bytes == 0
+
+
+def test_cached_images_are_read_only():
+    decoded_image_cache = DecodedImageCache(max_bytes=100)
+    decoded_image_cache.put("bucket", "a.png", '"1"', image(10))
+
+    with pytest.raises(ValueError):
+        decoded_image_cache.get("bucket", "a.png", '"1"')[0] = 1
+
+
+def test_default_budget_is_a_share_of_the_function_memory(monkeypatch):
+    monkeypatch.delenv("DEMO_APP_DECODED_IMAGE_CACHE_BYTES", raising=False)
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", raising=False)
+    assert default_max_bytes() == DEFAULT_MAX_BYTES
+
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "128")
+    assert default_max_bytes() == 32 * MiB
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "3008")
+    assert default_max_bytes() == 752 * MiB
+
+    monkeypatch.setenv("DEMO_APP_DECODED_IMAGE_CACHE_BYTES", "0")
+    assert default_max_bytes() == 0
@@ -0,0 +1,68 @@
+import imageio.v2 as imageio
+import numpy as np
+import pytest
+from skimage import exposure, img_as_ubyte
+from skimage.color import rgb2gray, rgba2rgb
+
+from image_editor import ImageEditor
+
+
+@pytest.fixture
+def rgba_image():
+    return np.random.default_rng(0).integers(0, 256, size=(37, 53, 4), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('gamma', [0.1, 0.5, 1, 2.2])
+def test_brighten_matches_skimage(rgba_image, gamma):
+    expected = img_as_ubyte(exposure.adjust_gamma(rgba_image, gamma))
+    brightened = ImageEditor.brighten(rgba_image, gamma)
+
+    assert brightened.dtype == np.uint8
+    np.testing.assert_array_equal(brightened, expected)
+
+
+def test_brighten_falls_back_for_float_images(rgba_image):
+    float_image = rgba_image / 255.0
+
+    np.testing.assert_array_equal(ImageEditor.brighten(float_image),
+                                  img_as_ubyte(exposure.adjust_gamma(float_image, 0.1)))
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+@pytest.mark.parametrize('channels', [3, 4])
+def test_grayscale_within_one_level_of_skimage(dtype, channels):
+    image = np.random.default_rng(1).integers(0, np.iinfo(dtype).max + 1, size=(61, 47, channels), dtype=dtype)
+    rgb_image = rgba2rgb(image) if channels == 4 else image
+    expected = img_as_ubyte(rgb2gray(rgb_image))
+
+    grey = ImageEditor.grayscale(image)
+
+    assert grey.dtype == np.uint8
+    assert grey.shape == expected.shape
+    assert np.abs(grey.astype(np.int16) - expected).max() <= 1
+
+
+def test_grayscale_extremes_are_exact():
+    image = np.zeros((2, 2, 4), dtype=np.uint8)
+    image[0, 0] = (255, 255, 255, 255)  # opaque white
+    image[0, 1] = (0, 0, 0, 255)  # opaque black
+    image[1, 0] = (0, 0, 0, 0)  # fully transparent, blends to the white background
+
+    np.testing.assert_array_equal(ImageEditor.grayscale(image), [[255, 0], [255, 255]])
+
+
+def test_tiled_outputs_match_whole_image_outputs(tmp_path):
+    # Smooth gradients with some noise, so every PNG filter type gets picked for some rows
+    rng = np.random.default_rng(2)
+    image = (np.add.outer(np.arange(90), np.arange(70))[..., np.newaxis] + rng.integers(0, 8, size=(90, 70, 4)))
+    image = image.astype(np.uint8)
+    whole = [str(tmp_path / "whole-grey.png"), str(tmp_path / "whole-bright.png")]
+    tiled = [str(tmp_path / "tiled-grey.png"), str(tmp_path / "tiled-bright.png")]
+
+    ImageEditor.apply(image, list(zip([ImageEditor.grayscale, ImageEditor.brighten], whole)))
+    # A few rows per strip, and a strip size that does not divide the height
+    ImageEditor.apply_tiled(image, list(zip([ImageEditor.grayscale, ImageEditor.brighten], tiled)),
+                            strip_bytes=image[0].nbytes * 7)
+
+    for whole_path, tiled_path in zip(whole, tiled):
+        np.testing.assert_array_equal(imageio.imread(tiled_path), imageio.imread(whole_path))
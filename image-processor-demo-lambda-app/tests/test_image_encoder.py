@@ -0,0 +1,55 @@
+from io import BytesIO
+
+import imageio.v2 as imageio
+import numpy as np
+import pytest
+
+from image_editor import ImageEditor
+from image_encoder import ImageEncoder
+
+
+@pytest.fixture
+def rgba_image():
+    return np.random.default_rng(4).integers(0, 256, size=(29, 31, 4), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('image_format, level', [('png', 6), ('png', 1), ('webp', 4), ('webp', 0)])
+def test_lossless_formats_round_trip(rgba_image, image_format, level):
+    encoder = ImageEncoder(image_format, level)
+
+    np.testing.assert_array_equal(imageio.imread(encoder.encode_to_bytes(rgba_image)), rgba_image)
+
+
+def test_jpeg_composites_transparency_over_white():
+    image = np.zeros((16, 16, 4), dtype=np.uint8)
+
+    decoded = imageio.imread(ImageEncoder('jpeg').encode_to_bytes(image))
+
+    assert decoded.shape == (16, 16, 3)
+    assert decoded.min() >= 250
+
+
+def test_params_name_format_and_level():
+    encoder = ImageEncoder('webp', 2)
+
+    assert (encoder.params, encoder.extension, encoder.content_type) == ('webp-2', '.webp', 'image/webp')
+    assert ImageEncoder('png').params == 'png-6'
+    with pytest.raises(ValueError):
+        ImageEncoder('gif')
+
+
+@pytest.mark.parametrize('image_format, level', [('png', -1), ('png', 10), ('webp', 7), ('jpeg', 0), ('jpeg', 96)])
+def test_levels_outside_the_range_of_the_format_are_rejected(image_format, level):
+    with pytest.raises(ValueError):
+        ImageEncoder(image_format, level)
+    with pytest.raises(ValueError):
+        ImageEncoder(image_format, str(level))
+
+
+def test_editor_writes_the_selected_format(rgba_image):
+    target = BytesIO()
+
+    ImageEditor.brighten_image(rgba_image, target, ImageEncoder('webp'))
+
+    assert target.getvalue()[8:12] == b'WEBP'
+    np.testing.assert_array_equal(imageio.imread(target.getvalue()), ImageEditor.brighten(rgba_image))
@@ -0,0 +1,76 @@
+import pytest
+
+import image_key_index
+from image_key_index import ImageKeyIndex
+
+PREFIX = "input-images/"
+
+
+class FakeS3Client:
+    def __init__(self, keys, page_size=1000):
+        self.keys = keys
+        self.page_size = page_size
+        self.list_calls = 0
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken="0"):
+        self.list_calls += 1
+        start = int(ContinuationToken)
+        page = self.keys[start:start + self.page_size]
+        response = {"Contents": [{"Key": key, "ETag": '"' + key + '"'} for key in page],
+                    "IsTruncated": start + self.page_size < len(self.keys)}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + self.page_size)
+        return response
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(image_key_index.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_keys_page_through_the_whole_listing():
+    keys = [PREFIX] + [PREFIX + str(i) + ".png" for i in range(2500)]
+    s3_client = FakeS3Client(keys)
+
+    assert ImageKeyIndex(s3_client, "bucket", PREFIX).keys() == keys[1:]
+    assert s3_client.list_calls == 3
+
+
+def test_listing_is_cached_until_it_expires(clock):
+    s3_client = FakeS3Client([PREFIX + "a.png"])
+    index = ImageKeyIndex(s3_client, "bucket", PREFIX, ttl_seconds=60)
+
+    index.keys()
+    clock[0] += 59
+    index.sample(100)
+    assert s3_client.list_calls == 1
+
+    s3_client.keys = [PREFIX + "a.png", PREFIX + "b.png"]
+    clock[0] += 1
+    assert index.keys() == [PREFIX + "a.png", PREFIX + "b.png"]
+    assert s3_client.list_calls == 2
+
+
+def test_invalidate_lists_again_on_next_lookup():
+    s3_client = FakeS3Client([])
+    index = ImageKeyIndex(s3_client, "bucket", PREFIX)
+    assert index.keys() == []
+
+    s3_client.keys = [PREFIX + "example-image.png"]
+    index.invalidate()
+    assert index.sample(3) == [PREFIX + "example-image.png"] * 3
+
+
+def test_failed_refresh_keeps_serving_previous_listing(clock):
+    s3_client = FakeS3Client([PREFIX + "a.png"])
+    index = ImageKeyIndex(s3_client, "bucket", PREFIX, ttl_seconds=60)
+    index.keys()
+
+    def fail(**kwargs):
+        raise RuntimeError("throttled")
+
+    s3_client.list_objects_v2 = fail
+    clock[0] += 60
+    assert index.keys() == [PREFIX + "a.png"]
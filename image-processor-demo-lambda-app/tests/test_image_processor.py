@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_aws import FakeS3, FakeSQS  # noqa: E402
+
+QUEUE_URL = "queue-url"
+BUCKET_NAME = "bucket"
+IMAGE_KEY = "input-images/example.png"
+
+
+class ExpiredContext:
+    def get_remaining_time_in_millis(self):
+        return 0
+
+
+def png():
+    image = np.random.default_rng(1).integers(0, 256, size=(24, 32, 3), dtype=np.uint8)
+    target = BytesIO()
+    Image.fromarray(image).save(target, format="PNG")
+    return target.getvalue()
+
+
+@pytest.fixture
+def fakes():
+    s3 = FakeS3()
+    s3.objects[IMAGE_KEY] = png()
+    return {"s3": s3, "sqs": FakeSQS(max_wait_seconds=0)}
+
+
+# The synchronous implementations; the asyncio pipeline has tests of its own
+@pytest.fixture(params=["original-implementation", "greenlet-implementation", "legacy-single-function"])
+def modules(request, import_implementation, fakes, monkeypatch):
+    image_processor, deadline, result_cache = import_implementation(
+        request.param, "image_processor", "deadline", "result_cache")
+    monkeypatch.setattr(image_processor, "get_client", lambda service_name: fakes[service_name])
+    return image_processor, deadline, result_cache
+
+
+@pytest.fixture
+def processor(modules):
+    processor = modules[0].ImageProcessor(QUEUE_URL, BUCKET_NAME)
+    processor.metrics.emit = lambda line: None
+    yield processor
+    processor.close()
+
+
+def receive(fakes):
+    fakes["sqs"].send([IMAGE_KEY])
+    return fakes["sqs"].receive_message(QueueUrl=QUEUE_URL, MaxNumberOfMessages=1)["Messages"][0]
+
+
+def process(processor, message, deadline):
+    """
+    Process one received message the way the implementation's run() does, and settle it with SQS.
+    """
+    if hasattr(processor, "concurrent_processing"):
+        processor.concurrent_processing([message], processor.bw_image_processor, processor.brighten_image_processor,
+                                        deadline)
+    else:
+        processor._process_message(message, deadline)
+    processor.task_acknowledger.close()
+
+
+def s3_calls(fakes):
+    return {operation: fakes["s3"].calls.get(operation, 0) for operation in ("head_object", "get_object",
+                                                                            "put_object")}
+
+
+def handed_back(fakes):
+    now = time.monotonic()
+    return [body for body, visible_at in fakes["sqs"].messages.values() if visible_at <= now]
+
+
+def test_a_new_image_is_downloaded_transformed_uploaded_and_acknowledged(modules, processor, fakes):
+    process(processor, receive(fakes), modules[1].InvocationDeadline())
+
+    # The source's ETag and the first output, which is missing, are looked up before the download and the uploads
+    assert s3_calls(fakes) == {"head_object": 2, "get_object": 1, "put_object": 2}
+    outputs = sorted(key for key in fakes["s3"].objects if key != IMAGE_KEY)
+    assert len(outputs) == 2 and "-bright-" in outputs[0] and "-monochrome-" in outputs[1]
+    assert fakes["sqs"].deleted == 1 and fakes["sqs"].messages == {}
+    assert all(processor.result_cache.contains(output) for output in outputs)
+
+
+def test_existing_outputs_found_with_head_requests_are_not_produced_again(modules, processor, fakes):
+    process(processor, receive(fakes), modules[1].InvocationDeadline())
+    # As in a new container, which only S3 can tell that the outputs exist
+    processor.result_cache = modules[2].ResultCache()
+    before = s3_calls(fakes)
+
+    process(processor, receive(fakes), modules[1].InvocationDeadline())
+
+    after = s3_calls(fakes)
+    assert after["head_object"] - before["head_object"] == 3
+    assert (after["get_object"], after["put_object"]) == (before["get_object"], before["put_object"])
+    assert fakes["sqs"].deleted == 2 and fakes["sqs"].messages == {}
+    assert processor.result_cache.hits == 1
+
+
+def test_outputs_known_to_the_result_cache_are_skipped_without_looking_them_up(modules, processor, fakes):
+    process(processor, receive(fakes), modules[1].InvocationDeadline())
+    before = s3_calls(fakes)
+
+    process(processor, receive(fakes), modules[1].InvocationDeadline())
+
+    after = s3_calls(fakes)
+    # Only the source's ETag, which the output keys are derived from
+    assert after["head_object"] - before["head_object"] == 1
+    assert (after["get_object"], after["put_object"]) == (before["get_object"], before["put_object"])
+    assert fakes["sqs"].deleted == 2 and fakes["sqs"].messages == {}
+
+
+def test_a_failed_upload_hands_the_message_back_instead_of_acknowledging_it(modules, processor, fakes):
+    def put_object(**kwargs):
+        raise RuntimeError("SlowDown")
+
+    fakes["s3"].put_object = put_object
+
+    process(processor, receive(fakes), modules[1].InvocationDeadline())
+
+    assert fakes["sqs"].deleted == 0
+    assert handed_back(fakes) == [IMAGE_KEY]
+    assert not any(processor.result_cache.known_outputs)
+
+
+def test_a_missing_source_hands_the_message_back(modules, processor, fakes):
+    del fakes["s3"].objects[IMAGE_KEY]
+
+    process(processor, receive(fakes), modules[1].InvocationDeadline())
+
+    assert s3_calls(fakes) == {"head_object": 1, "get_object": 0, "put_object": 0}
+    assert fakes["sqs"].deleted == 0
+    assert handed_back(fakes) == [IMAGE_KEY]
+
+
+def test_a_message_without_time_left_is_handed_back_untouched(modules, processor, fakes):
+    process(processor, receive(fakes), modules[1].InvocationDeadline(ExpiredContext()))
+
+    assert s3_calls(fakes) == {"head_object": 0, "get_object": 0, "put_object": 0}
+    assert fakes["sqs"].deleted == 0
+    assert handed_back(fakes) == [IMAGE_KEY]
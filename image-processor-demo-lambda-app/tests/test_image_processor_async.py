@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_aws import FakeS3, FakeSQS  # noqa: E402
+
+QUEUE_URL = "queue-url"
+BUCKET_NAME = "bucket"
+
+
+class RecordingSQS(FakeSQS):
+    """
+    Also counts the deletes of each message body, so a message acknowledged twice is noticed.
+    """
+
+    def __init__(self):
+        super().__init__(max_wait_seconds=0)
+        self.deleted_bodies = Counter()
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self.condition:
+            for entry in Entries:
+                message = self.messages.get(self.receipt_handles.get(entry["ReceiptHandle"]))
+                if message is not None:
+                    self.deleted_bodies[message[0]] += 1
+        return super().delete_message_batch(QueueUrl, Entries)
+
+
+class ExpiringContext:
+    """
+    A Lambda context with plenty of time left for the first calls, and none after that.
+    """
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_remaining_time_in_millis(self):
+        self.calls -= 1
+        return 15 * 60 * 1000 if self.calls >= 0 else 0
+
+
+def png(seed):
+    image = np.random.default_rng(seed).integers(0, 256, size=(24, 32, 3), dtype=np.uint8)
+    target = BytesIO()
+    Image.fromarray(image).save(target, format="PNG")
+    return target.getvalue()
+
+
+@pytest.fixture
+def fakes():
+    return {"s3": FakeS3(), "sqs": RecordingSQS()}
+
+
+@pytest.fixture
+def asyncio_modules(import_implementation, fakes, monkeypatch):
+    # Freshly imported, so the container-wide caches, clients and loop start out empty
+    image_processor, aws_clients_async, deadline, cpu_stage = import_implementation(
+        "asyncio-implementation", "image_processor", "aws_clients_async", "deadline", "cpu_stage")
+    monkeypatch.setattr(aws_clients_async, "get_client", lambda service_name: fakes[service_name])
+    monkeypatch.setattr(aws_clients_async, "get_session", None)
+    monkeypatch.setattr(image_processor, "get_client", lambda service_name: fakes[service_name])
+    yield image_processor, deadline
+    aws_clients_async.run_on_container_loop(aws_clients_async.default_aws_clients().close())
+    aws_clients_async.run_on_container_loop(asyncio.sleep(0))
+    aws_clients_async._container_loop.close()
+    cpu_stage.default_cpu_stage().shutdown()
+
+
+def queue_images(fakes, count):
+    keys = ["input-images/img%02d.png" % i for i in range(count)]
+    for seed, key in enumerate(keys):
+        fakes["s3"].objects[key] = png(seed)
+    fakes["sqs"].send(keys)
+    return keys
+
+
+def outputs_of(fakes, key):
+    image_name = key.split("/")[-1].split(".")[0]
+    return sorted(output for output in fakes["s3"].objects if output.startswith("bw-images/" + image_name + "-"))
+
+
+def pending_tasks(image_processor):
+    async def count_tasks():
+        return len(asyncio.all_tasks() - {asyncio.current_task()})
+
+    return image_processor.run_on_container_loop(count_tasks())
+
+
+def test_every_message_is_transformed_uploaded_and_acknowledged_once(asyncio_modules, fakes):
+    image_processor, deadline = asyncio_modules
+    keys = queue_images(fakes, 25)
+    processor = image_processor.ImageProcessor(QUEUE_URL, BUCKET_NAME)
+    emitted = []
+    processor.metrics.emit = emitted.append
+
+    try:
+        received = processor.run(deadline=deadline.InvocationDeadline())
+    finally:
+        processor.close()
+
+    assert received == len(keys)
+    for key in keys:
+        outputs = outputs_of(fakes, key)
+        assert len(outputs) == 2 and "-bright-" in outputs[0] and "-monochrome-" in outputs[1]
+        for output in outputs:
+            assert Image.open(BytesIO(fakes["s3"].objects[output])).size == (32, 24)
+    # Every output was put once, and nothing besides the sources and the outputs
+    assert fakes["s3"].calls["put_object"] == 2 * len(keys)
+    assert len(fakes["s3"].objects) == 3 * len(keys)
+    assert fakes["sqs"].deleted_bodies == Counter(keys)
+    assert fakes["sqs"].messages == {}
+    assert json.loads(emitted[-1])["MessagesProcessed"] == len(keys)
+
+
+def test_stages_drain_when_the_deadline_is_reached(asyncio_modules, fakes):
+    image_processor, deadline = asyncio_modules
+    keys = queue_images(fakes, 30)
+    processor = image_processor.ImageProcessor(QUEUE_URL, BUCKET_NAME)
+    processor.metrics.emit = lambda line: None
+    invocation_deadline = deadline.InvocationDeadline(ExpiringContext(calls=12))
+
+    try:
+        processor.run(deadline=invocation_deadline)
+        # Nothing is left running on the container's loop once the run has returned
+        leftover = pending_tasks(image_processor)
+    finally:
+        processor.close()
+
+    assert leftover == 0
+    deleted = fakes["sqs"].deleted_bodies
+    remaining = Counter(body for body, _ in fakes["sqs"].messages.values())
+    assert deleted and remaining, "the deadline was reached after some messages were taken on"
+    # Each message was either processed and acknowledged once, or handed back to the queue untouched
+    assert deleted + remaining == Counter(keys)
+    assert all(count == 1 for count in deleted.values())
+    for key in keys:
+        assert len(outputs_of(fakes, key)) == (2 if key in deleted else 0)
+    # Handed back messages are visible again right away instead of after their visibility timeout
+    now = time.monotonic()
+    assert all(visible_at <= now for _, visible_at in fakes["sqs"].messages.values())
+
+
+def test_receive_stage_gives_up_when_every_receive_fails(asyncio_modules, fakes, monkeypatch):
+    image_processor, deadline = asyncio_modules
+    monkeypatch.setattr(image_processor, "RECEIVE_RETRY_DELAY_SECONDS", 0.001)
+    receives = []
+
+    def receive_message(**kwargs):
+        receives.append(kwargs)
+        raise RuntimeError("AccessDenied")
+
+    fakes["sqs"].receive_message = receive_message
+    processor = image_processor.ImageProcessor(QUEUE_URL, BUCKET_NAME)
+    processor.metrics.emit = lambda line: None
+
+    try:
+        # Without a deadline or a number of receives, only the cap on failed attempts ends the run
+        received = processor.run(deadline=deadline.InvocationDeadline())
+    finally:
+        processor.close()
+
+    assert received == 0
+    assert len(receives) == image_processor.RECEIVE_CONCURRENCY * image_processor.MAX_RECEIVE_ATTEMPTS
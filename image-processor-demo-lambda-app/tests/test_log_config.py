@@ -0,0 +1,61 @@
+import logging
+
+import pytest
+
+from log_config import DebugSampler, configure_logging
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handler = logging.NullHandler()
+    saved = root.level, root.handlers[:], logging.getLogger("botocore").level
+    root.handlers[:] = [handler]
+    yield root
+    root.setLevel(saved[0])
+    root.handlers[:] = saved[1]
+    logging.getLogger("botocore").setLevel(saved[2])
+
+
+class CountingArgument:
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "image.png"
+
+
+def test_levels_come_from_the_environment(root_logger, monkeypatch):
+    monkeypatch.setenv("DEMO_APP_LOG_LEVEL", "warning")
+    monkeypatch.setenv("DEMO_APP_LIBRARY_LOG_LEVEL", "ERROR")
+
+    configure_logging()
+
+    assert root_logger.level == logging.WARNING
+    assert logging.getLogger("botocore").level == logging.ERROR
+
+
+def test_disabled_lines_are_never_formatted(root_logger):
+    configure_logging("INFO")
+    argument = CountingArgument()
+
+    logging.getLogger("image_processor").debug("Downloading %s into memory", argument)
+
+    assert argument.formatted == 0
+
+
+def test_only_debug_lines_are_sampled(root_logger):
+    configure_logging("DEBUG", sample_rate=0.25)
+    samplers = [f for f in root_logger.handlers[0].filters if isinstance(f, DebugSampler)]
+    assert len(samplers) == 1
+
+    def record(level):
+        return logging.LogRecord("image_processor", level, __file__, 1, "message", None, None)
+
+    kept = sum(samplers[0].filter(record(logging.DEBUG)) for _ in range(4000))
+    assert 800 < kept < 1200
+    assert all(samplers[0].filter(record(logging.INFO)) for _ in range(100))
+
+    configure_logging("DEBUG", sample_rate=1)
+    assert not root_logger.handlers[0].filters
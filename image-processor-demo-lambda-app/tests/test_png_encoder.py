@@ -0,0 +1,28 @@
+from io import BytesIO
+
+import imageio.v2 as imageio
+import numpy as np
+import pytest
+
+from png_encoder import StreamingPngEncoder
+
+
+@pytest.mark.parametrize('shape', [(23, 17), (23, 17, 2), (23, 17, 3), (23, 17, 4)])
+def test_strips_decode_back_to_the_image(shape):
+    image = np.random.default_rng(3).integers(0, 256, size=shape, dtype=np.uint8)
+    target = BytesIO()
+    encoder = StreamingPngEncoder(target, shape[1], shape[0], shape[2] if len(shape) == 3 else 1)
+
+    for start in range(0, shape[0], 5):
+        encoder.write_rows(image[start:start + 5])
+    encoder.close()
+
+    np.testing.assert_array_equal(imageio.imread(target.getvalue()), image)
+
+
+def test_closing_before_every_row_is_written_fails():
+    encoder = StreamingPngEncoder(BytesIO(), 4, 3, 1)
+    encoder.write_rows(np.zeros((2, 4), dtype=np.uint8))
+
+    with pytest.raises(ValueError):
+        encoder.close()
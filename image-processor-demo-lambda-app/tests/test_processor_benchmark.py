@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_aws import FakeS3, FakeSQS  # noqa: E402
+
+
+def test_fake_sqs_redelivers_until_deleted():
+    sqs = FakeSQS(max_wait_seconds=0)
+    sqs.send(["a", "b"])
+
+    first = sqs.receive_message(QueueUrl="q", MaxNumberOfMessages=10, VisibilityTimeout=30)["Messages"]
+    assert [message["Body"] for message in first] == ["a", "b"]
+    assert sqs.receive_message(QueueUrl="q", MaxNumberOfMessages=10) == {}
+
+    sqs.delete_message_batch(QueueUrl="q", Entries=[{"Id": "0", "ReceiptHandle": first[0]["ReceiptHandle"]}])
+    sqs.change_message_visibility_batch(QueueUrl="q", Entries=[
+        {"Id": "0", "ReceiptHandle": first[1]["ReceiptHandle"], "VisibilityTimeout": 0}])
+
+    again = sqs.receive_message(QueueUrl="q", MaxNumberOfMessages=10)["Messages"]
+    assert [message["Body"] for message in again] == ["b"]
+    assert sqs.deleted == 1
+
+
+def test_fake_s3_honours_range_and_if_match():
+    s3 = FakeS3()
+    etag = s3.put_object(Bucket="b", Key="k", Body=b"0123456789")["ETag"]
+
+    response = s3.get_object(Bucket="b", Key="k", Range="bytes=2-4", IfMatch=etag)
+    assert response["Body"].read() == b"234"
+    assert response["ContentRange"] == "bytes 2-4/10"
+    with pytest.raises(Exception, match="PreconditionFailed"):
+        s3.get_object(Bucket="b", Key="k", IfMatch='"stale"')
+    with pytest.raises(Exception, match="404"):
+        s3.head_object(Bucket="b", Key="missing")
+
+
+def test_benchmark_drains_the_queue_and_writes_json(tmp_path):
+    output = tmp_path / "results.json"
+
+    subprocess.run([sys.executable, os.path.join(BENCHMARKS_DIR, "processor_benchmark.py"), "--variants",
+                    "original", "--messages", "3", "--sizes", "48x32", "--request-latency-ms", "0",
+                    "--output", str(output)], check=True, stdout=subprocess.PIPE)
+
+    result = json.loads(output.read_text())["results"][0]
+    assert (result["completed"], result["acknowledged"]) == (3, 3)
+    assert result["messages_per_second"] > 0
+    assert result["latency_p50_seconds"] <= result["latency_p99_seconds"]
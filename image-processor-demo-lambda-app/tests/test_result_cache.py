@@ -0,0 +1,35 @@
+from botocore.exceptions import ClientError
+
+from result_cache import ResultCache, fingerprint, is_missing
+
+
+def test_fingerprint_depends_on_source_and_transform():
+    assert fingerprint('"abc"', "monochrome") == fingerprint('"abc"', "monochrome")
+    assert fingerprint('"abc"', "monochrome") != fingerprint('"abd"', "monochrome")
+    assert fingerprint('"abc"', "monochrome") != fingerprint('"abc"', "brighten-gamma-0.1")
+
+
+def test_cache_evicts_the_least_recently_used_output():
+    result_cache = ResultCache(max_entries=2)
+    result_cache.add(["a", "b"])
+    assert result_cache.contains("a")
+
+    result_cache.add(["c"])
+
+    assert result_cache.contains("a")
+    assert not result_cache.contains("b")
+    assert result_cache.contains("c")
+
+
+def test_summary_reports_the_hit_rate():
+    result_cache = ResultCache()
+    for hit in (True, True, True, False):
+        result_cache.record(hit)
+
+    assert result_cache.summary() == "Result cache: 3 hits, 1 misses (75% hit rate)"
+
+
+def test_only_not_found_errors_count_as_missing():
+    assert is_missing(ClientError({"Error": {"Code": "404"}}, "HeadObject"))
+    assert not is_missing(ClientError({"Error": {"Code": "403"}}, "HeadObject"))
+    assert not is_missing(ValueError("404"))
@@ -0,0 +1,88 @@
+import io
+
+import pytest
+
+from s3_transfer import S3Transfer, TransferStats, part_ranges
+
+
+class FakeS3Client:
+    def __init__(self, objects=None, fail_part=None):
+        self.objects = objects or {}
+        self.fail_part = fail_part
+        self.calls = []
+        self.parts = {}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.calls.append(("get_object", Range))
+        data = self.objects[Key]
+        first_byte, last_byte = (int(value) for value in Range[len("bytes="):].split("-"))
+        last_byte = min(last_byte, len(data) - 1)
+        return {"Body": io.BytesIO(data[first_byte:last_byte + 1]),
+                "ContentRange": "bytes %d-%d/%d" % (first_byte, last_byte, len(data))}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append(("put_object", len(Body)))
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls.append(("create_multipart_upload", Key))
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise RuntimeError("part failed")
+        self.parts[PartNumber] = Body
+        return {"ETag": '"part-%d"' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[Key] = b"".join(self.parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(("abort_multipart_upload", Key))
+
+
+def test_part_ranges_cover_every_byte_once():
+    assert part_ranges(25, 10) == [(0, 9), (10, 19), (20, 24)]
+    assert part_ranges(25, 10, start=10) == [(10, 19), (20, 24)]
+
+
+def test_small_objects_are_downloaded_with_a_single_request():
+    s3_client = FakeS3Client({"small.png": b"x" * 7})
+    s3_transfer = S3Transfer(s3_client, part_size=10, stats=TransferStats())
+
+    assert s3_transfer.download("bucket", "small.png") == b"x" * 7
+    assert s3_client.calls == [("get_object", "bytes=0-9")]
+
+
+def test_large_objects_are_downloaded_in_ranges():
+    data = bytes(range(256)) * 4
+    s3_client = FakeS3Client({"large.png": data})
+    stats = TransferStats()
+    s3_transfer = S3Transfer(s3_client, part_size=100, max_concurrency=4, stats=stats)
+
+    assert s3_transfer.download("bucket", "large.png") == data
+    assert len(s3_client.calls) == 11
+    assert "S3 download (ranged): 1 objects" in stats.summary()
+
+
+def test_uploads_switch_to_multipart_at_the_threshold():
+    s3_client = FakeS3Client()
+    s3_transfer = S3Transfer(s3_client, multipart_threshold=50, part_size=20, stats=TransferStats())
+
+    s3_transfer.upload("bucket", "small.png", b"s" * 49)
+    s3_transfer.upload("bucket", "large.png", bytes(range(50)))
+
+    assert s3_client.objects["small.png"] == b"s" * 49
+    assert s3_client.objects["large.png"] == bytes(range(50))
+    assert sorted(s3_client.parts) == [1, 2, 3]
+    assert ("create_multipart_upload", "large.png") in s3_client.calls
+
+
+def test_failed_multipart_uploads_are_aborted():
+    s3_client = FakeS3Client(fail_part=2)
+    s3_transfer = S3Transfer(s3_client, multipart_threshold=50, part_size=20, stats=TransferStats())
+
+    with pytest.raises(RuntimeError):
+        s3_transfer.upload("bucket", "large.png", bytes(60))
+    assert ("abort_multipart_upload", "large.png") in s3_client.calls
+    assert "large.png" not in s3_client.objects
@@ -0,0 +1,56 @@
+import json
+from io import BytesIO
+
+import numpy as np
+
+from image_editor import ImageEditor
+from stage_metrics import BUCKET_GROWTH, Histogram, StageMetrics
+
+
+def test_histogram_buckets_are_within_their_growth_factor():
+    histogram = Histogram()
+    for value in (0.5, 3.2, 3.3, 250.0):
+        histogram.record(value)
+
+    emf = histogram.to_emf()
+
+    assert emf["Counts"] == [1, 2, 1]
+    for value, midpoint in zip((0.5, 3.2, 250.0), emf["Values"]):
+        assert value / BUCKET_GROWTH ** 0.5 <= midpoint <= value * BUCKET_GROWTH ** 0.5
+    assert (emf["Min"], emf["Max"], emf["Count"], emf["Sum"]) == (0.5, 250.0, 4, 257.0)
+
+
+def test_flush_writes_one_emf_line_and_starts_over():
+    lines = []
+    metrics = StageMetrics("original", namespace="Test", emit=lines.append)
+    with metrics.time("download"):
+        pass
+    metrics.record("upload", 0.002)
+    metrics.count("MessagesProcessed", 2)
+
+    metrics.flush()
+    metrics.flush()
+
+    assert len(lines) == 1
+    document = json.loads(lines[0])
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "Test"
+    assert directive["Dimensions"] == [["Implementation"]]
+    assert [metric["Name"] for metric in directive["Metrics"]] == ["DownloadTime", "UploadTime", "MessagesProcessed"]
+    assert document["Implementation"] == "original"
+    assert document["UploadTime"]["Sum"] == 2.0
+    assert document["MessagesProcessed"] == 2
+
+
+def test_editor_reports_decode_transform_and_encode_times():
+    image = np.random.default_rng(5).integers(0, 256, size=(20, 30, 3), dtype=np.uint8)
+    source = BytesIO()
+    ImageEditor.apply(image, [(ImageEditor.brighten, source)])
+    source.seek(0)
+    timings = {}
+
+    ImageEditor.apply(source, [(ImageEditor.grayscale, BytesIO()), (ImageEditor.brighten, BytesIO())],
+                      timings=timings)
+
+    assert sorted(timings) == ["decode", "encode", "transform"]
+    assert all(seconds > 0 for seconds in timings.values())
@@ -0,0 +1,90 @@
+import threading
+
+import boto3
+import pytest
+
+import aws_clients
+import image_key_index
+import task_publisher
+from task_publisher import TaskPublisher
+
+
+class FakeSqsClient:
+    def __init__(self, failures=None):
+        # MessageBody -> list of failures to report for it, consumed one per attempt
+        self.failures = failures or {}
+        self.lock = threading.Lock()
+        self.batches = []
+        self.sent = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        with self.lock:
+            self.batches.append([entry["MessageBody"] for entry in Entries])
+            failed = []
+            for entry in Entries:
+                pending = self.failures.get(entry["MessageBody"])
+                if pending:
+                    failed.append(dict(pending.pop(0), Id=entry["Id"]))
+                else:
+                    self.sent.append(entry["MessageBody"])
+        return {"Successful": [], "Failed": failed}
+
+
+@pytest.fixture
+def publisher(monkeypatch):
+    monkeypatch.setattr(boto3, "client", lambda *args, **kwargs: None)
+    monkeypatch.setattr(aws_clients, "_clients", {})
+    monkeypatch.setattr(task_publisher, "RETRY_BACKOFF_SECONDS", 0)
+    return TaskPublisher("queue-url", "bucket")
+
+
+def test_publish_messages_sends_batches_of_ten(publisher):
+    publisher.sqs_client = FakeSqsClient()
+    messages = ["key-" + str(i) for i in range(95)]
+
+    assert publisher.publish_messages(messages) == 95
+    assert sorted(publisher.sqs_client.sent) == sorted(messages)
+    assert len(publisher.sqs_client.batches) == 10
+
+
+def test_failed_entries_are_retried_on_their_own(publisher):
+    throttled = {"Code": "InternalError", "SenderFault": False}
+    publisher.sqs_client = FakeSqsClient({"key-3": [throttled, throttled], "key-7": [throttled]})
+
+    assert publisher.publish_messages(["key-" + str(i) for i in range(10)]) == 10
+    assert publisher.sqs_client.batches[1:] == [["key-3", "key-7"], ["key-3"]]
+
+
+def test_rejected_and_exhausted_entries_are_reported_as_not_sent(publisher):
+    throttled = {"Code": "InternalError", "SenderFault": False}
+    invalid = {"Code": "InvalidMessageContents", "SenderFault": True}
+    publisher.sqs_client = FakeSqsClient({"key-0": [invalid], "key-1": [throttled] * task_publisher.MAX_SEND_ATTEMPTS})
+
+    assert publisher.publish_messages(["key-0", "key-1", "key-2"]) == 1
+    assert publisher.sqs_client.sent == ["key-2"]
+
+
+class FakeBucketAndQueueClient(FakeSqsClient):
+    def __init__(self, keys):
+        super().__init__()
+        self.keys = keys
+        self.list_calls = 0
+
+    def list_objects_v2(self, Bucket, Prefix):
+        self.list_calls += 1
+        return {"Contents": [{"Key": key, "ETag": '"' + key + '"'} for key in self.keys], "IsTruncated": False}
+
+
+def test_publishers_of_later_invocations_reuse_the_image_listing(monkeypatch):
+    client = FakeBucketAndQueueClient(["input-images/a.png", "input-images/b.png"])
+    monkeypatch.setattr(boto3, "client", lambda *args, **kwargs: client)
+    monkeypatch.setattr(aws_clients, "_clients", {})
+    monkeypatch.setattr(image_key_index, "_indexes", {})
+
+    # The handler builds a new TaskPublisher on every invocation
+    for _ in range(3):
+        assert TaskPublisher("queue-url", "bucket").publish_image_transform_task(20) == 20
+
+    assert client.list_calls == 1
+    assert len(client.sent) == 60
@@ -0,0 +1,248 @@
+import threading
+import time
+
+from task_receiver import MAX_MESSAGES_PER_RECEIVE, TaskAcknowledger, TaskReceiver
+
+
+class FakeSqsClient:
+    def __init__(self, number_of_messages):
+        self.messages = [{"Body": "key-" + str(i), "ReceiptHandle": "handle-" + str(i)}
+                         for i in range(number_of_messages)]
+        self.lock = threading.Lock()
+        self.receive_calls = []
+        self.visibility_changes = []
+        self.deleted = []
+        self.delete_calls = 0
+
+    def receive_message(self, **kwargs):
+        self.receive_calls.append(kwargs)
+        with self.lock:
+            batch = self.messages[:kwargs["MaxNumberOfMessages"]]
+            del self.messages[:len(batch)]
+        if not batch:
+            threading.Event().wait(0.05)
+            return {}
+        return {"Messages": batch}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.visibility_changes.extend(Entries)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.delete_calls += 1
+        self.deleted.extend(entry["ReceiptHandle"] for entry in Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_receive_long_polls_for_full_batches():
+    sqs_client = FakeSqsClient(25)
+    receiver = TaskReceiver(sqs_client, "queue-url", wait_time_seconds=7)
+
+    bodies = []
+    while len(bodies) < 25:
+        bodies.extend(message["Body"] for message in receiver.receive(timeout=1))
+    receiver.stop()
+
+    assert sorted(bodies) == sorted("key-" + str(i) for i in range(25))
+    assert all(call["MaxNumberOfMessages"] == MAX_MESSAGES_PER_RECEIVE and call["WaitTimeSeconds"] == 7
+               for call in sqs_client.receive_calls)
+
+
+def test_receive_returns_empty_list_when_queue_stays_empty():
+    receiver = TaskReceiver(FakeSqsClient(0), "queue-url")
+
+    assert receiver.receive(timeout=0.1) == []
+    receiver.stop()
+
+
+def test_stop_releases_buffered_messages():
+    sqs_client = FakeSqsClient(30)
+    receiver = TaskReceiver(sqs_client, "queue-url", prefetch_size=20)
+
+    received = receiver.receive(max_messages=5, timeout=1)
+    receiver.stop()
+    for poller in receiver.pollers:
+        poller.join(timeout=1)
+
+    released = {entry["ReceiptHandle"] for entry in sqs_client.visibility_changes}
+    assert len(received) == 5
+    assert not released & {message["ReceiptHandle"] for message in received}
+    assert all(entry["VisibilityTimeout"] == 0 for entry in sqs_client.visibility_changes)
+    # Everything pulled off the queue is either handed out or released, and never more than the prefetch size
+    assert len(received) + len(released) == 30 - len(sqs_client.messages)
+    assert len(received) + len(released) <= 20
+
+
+def test_acks_are_deleted_in_full_batches_without_waiting_for_the_interval():
+    sqs_client = FakeSqsClient(25)
+    acknowledger = TaskAcknowledger(sqs_client, "queue-url", flush_interval=60)
+    messages, sqs_client.messages = sqs_client.messages, []
+    acknowledger.track(messages)
+
+    for message in messages[:10]:
+        acknowledger.ack(message)
+
+    assert wait_until(lambda: len(sqs_client.deleted) == 10)
+    assert sqs_client.delete_calls == 1
+
+    for message in messages[10:]:
+        acknowledger.ack(message)
+    acknowledger.close()
+
+    assert sorted(sqs_client.deleted) == sorted(message["ReceiptHandle"] for message in messages)
+    assert sqs_client.delete_calls == 3
+    assert sqs_client.visibility_changes == []
+
+
+def test_acks_are_flushed_after_the_interval():
+    sqs_client = FakeSqsClient(3)
+    acknowledger = TaskAcknowledger(sqs_client, "queue-url", flush_interval=0.05)
+    acknowledger.track(sqs_client.messages)
+
+    for message in sqs_client.messages:
+        acknowledger.ack(message)
+
+    assert wait_until(lambda: len(sqs_client.deleted) == 3)
+    assert sqs_client.delete_calls == 1
+    acknowledger.close()
+
+
+def test_failed_messages_are_returned_to_the_queue_promptly():
+    sqs_client = FakeSqsClient(2)
+    acknowledger = TaskAcknowledger(sqs_client, "queue-url", flush_interval=60)
+    acknowledger.track(sqs_client.messages)
+
+    acknowledger.nack(sqs_client.messages[0])
+
+    assert wait_until(lambda: sqs_client.visibility_changes)
+    assert sqs_client.visibility_changes == [{"Id": "0", "ReceiptHandle": "handle-0", "VisibilityTimeout": 0}]
+    acknowledger.close()
+
+
+def test_heartbeat_extends_visibility_of_slow_messages():
+    sqs_client = FakeSqsClient(2)
+    acknowledger = TaskAcknowledger(sqs_client, "queue-url", visibility_timeout=0.3)
+    acknowledger.track(sqs_client.messages)
+    acknowledger.ack(sqs_client.messages[0])
+
+    assert wait_until(lambda: len(sqs_client.visibility_changes) >= 2)
+    assert {entry["ReceiptHandle"] for entry in sqs_client.visibility_changes} == {"handle-1"}
+    assert all(entry["VisibilityTimeout"] == 0.3 for entry in sqs_client.visibility_changes)
+    acknowledger.close()
+
+
+def test_close_hands_back_messages_that_were_never_settled():
+    sqs_client = FakeSqsClient(3)
+    acknowledger = TaskAcknowledger(sqs_client, "queue-url", flush_interval=60)
+    acknowledger.track(sqs_client.messages)
+    acknowledger.ack(sqs_client.messages[0])
+
+    acknowledger.close()
+
+    assert sqs_client.deleted == ["handle-0"]
+    assert sorted(entry["ReceiptHandle"] for entry in sqs_client.visibility_changes) == ["handle-1", "handle-2"]
+    assert all(entry["VisibilityTimeout"] == 0 for entry in sqs_client.visibility_changes)
+
+
+class FixedDeadline:
+    def __init__(self, wait_seconds):
+        self.wait_seconds = wait_seconds
+
+    def receive_wait_seconds(self, rounds=1):
+        return self.wait_seconds
+
+
+def test_buffered_messages_are_heartbeated_until_handed_out():
+    sqs_client = FakeSqsClient(20)
+    acknowledger = TaskAcknowledger(sqs_client, "queue-url", visibility_timeout=0.3)
+    receiver = TaskReceiver(sqs_client, "queue-url", prefetch_size=20, acknowledger=acknowledger)
+
+    received = receiver.receive(max_messages=5, timeout=1)
+    for message in received:
+        acknowledger.ack(message)
+
+    assert wait_until(lambda: len(receiver.buffer) == 15)
+    assert wait_until(lambda: len({entry["ReceiptHandle"] for entry in sqs_client.visibility_changes}) == 15)
+    assert all(entry["VisibilityTimeout"] == 0.3 for entry in sqs_client.visibility_changes)
+    sqs_client.visibility_changes.clear()
+    receiver.stop()
+    acknowledger.close()
+
+    assert sorted(sqs_client.deleted) == sorted(message["ReceiptHandle"] for message in received)
+    released = [entry for entry in sqs_client.visibility_changes if entry["VisibilityTimeout"] == 0]
+    assert len(released) == 15
+
+
+def test_expired_buffered_messages_are_dropped_without_an_acknowledger():
+    sqs_client = FakeSqsClient(10)
+    receiver = TaskReceiver(sqs_client, "queue-url", visibility_timeout=0.1)
+    receiver.start()
+    assert wait_until(lambda: len(receiver.buffer) == 10)
+    time.sleep(0.15)
+
+    assert receiver.receive(timeout=0.1) == []
+    receiver.stop()
+
+
+def test_long_polls_are_bounded_by_the_deadline():
+    sqs_client = FakeSqsClient(0)
+    receiver = TaskReceiver(sqs_client, "queue-url")
+
+    receiver.receive(timeout=0.1, deadline=FixedDeadline(3))
+    receiver.stop()
+    assert sqs_client.receive_calls
+    assert all(call["WaitTimeSeconds"] == 3 for call in sqs_client.receive_calls)
+
+    sqs_client = FakeSqsClient(5)
+    receiver = TaskReceiver(sqs_client, "queue-url")
+    assert receiver.receive(timeout=0.1, deadline=FixedDeadline(0)) == []
+    assert wait_until(lambda: not any(poller.is_alive() for poller in receiver.pollers))
+    assert sqs_client.receive_calls == []
+    receiver.stop()
+
+
+def test_stop_does_not_wait_for_receives_in_flight_but_hands_back_what_they_get():
+    sqs_client = FakeSqsClient(10)
+    receive_message = sqs_client.receive_message
+    in_flight = threading.Event()
+
+    def slow_receive_message(**kwargs):
+        in_flight.set()
+        time.sleep(0.5)
+        return receive_message(**kwargs)
+
+    sqs_client.receive_message = slow_receive_message
+    receiver = TaskReceiver(sqs_client, "queue-url", concurrent_receives=1)
+    receiver.start()
+    assert in_flight.wait(1)
+
+    started_at = time.monotonic()
+    receiver.stop()
+
+    assert time.monotonic() - started_at < 0.25
+    assert wait_until(lambda: not receiver.pollers[0].is_alive())
+    assert sorted(entry["ReceiptHandle"] for entry in sqs_client.visibility_changes) == \
+        sorted("handle-" + str(i) for i in range(10))
+
+
+def test_pollers_stop_long_polling_once_the_queue_is_drained():
+    sqs_client = FakeSqsClient(0)
+    receiver = TaskReceiver(sqs_client, "queue-url")
+
+    assert receiver.receive(timeout=0.2) == []
+    assert wait_until(lambda: receiver.in_flight == 0)
+    calls = len(sqs_client.receive_calls)
+    time.sleep(0.2)
+    assert len(sqs_client.receive_calls) == calls
+
+    # The next receive() starts them again
+    sqs_client.messages = [{"Body": "late", "ReceiptHandle": "handle-late"}]
+    assert [message["Body"] for message in receiver.receive(timeout=1)] == ["late"]
+    receiver.stop()
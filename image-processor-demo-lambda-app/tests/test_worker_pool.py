@@ -0,0 +1,56 @@
+from collections import Counter
+
+import pytest
+
+
+@pytest.fixture
+def worker_pool(import_implementation):
+    return import_implementation("greenlet-implementation", "worker_pool")
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 10])
+@pytest.mark.parametrize("pool_size", [None, 1, 4, 32])
+def test_every_message_of_a_batch_is_handled_exactly_once(worker_pool, batch_size, pool_size):
+    import gevent
+
+    handled = Counter()
+    in_flight = []
+    peak = [0]
+
+    def handler(message):
+        in_flight.append(message)
+        peak[0] = max(peak[0], len(in_flight))
+        # Yield to the hub, as a greenlet blocked on a socket would
+        gevent.sleep(0.001)
+        in_flight.remove(message)
+        handled[message] += 1
+
+    pool = worker_pool.WorkerPool(pool_size=pool_size)
+    limit = pool.pool_size
+    messages = ["message-%d" % i for i in range(batch_size)]
+
+    pool.map(handler, messages)
+
+    assert handled == Counter(messages)
+    assert peak[0] <= min(batch_size, limit)
+
+
+def test_a_failing_message_does_not_stop_the_rest_of_the_batch(worker_pool):
+    handled = Counter()
+
+    def handler(message):
+        handled[message] += 1
+        if message == 4:
+            raise RuntimeError("cannot process")
+
+    worker_pool.WorkerPool(pool_size=3).map(handler, list(range(10)))
+
+    assert handled == Counter(range(10))
+
+
+def test_an_empty_batch_spawns_no_workers(worker_pool):
+    pool = worker_pool.WorkerPool(pool_size=4)
+
+    pool.map(lambda message: pytest.fail("handled %s" % message), [])
+
+    assert pool.pool_size == 4
@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import collections
+import os
+import threading
+
+MiB = 1024 * 1024
+# Share of the function's memory the decoded images may take up in total. The cache lives as long as the container,
+# so the rest is left for the runtime and libraries, and for the images in flight and their encoded outputs
+MEMORY_FRACTION = 0.25
+# Budget outside Lambda, where there is no function memory size to take a share of
+DEFAULT_MAX_BYTES = 256 * MiB
+
+
+class DecodedImageCache:
+    """
+    Least recently used cache of decoded source images, keyed by (bucket, key, ETag) so a changed object is never
+    served from a stale entry. The budget is in bytes of decoded pixels rather than entries, since one large image
+    can take up as much memory as hundreds of small ones. Images larger than the whole budget are not cached.
+
+    Cached arrays are made read-only, so a transform that tried to modify its input in place would fail instead of
+    corrupting the image for the next message that uses it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, bucket, key, etag):
+        with self.lock:
+            image = self.images.get((bucket, key, etag))
+            if image is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end((bucket, key, etag))
+            self.hits += 1
+            return image
+
+    def put(self, bucket, key, etag, image):
+        if image.nbytes > self.max_bytes:
+            return
+        image.flags.writeable = False
+        with self.lock:
+            previous = self.images.pop((bucket, key, etag), None)
+            if previous is not None:
+                self.size_bytes -= previous.nbytes
+            self.images[(bucket, key, etag)] = image
+            self.size_bytes += image.nbytes
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.size_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return "Decoded image cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses (" + \
+            "%.0f" % (hit_rate * 100) + "% hit rate), " + str(len(self.images)) + " images in " + \
+            str(self.size_bytes // (1024 * 1024)) + " MiB, " + str(self.evictions) + " evictions"
+
+
+def default_max_bytes():
+    """
+    DEMO_APP_DECODED_IMAGE_CACHE_BYTES when it is set (0 disables the cache), otherwise MEMORY_FRACTION of the
+    memory configured for the function, or DEFAULT_MAX_BYTES outside Lambda.
+    """
+    max_bytes = os.environ.get("DEMO_APP_DECODED_IMAGE_CACHE_BYTES")
+    if max_bytes is not None:
+        return int(max_bytes)
+    memory_size_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if memory_size_mb is None:
+        return DEFAULT_MAX_BYTES
+    return int(int(memory_size_mb) * MiB * MEMORY_FRACTION)
+
+
+_default_decoded_image_cache = DecodedImageCache(default_max_bytes())
+
+
+def default_decoded_image_cache():
+    # One cache per container, so every run() of a warm container can reuse the images decoded by earlier ones
+    return _default_decoded_image_cache
@@ -1,20 +1,172 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import contextlib
+import os
+import time
+from functools import lru_cache
+
+import numpy as np
 from skimage import io, exposure
 from skimage import img_as_ubyte
 from skimage.color import rgb2gray, rgba2rgb
 
+from image_encoder import default_image_encoder
+
+BRIGHTEN_GAMMA = 0.1
+
+# rgb2gray's luma weights (0.2125, 0.7154, 0.0721) in 16-bit fixed point; they sum to exactly 1 << 16
+LUMA_WEIGHTS = (13926, 46885, 4725)
+LUMA_SCALE = 1 << 16
+
+# Images with at least this many pixels are transformed and encoded in row strips
+TILED_MIN_PIXELS = int(os.environ.get("DEMO_APP_TILED_MIN_PIXELS", 16 * 1024 * 1024))
+# Decoded source bytes per strip, which bounds the transforms' working set however large the image is
+STRIP_BYTES = 1024 * 1024
+
+
+def _add_time(timings, stage, started_at):
+    # timings, when given, is a {stage: seconds} dict the caller reports from, e.g. to StageMetrics.record_all
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - started_at
+    return now
+
+
+@lru_cache(maxsize=None)
+def _gamma_lookup_table(gamma):
+    # Same table exposure.adjust_gamma builds for uint8 images, computed once per gamma instead of per call
+    lookup_table = np.minimum(np.rint(255 * (np.linspace(0, 1, 256) ** gamma)), 255).astype(np.uint8)
+    lookup_table.flags.writeable = False
+    return lookup_table
+
+
+def _fixed_point_grayscale(image):
+    """
+    Integer equivalent of img_as_ubyte(rgb2gray(rgba2rgb(image))) for uint8/uint16 RGB(A) images. Alpha blending
+    against white and luma weighting happen in one pass over two full-size integer buffers, instead of the
+    several float64 copies the skimage path allocates. Results agree with skimage to within one grey level.
+    """
+    max_value = int(np.iinfo(image.dtype).max)
+    # The blended numerator needs ~32 bits for uint8 input and ~48 bits for uint16 input
+    accumulator_dtype = np.uint32 if image.dtype == np.uint8 else np.uint64
+    luma = np.empty(image.shape[:2], dtype=accumulator_dtype)
+    scratch = np.empty_like(luma)
+    grey = np.empty(image.shape[:2], dtype=np.uint8)
+
+    np.multiply(image[..., 0], LUMA_WEIGHTS[0], out=luma, dtype=accumulator_dtype)
+    for channel in (1, 2):
+        np.multiply(image[..., channel], LUMA_WEIGHTS[channel], out=scratch, dtype=accumulator_dtype)
+        luma += scratch
+
+    denominator = LUMA_SCALE * max_value
+    if image.shape[-1] == 4:
+        # Composite over a white background: luma * alpha + white * (max - alpha), all scaled by max
+        alpha = image[..., 3]
+        luma *= alpha
+        np.subtract(max_value, alpha, out=scratch, dtype=accumulator_dtype)
+        scratch *= LUMA_SCALE * max_value
+        luma += scratch
+        denominator *= max_value
+
+    # Rescale to 0..255 with round-half-up; for uint8 input the factor of 255 cancels out of the denominator
+    if max_value == 255:
+        denominator //= 255
+    else:
+        luma *= 255
+    luma += denominator // 2
+    np.floor_divide(luma, denominator, out=grey, casting='unsafe')
+    return grey
+
 
 class ImageEditor:
     @staticmethod
-    def brighten_image(source_filename, target_filename):
-        image = io.imread(source_filename)
-        brightened_image = exposure.adjust_gamma(image, 0.1)
-        io.imsave(fname=target_filename, arr=img_as_ubyte(brightened_image))
+    def brighten(image, gamma=BRIGHTEN_GAMMA):
+        if image.dtype != np.uint8:
+            return img_as_ubyte(exposure.adjust_gamma(image, gamma))
+        # Every uint8 value is a valid index into the 256-entry table, so bounds checking can be skipped
+        return np.take(_gamma_lookup_table(gamma), image, mode='clip')
+
+    @staticmethod
+    def grayscale(image):
+        if image.dtype in (np.uint8, np.uint16) and image.ndim == 3 and image.shape[-1] in (3, 4):
+            return _fixed_point_grayscale(image)
+        return img_as_ubyte(rgb2gray(rgba2rgb(image)))
+
+    @staticmethod
+    def decode(source):
+        """
+        Decode source, a filename or a file-like object holding an encoded image, into a numpy array.
+        """
+        return io.imread(source)
+
+    @staticmethod
+    def apply(source, operations, encoder=None, timings=None):
+        """
+        Decode source once and encode every (transform, target) pair in operations from that same in-memory
+        image, so several outputs only cost a single decode. Source and targets may be filenames or file-like
+        objects such as BytesIO, which keeps the whole round trip in memory; source may also be an image that
+        has already been decoded into a numpy array. Outputs are encoded with encoder, an ImageEncoder, or in the
+        container's default output format. The seconds spent decoding, transforming and encoding are added to
+        timings if a dict is given.
+        """
+        encoder = encoder or default_image_encoder()
+        started_at = time.perf_counter()
+        if isinstance(source, np.ndarray):
+            image = source
+        else:
+            image = ImageEditor.decode(source)
+            started_at = _add_time(timings, "decode", started_at)
+        if encoder.streams and image.shape[0] * image.shape[1] >= TILED_MIN_PIXELS:
+            ImageEditor.apply_tiled(image, operations, encoder=encoder, timings=timings)
+            return
+        for transform, target in operations:
+            output = transform(image)
+            started_at = _add_time(timings, "transform", started_at)
+            encoder.encode(output, target)
+            started_at = _add_time(timings, "encode", started_at)
+
+    @staticmethod
+    def apply_tiled(source, operations, strip_bytes=STRIP_BYTES, encoder=None, timings=None):
+        """
+        Same as apply, but every transform runs on one strip of rows at a time and its output is fed to a
+        streaming encoder as it is produced. No full-size output image, float64 intermediate or encoded
+        copy is ever held, so besides the decoded source the memory used does not grow with the image. The
+        transforms must work pixel by pixel, as brighten and grayscale do, and the encoder must stream (PNG).
+        """
+        encoder = encoder or default_image_encoder()
+        if not encoder.streams:
+            raise ValueError(encoder.image_format + " output cannot be encoded a strip at a time")
+        started_at = time.perf_counter()
+        if isinstance(source, np.ndarray):
+            image = source
+        else:
+            image = ImageEditor.decode(source)
+            started_at = _add_time(timings, "decode", started_at)
+        height = image.shape[0]
+        rows_per_strip = max(1, strip_bytes // max(1, image[0].nbytes))
+        streams = [None] * len(operations)
+        with contextlib.ExitStack() as stack:
+            targets = [stack.enter_context(open(target, 'wb')) if isinstance(target, str) else target
+                       for _, target in operations]
+            for start in range(0, height, rows_per_strip):
+                strip = image[start:start + rows_per_strip]
+                for index, (transform, _) in enumerate(operations):
+                    output = transform(strip)
+                    started_at = _add_time(timings, "transform", started_at)
+                    if streams[index] is None:
+                        channels = 1 if output.ndim == 2 else output.shape[-1]
+                        streams[index] = encoder.stream(targets[index], output.shape[1], height, channels)
+                    streams[index].write_rows(output)
+                    started_at = _add_time(timings, "encode", started_at)
+            for stream in streams:
+                stream.close()
+            _add_time(timings, "encode", started_at)
+
+    @staticmethod
+    def brighten_image(source, target, encoder=None):
+        ImageEditor.apply(source, [(ImageEditor.brighten, target)], encoder)
 
     @staticmethod
-    def monochrome(source_filename, target_filename):
-        image = io.imread(source_filename)
-        image_grey = rgb2gray(rgba2rgb(image))
-        io.imsave(fname=target_filename, arr=img_as_ubyte(image_grey))
+    def monochrome(source, target, encoder=None):
+        ImageEditor.apply(source, [(ImageEditor.grayscale, target)], encoder)
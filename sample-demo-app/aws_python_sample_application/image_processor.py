@@ -1,157 +1,267 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import os
-import random
+import logging
+import math
 import time
-import gevent
-from gevent import monkey
+from io import BytesIO
 
-from image_editor import ImageEditor
+from aws_clients import get_client
+from deadline import InvocationDeadline
+from decoded_image_cache import default_decoded_image_cache
+from image_editor import BRIGHTEN_GAMMA, ImageEditor
+from image_encoder import default_image_encoder
+from result_cache import default_result_cache, fingerprint, is_missing
+from s3_transfer import S3Transfer
+from stage_metrics import StageMetrics
+from task_receiver import MAX_MESSAGES_PER_RECEIVE, MAX_WAIT_TIME_SECONDS, TaskAcknowledger, TaskReceiver
+from worker_pool import WorkerPool
 
-import boto3
+logger = logging.getLogger(__name__)
 
 BW_FOLDER = "bw-images/"
 BRIGHTEN_FOLDER = "brighten-images/"
 
 
-def delete_file(file_path):
-    try:
-        print("Removing file from " + file_path)
-        os.remove(file_path)
-        print("Successfully removed file from " + file_path)
-    except Exception:
-        print("Failed to remove file from" + file_path)
-
-
 class ImageProcessor:
-    def __init__(self, sqs_queue_url, s3_bucket_name):
-        self.sqs_client = boto3.client('sqs')
-        self.s3_client = boto3.client('s3')
+    def __init__(self, sqs_queue_url, s3_bucket_name, pool_size=None):
+        self.sqs_client = get_client('sqs')
+        self.s3_client = get_client('s3')
         self.sqs_queue_url = sqs_queue_url
         self.s3_bucket_name = s3_bucket_name
-        self.bw_image_processor = self.BWImageProcessor(self.s3_client, self.sqs_queue_url, self.s3_bucket_name)
-        self.brighten_image_processor = self.BrightenImageProcessor(self.s3_client, self.sqs_queue_url,
-                                                                    self.s3_bucket_name)
+        self.image_encoder = default_image_encoder()
+        # Whole-object transfers, as a single request or in concurrent parts depending on the object's size
+        self.s3_transfer = S3Transfer(self.s3_client)
+        self.bw_image_processor = self.BWImageProcessor(self.s3_transfer, self.sqs_queue_url, self.s3_bucket_name,
+                                                        self.image_encoder)
+        self.brighten_image_processor = self.BrightenImageProcessor(self.s3_transfer, self.sqs_queue_url,
+                                                                    self.s3_bucket_name, self.image_encoder)
+        # Per-stage latencies and message counts, written as one EMF log line per invocation by close()
+        self.metrics = StageMetrics("sample-app")
+        self.task_acknowledger = TaskAcknowledger(self.sqs_client, self.sqs_queue_url, metrics=self.metrics)
+        # Tracks prefetched messages from the moment they are received, so they are heartbeated while buffered
+        self.task_receiver = TaskReceiver(self.sqs_client, self.sqs_queue_url, acknowledger=self.task_acknowledger)
+        # Shared by every processor in the container, so warm invocations skip outputs that already exist
+        self.result_cache = default_result_cache()
+        # Also container wide, so messages for the same source image reuse one download and decode
+        self.decoded_image_cache = default_decoded_image_cache()
+        # pool_size=None lets the pool size itself from the observed I/O vs CPU mix
+        self.worker_pool = WorkerPool(pool_size)
 
-    def _extract_tasks(self):
+    def _extract_tasks(self, wait_seconds=MAX_WAIT_TIME_SECONDS, deadline=None):
         try:
-            print("Extracting tasks from sqs queue - " + self.sqs_queue_url)
-            response = self.sqs_client.receive_message(QueueUrl=self.sqs_queue_url, MaxNumberOfMessages=1)
-            if "Messages" not in response:
-                print("No messages exists in SQS queue at the moment, retry later.")
+            logger.debug("Extracting tasks from sqs queue - %s", self.sqs_queue_url)
+            # Long-polled full batches are prefetched in the background; this only waits if the buffer is empty
+            with self.metrics.time("receive"):
+                response_messages = self.task_receiver.receive(timeout=wait_seconds, deadline=deadline)
+            if len(response_messages) == 0:
+                logger.info("No messages exists in SQS queue at the moment, retry later.")
                 return []
-            messages = list(map(lambda x: x["Body"], response["Messages"]))
-            print("Extracted tasks from sqs queue successfully")
-            return messages
+            logger.debug("Extracted tasks from sqs queue successfully")
+            return response_messages
         except Exception:
-            print("Failed to extract task from sqs queue - " + str(self.sqs_queue_url))
+            logger.error("Failed to extract task from sqs queue - %s", self.sqs_queue_url)
             raise
 
+    def close(self):
+        # Stop prefetching and hand any buffered messages straight back to the queue
+        self.task_receiver.stop()
+        self.task_acknowledger.close()
+        logger.info("%s", self.result_cache.summary())
+        logger.info("%s", self.decoded_image_cache.summary())
+        self.s3_transfer.close()
+        logger.info("%s", self.s3_transfer.stats.summary())
+        self.metrics.flush()
+
     @staticmethod
     def _get_name_from_key(key):
         return key.split("/")[-1]
 
-    def _download_image(self, image_key, file_path):
+    def _download_image(self, image_key, etag=None):
+        # Fetch the object straight into memory instead of going through /tmp
         try:
-            print("Downloading " + image_key + " to " + file_path)
-            self.s3_client.download_file(Bucket=self.s3_bucket_name, Key=image_key, Filename=file_path)
-            print("Downloaded " + image_key + " to " + file_path + " successfully")
+            logger.debug("Downloading %s into memory", image_key)
+            kwargs = {}
+            if etag is not None:
+                # Fail rather than transform different bytes than the ones the output keys were derived from
+                kwargs["IfMatch"] = etag
+            with self.metrics.time("download"):
+                image_data = self.s3_transfer.download(self.s3_bucket_name, image_key, **kwargs)
+            logger.debug("Downloaded %s successfully", image_key)
+            return image_data
         except Exception:
-            print("Failed to download image " + image_key + " to " + file_path)
+            logger.error("Failed to download image %s", image_key)
             raise
 
+    def _load_image(self, image_key, etag):
+        image = self.decoded_image_cache.get(self.s3_bucket_name, image_key, etag)
+        if image is not None:
+            logger.debug("Using decoded %s from memory", image_key)
+            return image
+        image_data = self._download_image(image_key, etag)
+        with self.metrics.time("decode"):
+            image = ImageEditor.decode(BytesIO(image_data))
+        self.decoded_image_cache.put(self.s3_bucket_name, image_key, etag, image)
+        return image
+
+    def _get_image_etag(self, image_key):
+        return self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=image_key)["ETag"]
+
+    def _output_exists(self, output_key):
+        if self.result_cache.contains(output_key):
+            return True
+        try:
+            self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=output_key)
+        except Exception as e:
+            if is_missing(e):
+                return False
+            raise
+        self.result_cache.add([output_key])
+        return True
+
     class BWImageProcessor:
-        def __init__(self, s3_client, sqs_queue_url, s3_bucket_name):
-            self.s3_client = s3_client
+        TRANSFORM_PARAMS = "monochrome"
+
+        def __init__(self, s3_transfer, sqs_queue_url, s3_bucket_name, image_encoder):
+            self.s3_transfer = s3_transfer
             self.sqs_queue_url = sqs_queue_url
             self.s3_bucket_name = s3_bucket_name
+            self.image_encoder = image_encoder
 
-        def _upload_file(self, filename, bucket, key):
+        def _upload_file(self, image_buffer, bucket, key):
             try:
-                print("Uploading file " + filename + " into " + bucket + " with key: " + key)
-                self.s3_client.upload_file(filename, bucket, key)
-                print("Uploaded file " + filename + " into " + bucket + " with key: " + key + " successfully")
+                logger.debug("Uploading image into %s with key: %s", bucket, key)
+                self.s3_transfer.upload(bucket, key, image_buffer.getvalue(),
+                                        ContentType=self.image_encoder.content_type)
+                logger.debug("Uploaded image into %s with key: %s successfully", bucket, key)
             except Exception:
-                print("Failed to upload file " + filename + " into " + bucket + " with key: " + key)
+                logger.error("Failed to upload image into %s with key: %s", bucket, key)
+                raise
 
-        def monochrome_and_upload(self, source_image):
-            image_name = source_image.split(".")[-2]
-            target_file_path = source_image + "-monochrome.png"
+        def output_key(self, image_name, result_fingerprint=None):
+            # Outputs without a fingerprint are not content addressed and get a unique, time based key
+            suffix = result_fingerprint or str(int(round(time.time() * 1000)))
+            return BW_FOLDER + image_name + "-monochrome-" + suffix + self.image_encoder.extension
 
-            try:
-                ImageEditor.monochrome(source_image, target_file_path)
-                self._upload_file(target_file_path, self.s3_bucket_name,
-                                  BW_FOLDER + image_name + "-monochrome-" + str(
-                                      int(round(time.time() * 1000))) + ".png")
-            except Exception:
-                raise
-            finally:
-                delete_file(target_file_path)
+        def upload(self, image_name, image_buffer, result_fingerprint=None):
+            self._upload_file(image_buffer, self.s3_bucket_name, self.output_key(image_name, result_fingerprint))
 
     class BrightenImageProcessor:
-        def __init__(self, s3_client, sqs_queue_url, s3_bucket_name):
-            self.s3_client = s3_client
+        TRANSFORM_PARAMS = "brighten-gamma-" + str(BRIGHTEN_GAMMA)
+
+        def __init__(self, s3_transfer, sqs_queue_url, s3_bucket_name, image_encoder):
+            self.s3_transfer = s3_transfer
             self.sqs_queue_url = sqs_queue_url
             self.s3_bucket_name = s3_bucket_name
+            self.image_encoder = image_encoder
 
-        def _upload_file(self, filename, bucket, key):
+        def _upload_file(self, image_buffer, bucket, key):
             try:
-                print("Uploading file " + filename + " into " + bucket + " with key: " + key)
-                self.s3_client.upload_file(filename, bucket, key)
-                print("Uploaded file " + filename + " into " + bucket + " with key: " + key + " successfully")
-            except Exception:
-                print("Failed to upload file " + filename + " into " + bucket + " with key: " + key)
-
-        def brighten_and_upload(self, source_image):
-            image_name = source_image.split(".")[-2]
-            target_file_path = source_image + "-bright.png"
-
-            try:
-                ImageEditor.brighten_image(source_image, target_file_path)
-                self._upload_file(target_file_path, self.s3_bucket_name,
-                                  BW_FOLDER + image_name + "-bright-" + str(int(round(time.time() * 1000))) + ".png")
+                logger.debug("Uploading image into %s with key: %s", bucket, key)
+                self.s3_transfer.upload(bucket, key, image_buffer.getvalue(),
+                                        ContentType=self.image_encoder.content_type)
+                logger.debug("Uploaded image into %s with key: %s successfully", bucket, key)
             except Exception:
+                logger.error("Failed to upload image into %s with key: %s", bucket, key)
                 raise
-            finally:
-                delete_file(target_file_path)
 
-    def process_image(self, messages, bw_image_processor, brighten_image_processor):
-        for image_key in messages:
-            image_name = self._get_name_from_key(image_key)
-            print("Image name: " + image_name)
-            image_name_without_file_suffix = image_name.split(".")[-2]
-            image_file_suffix = image_name.split(".")[-1]
-            temp_image_path = image_name_without_file_suffix + "-" + str(random.randrange(100000))
-            self._download_image(image_key, temp_image_path + "." + image_file_suffix)
-            bw_image_processor.monochrome_and_upload(temp_image_path + "." + image_file_suffix)
-            brighten_image_processor.brighten_and_upload(temp_image_path + "." + image_file_suffix)
-            delete_file(temp_image_path + "." + image_file_suffix)
+        def output_key(self, image_name, result_fingerprint=None):
+            suffix = result_fingerprint or str(int(round(time.time() * 1000)))
+            return BW_FOLDER + image_name + "-bright-" + suffix + self.image_encoder.extension
+
+        def upload(self, image_name, image_buffer, result_fingerprint=None):
+            self._upload_file(image_buffer, self.s3_bucket_name, self.output_key(image_name, result_fingerprint))
 
-    def concurrent_processing(self, messages, bw_image_processor, brighten_image_processor):
-        greenlets = []
-        number_of_greenlets = 2
+    def _transform_and_upload(self, image, image_name, bw_image_processor, brighten_image_processor,
+                              fingerprints=(None, None)):
+        """
+        Produce both the monochrome and the brightened output from the same decoded image, encoding each into
+        its own in-memory buffer.
+        """
+        try:
+            bw_image_buffer = BytesIO()
+            brighten_image_buffer = BytesIO()
+            timings = {}
+            ImageEditor.apply(image, [(ImageEditor.grayscale, bw_image_buffer),
+                                      (ImageEditor.brighten, brighten_image_buffer)], self.image_encoder, timings)
+            self.metrics.record_all(timings)
+            with self.metrics.time("upload"):
+                bw_image_processor.upload(image_name, bw_image_buffer, fingerprints[0])
+                brighten_image_processor.upload(image_name, brighten_image_buffer, fingerprints[1])
+        except Exception as e:
+            logger.error("Error in _transform_and_upload: %s", e)
+            raise
 
-        # Calculate the number of messages per greenlet
-        messages_per_greenlet = len(messages) // number_of_greenlets
+    def _process_image_key(self, image_key, bw_image_processor, brighten_image_processor):
+        """
+        Transform one input image, unless its outputs already exist. Output keys are derived from the source's ETag
+        and the transform parameters, so an image that was processed before (a redelivered message, or the same
+        image queued again) is recognised from a HEAD request, or from the result cache without any request, and is
+        neither downloaded nor uploaded again.
+        """
+        image_name = self._get_name_from_key(image_key)
+        image_name_without_file_suffix = image_name.split(".")[-2]
+        etag = self._get_image_etag(image_key)
+        processors = (bw_image_processor, brighten_image_processor)
+        fingerprints = tuple(fingerprint(etag, processor.TRANSFORM_PARAMS + "|" + self.image_encoder.params)
+                             for processor in processors)
+        output_keys = [processor.output_key(image_name_without_file_suffix, image_fingerprint)
+                       for processor, image_fingerprint in zip(processors, fingerprints)]
+        if all(self._output_exists(output_key) for output_key in output_keys):
+            self.result_cache.record(hit=True)
+            self.metrics.count("MessagesSkipped")
+            logger.debug("Outputs of %s already exist, skipping it", image_key)
+            return
+        self.result_cache.record(hit=False)
+        image = self._load_image(image_key, etag)
+        self._transform_and_upload(image, image_name_without_file_suffix, bw_image_processor,
+                                   brighten_image_processor, fingerprints)
+        self.result_cache.add(output_keys)
 
-        for i in range(number_of_greenlets):
-            start_idx = i * messages_per_greenlet
-            end_idx = start_idx + messages_per_greenlet
-            sub_messages = messages[start_idx:end_idx]
+    def process_image(self, messages, bw_image_processor, brighten_image_processor):
+        for image_key in messages:
+            self._process_image_key(image_key, bw_image_processor, brighten_image_processor)
 
-            greenlets.append(gevent.spawn(self.process_image, sub_messages, bw_image_processor, brighten_image_processor))
+    def _process_message(self, message, bw_image_processor, brighten_image_processor, deadline):
+        image_key = message["Body"]
+        if not deadline.has_time_for():
+            logger.warning("Not enough time left to process image %s, returning it to the queue", image_key)
+            self.task_acknowledger.nack(message)
+            return
+        started_at = time.monotonic()
+        try:
+            self.process_image([image_key], bw_image_processor, brighten_image_processor)
+        except Exception as e:
+            logger.error("Failed to process image %s, returning it to the queue: %s", image_key, e)
+            self.task_acknowledger.nack(message)
+            self.metrics.count("MessagesFailed")
+            return
+        self.task_acknowledger.ack(message)
+        self.metrics.count("MessagesProcessed")
+        self.metrics.record("message", time.monotonic() - started_at)
+        deadline.record(started_at)
 
-        gevent.joinall(greenlets)
+    def concurrent_processing(self, messages, bw_image_processor, brighten_image_processor, deadline=None):
+        deadline = deadline or InvocationDeadline()
+        # Idle greenlets pull the next message from a shared queue, so no batch size leaves messages behind
+        self.worker_pool.map(lambda message: self._process_message(message, bw_image_processor,
+                                                                   brighten_image_processor, deadline), messages)
 
-    def run(self):
+    def run(self, deadline=None):
+        deadline = deadline or InvocationDeadline()
+        messages = []
         try:
-            messages = self._extract_tasks()
+            # pool_size messages are processed at a time, so a batch takes this many message latencies
+            rounds = math.ceil(MAX_MESSAGES_PER_RECEIVE / self.worker_pool.pool_size)
+            if not deadline.has_time_for(rounds):
+                logger.info("Not enough time left in this invocation for another batch")
+                return 0
+            messages = self._extract_tasks(deadline.receive_wait_seconds(rounds), deadline)
             if len(messages) == 0:
-                return
+                return 0
             
             # Call concurrent_processing function
-            self.concurrent_processing(messages, self.bw_image_processor, self.brighten_image_processor)
+            self.concurrent_processing(messages, self.bw_image_processor, self.brighten_image_processor, deadline)
         except Exception as e:
-            print("Failed to process message from SQS queue...")
-            print(e)
+            logger.error("Failed to process message from SQS queue...: %s", e)
+        return len(messages)
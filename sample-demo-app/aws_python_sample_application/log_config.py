@@ -0,0 +1,53 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import os
+import random
+
+DEFAULT_LOG_LEVEL = "INFO"
+# boto3 and its HTTP stack log every request and response at DEBUG, which would drown the application's own lines
+LIBRARY_LOGGERS = ("boto3", "botocore", "s3transfer", "urllib3", "aiobotocore")
+DEFAULT_LIBRARY_LOG_LEVEL = "WARNING"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+
+class DebugSampler(logging.Filter):
+    """
+    Lets every record at INFO and above through, but only a random share (rate) of the DEBUG ones, so the
+    per-image debug lines can stay on under load for a fraction of their volume.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+def configure_logging(level=None, sample_rate=None):
+    """
+    Set the level of the application's log lines from DEMO_APP_LOG_LEVEL (DEBUG, INFO, WARNING, ...), that of
+    boto3 and friends from DEMO_APP_LIBRARY_LOG_LEVEL, and the share of DEBUG lines kept from
+    DEMO_APP_LOG_SAMPLE_RATE (0 to 1). The Lambda runtime already has a handler on the root logger; elsewhere one
+    writing to stderr is added. Calling it again applies the settings afresh.
+
+    Modules log through logging.getLogger(__name__) with %s arguments, so a line below the level is dropped before
+    its message is formatted.
+    """
+    level = (level or os.environ.get("DEMO_APP_LOG_LEVEL", DEFAULT_LOG_LEVEL)).upper()
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("DEMO_APP_LOG_SAMPLE_RATE", 1))
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(format=LOG_FORMAT)
+    root.setLevel(level)
+    library_level = os.environ.get("DEMO_APP_LIBRARY_LOG_LEVEL", DEFAULT_LIBRARY_LOG_LEVEL).upper()
+    for name in LIBRARY_LOGGERS:
+        logging.getLogger(name).setLevel(library_level)
+    for handler in root.handlers:
+        for sampler in [f for f in handler.filters if isinstance(f, DebugSampler)]:
+            handler.removeFilter(sampler)
+        if sample_rate < 1:
+            handler.addFilter(DebugSampler(sample_rate))
@@ -1,12 +1,25 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
+
+# gevent's monkey.patch_all() is deliberately not called here. The app is started by the CodeGuru Profiler agent,
+# whose sampler and reporter threads (and botocore, with ssl) already exist by the time this module runs, and patching
+# then leaves them half patched. Patched earlier, the sampler would become a greenlet that cannot interrupt the CPU
+# bound image work it is meant to profile. The greenlets of the worker pool therefore take turns on blocking calls.
 import os
+import signal
 import threading
 import time
 
 from image_processor import ImageProcessor
+from log_config import configure_logging
 from task_publisher import TaskPublisher
 
+# Log levels and debug sampling from the DEMO_APP_LOG_* environment variables
+configure_logging()
+
+# The app runs until it is stopped, so the stage metrics are written out every so often rather than once at the end
+METRICS_FLUSH_INTERVAL_SECONDS = 60
+
 
 def _get_environment_variable(key, example_value):
     value = os.getenv(key)
@@ -22,7 +35,11 @@ class SampleDemoApp:
         self.s3_bucket_name = _get_environment_variable(
             key="DEMO_APP_BUCKET_NAME", example_value="test-images-for-my-demo-app")
         self.task_publisher = TaskPublisher(self.sqs_queue_url, self.s3_bucket_name)
-        self.image_processor = ImageProcessor(self.sqs_queue_url, self.s3_bucket_name)
+        # Optional fixed number of greenlets; when unset the pool adapts to the I/O vs CPU mix
+        pool_size = os.getenv("DEMO_APP_POOL_SIZE")
+        self.image_processor = ImageProcessor(self.sqs_queue_url, self.s3_bucket_name,
+                                              int(pool_size) if pool_size else None)
+        self.stopping = threading.Event()
 
     def _publish_task(self):
         """
@@ -37,21 +54,42 @@ class SampleDemoApp:
 
     def _process_message(self):
         """
-        Setup a thread to process message
+        Setup a thread to process message, batch after batch until the app is stopped
         """
-        while True:
-            task_thread = threading.Thread(target=self.image_processor.run, name="task-publisher")
+        while not self.stopping.is_set():
+            task_thread = threading.Thread(target=self.image_processor.run, name="task-processor")
             task_thread.start()
             task_thread.join()
 
+    def _flush_metrics(self):
+        """
+        Setup a thread to write the stage metrics as an EMF line every METRICS_FLUSH_INTERVAL_SECONDS
+        """
+        while not self.stopping.wait(METRICS_FLUSH_INTERVAL_SECONDS):
+            self.image_processor.metrics.flush()
+
+    def stop(self, *_):
+        # The batch in progress is finished before the processor is closed
+        self.stopping.set()
+
     def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
         # Publisher
-        task_publisher_thread = threading.Thread(target=self._publish_task, name="task_publisher_scheduler")
+        task_publisher_thread = threading.Thread(target=self._publish_task, name="task_publisher_scheduler",
+                                                 daemon=True)
         task_publisher_thread.start()
 
-        # Listener
-        task_processor_thread = threading.Thread(target=self._process_message(), name="task_processor_thread")
-        task_processor_thread.start()
+        # Metrics
+        threading.Thread(target=self._flush_metrics, name="metrics_flusher", daemon=True).start()
+
+        # Listener, on the main thread until stopped; closing settles the acknowledgements, hands back prefetched
+        # messages, logs the cache and transfer summaries and flushes the last metrics
+        try:
+            self._process_message()
+        finally:
+            self.image_processor.close()
 
 
 if __name__ == '__main__':
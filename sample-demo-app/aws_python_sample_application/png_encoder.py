@@ -0,0 +1,107 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG colour type for each number of 8-bit channels: grey, grey + alpha, RGB, RGBA
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+DEFAULT_COMPRESSION_LEVEL = 6
+# Compressed data is written out in IDAT chunks of about this size
+IDAT_CHUNK_SIZE = 64 * 1024
+
+FILTER_NONE, FILTER_SUB, FILTER_UP, FILTER_AVERAGE, FILTER_PAETH = range(5)
+
+
+def _chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def _filter_rows(rows, previous_row, bytes_per_pixel):
+    """
+    Filter each row of rows (height x row bytes, uint8) with whichever of the five PNG filters gives the smallest
+    sum of absolute values, the heuristic the PNG specification recommends, and return the rows with their filter
+    type byte prepended. The filters only look at the unfiltered neighbours, so a whole strip is filtered at once.
+    """
+    above = np.vstack((previous_row[np.newaxis], rows[:-1]))
+    left = np.zeros_like(rows)
+    left[:, bytes_per_pixel:] = rows[:, :-bytes_per_pixel]
+    upper_left = np.zeros_like(above)
+    upper_left[:, bytes_per_pixel:] = above[:, :-bytes_per_pixel]
+
+    # Paeth predictor: whichever neighbour is closest to left + above - upper left
+    above_step = np.subtract(above, upper_left, dtype=np.int16)
+    left_step = np.subtract(left, upper_left, dtype=np.int16)
+    distance_left = np.abs(above_step)
+    distance_above = np.abs(left_step)
+    distance_upper_left = np.abs(above_step + left_step)
+    paeth = np.where(distance_above <= distance_upper_left, above, upper_left)
+    np.copyto(paeth, left, where=(distance_left <= distance_above) & (distance_left <= distance_upper_left))
+    average = (np.add(left, above, dtype=np.uint16) >> 1).astype(np.uint8)
+    del above_step, left_step, distance_left, distance_above, distance_upper_left
+
+    filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    best_scores = None
+    for filter_type, predictor in ((FILTER_NONE, None), (FILTER_SUB, left), (FILTER_UP, above),
+                                   (FILTER_AVERAGE, average), (FILTER_PAETH, paeth)):
+        candidate = rows if predictor is None else rows - predictor
+        # Absolute value of each byte read as an int8, the smaller of the byte and its negation modulo 256
+        scores = np.minimum(candidate, -candidate).sum(axis=1, dtype=np.uint32)
+        better = slice(None) if best_scores is None else scores < best_scores
+        best_scores = scores if best_scores is None else np.minimum(scores, best_scores)
+        filtered[better, 0] = filter_type
+        filtered[better, 1:] = candidate[better]
+    return filtered
+
+
+class StreamingPngEncoder:
+    """
+    Writes an 8-bit PNG to target, a file-like object, a strip of rows at a time. Each strip is filtered and
+    compressed as it arrives and complete IDAT chunks are written straight away, so the encoder holds one strip
+    and the compressor's window at most, however tall the image is.
+    """
+
+    def __init__(self, target, width, height, channels, level=DEFAULT_COMPRESSION_LEVEL):
+        self.target = target
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows_written = 0
+        self.previous_row = np.zeros(width * channels, dtype=np.uint8)
+        self.compressor = zlib.compressobj(level)
+        self.pending = []
+        self.pending_size = 0
+        header = struct.pack(">IIBBBBB", width, height, 8, COLOR_TYPES[channels], 0, 0, 0)
+        target.write(PNG_SIGNATURE + _chunk(b"IHDR", header))
+
+    def _write_compressed(self, data, final=False):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= IDAT_CHUNK_SIZE or (final and self.pending_size):
+            self.target.write(_chunk(b"IDAT", b"".join(self.pending)))
+            self.pending = []
+            self.pending_size = 0
+
+    def write_rows(self, rows):
+        """
+        Append rows, a uint8 array of shape (rows, width) or (rows, width, channels), to the image.
+        """
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape(len(rows), self.width * self.channels)
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError("More rows written than the image has")
+        if len(rows) == 0:
+            return
+        filtered = _filter_rows(rows, self.previous_row, self.channels)
+        self.previous_row = rows[-1].copy()
+        self.rows_written += len(rows)
+        self._write_compressed(self.compressor.compress(filtered.tobytes()))
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError("Image has " + str(self.height) + " rows, " + str(self.rows_written) + " were written")
+        self._write_compressed(self.compressor.flush(), final=True)
+        self.target.write(_chunk(b"IEND", b""))
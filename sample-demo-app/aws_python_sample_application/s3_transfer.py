@@ -0,0 +1,145 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MiB = 1024 * 1024
+# Uploads of at least this many bytes are sent as a multipart upload
+DEFAULT_MULTIPART_THRESHOLD = 16 * MiB
+# Size of each upload part and of each range request of a download; S3 parts must be at least 5 MiB
+DEFAULT_PART_SIZE = 8 * MiB
+# Parts (or ranges) of one object transferred at the same time
+DEFAULT_MAX_CONCURRENCY = 8
+
+TRANSFER_CONFIG = dict(
+    multipart_threshold=int(os.environ.get("DEMO_APP_MULTIPART_THRESHOLD", DEFAULT_MULTIPART_THRESHOLD)),
+    part_size=max(5 * MiB, int(os.environ.get("DEMO_APP_TRANSFER_PART_SIZE", DEFAULT_PART_SIZE))),
+    max_concurrency=int(os.environ.get("DEMO_APP_TRANSFER_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+)
+
+
+def part_ranges(size, part_size, start=0):
+    """
+    Split bytes start..size-1 into (first byte, last byte) ranges of at most part_size bytes.
+    """
+    return [(offset, min(offset + part_size, size) - 1) for offset in range(start, size, part_size)]
+
+
+def object_size(response):
+    # A range response carries the full size after the slash, e.g. "bytes 0-8388607/52428800"
+    content_range = response.get("ContentRange")
+    if content_range:
+        return int(content_range.rsplit("/", 1)[1])
+    return response.get("ContentLength")
+
+
+class TransferStats:
+    """
+    Bytes moved and time spent per direction and per transfer mode, so thresholds, part size and concurrency can
+    be tuned against the throughput they actually give.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def record(self, direction, mode, size, seconds):
+        with self.lock:
+            count, total_size, total_seconds = self.totals.get((direction, mode), (0, 0, 0.0))
+            self.totals[(direction, mode)] = (count + 1, total_size + size, total_seconds + seconds)
+
+    def summary(self):
+        with self.lock:
+            totals = sorted(self.totals.items())
+        lines = []
+        for (direction, mode), (count, size, seconds) in totals:
+            rate = size / seconds / MiB if seconds else 0
+            lines.append("S3 " + direction + " (" + mode + "): " + str(count) + " objects, " +
+                         "%.1f MiB at %.1f MiB/s" % (size / MiB, rate))
+        return "\n".join(lines) or "S3 transfers: none"
+
+
+_default_transfer_stats = TransferStats()
+
+
+def default_transfer_stats():
+    # Kept for the life of the container, so the figures cover every invocation it served
+    return _default_transfer_stats
+
+
+class S3Transfer:
+    """
+    Moves whole objects between S3 and memory, choosing how by object size. Uploads below multipart_threshold
+    are a single PutObject, larger ones a multipart upload whose parts are sent max_concurrency at a time.
+    Downloads start with one ranged GetObject of part_size bytes, which is the whole transfer for most images;
+    if the object turns out to be larger, the remaining ranges are fetched max_concurrency at a time.
+
+    Each transfer is recorded in stats by direction and mode, for the bytes/second figures in stats.summary().
+    """
+
+    def __init__(self, s3_client, multipart_threshold=None, part_size=None, max_concurrency=None, stats=None):
+        self.s3_client = s3_client
+        self.multipart_threshold = multipart_threshold or TRANSFER_CONFIG["multipart_threshold"]
+        self.part_size = part_size or TRANSFER_CONFIG["part_size"]
+        self.max_concurrency = max_concurrency or TRANSFER_CONFIG["max_concurrency"]
+        self.stats = stats or default_transfer_stats()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="s3-transfer")
+
+    def _get_range(self, bucket, key, first_byte, last_byte, get_kwargs):
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, Range="bytes=%d-%d" % (first_byte, last_byte),
+                                             **get_kwargs)
+        return response, response["Body"].read()
+
+    def download(self, bucket, key, **get_kwargs):
+        """
+        Return the object's bytes. get_kwargs (e.g. IfMatch) are passed on to every GetObject request, so all
+        ranges come from the same version of the object.
+        """
+        started_at = time.monotonic()
+        response, data = self._get_range(bucket, key, 0, self.part_size - 1, get_kwargs)
+        size = object_size(response)
+        if size is None or len(data) >= size:
+            self.stats.record("download", "single", len(data), time.monotonic() - started_at)
+            return data
+
+        remaining = part_ranges(size, self.part_size, start=len(data))
+        parts = self.executor.map(lambda byte_range: self._get_range(bucket, key, *byte_range, get_kwargs)[1],
+                                  remaining)
+        data = b"".join([data, *parts])
+        self.stats.record("download", "ranged", len(data), time.monotonic() - started_at)
+        return data
+
+    def _upload_part(self, bucket, key, upload_id, part_number, body, first_byte, last_byte):
+        response = self.s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                              Body=body[first_byte:last_byte + 1])
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def upload(self, bucket, key, body, **put_kwargs):
+        """
+        Store body (bytes) under key. put_kwargs (e.g. ContentType) apply to the object as a whole.
+        """
+        started_at = time.monotonic()
+        if len(body) < self.multipart_threshold:
+            self.s3_client.put_object(Body=body, Bucket=bucket, Key=key, **put_kwargs)
+            self.stats.record("upload", "single", len(body), time.monotonic() - started_at)
+            return
+
+        upload_id = self.s3_client.create_multipart_upload(Bucket=bucket, Key=key, **put_kwargs)["UploadId"]
+        try:
+            parts = list(self.executor.map(
+                lambda numbered_range: self._upload_part(bucket, key, upload_id, numbered_range[0], body,
+                                                         *numbered_range[1]),
+                enumerate(part_ranges(len(body), self.part_size), start=1)))
+            self.s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                     MultipartUpload={"Parts": parts})
+        except Exception:
+            # Parts of an unfinished upload are stored (and billed) until the upload is aborted
+            self.s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+        self.stats.record("upload", "multipart", len(body), time.monotonic() - started_at)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
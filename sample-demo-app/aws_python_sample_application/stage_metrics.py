@@ -0,0 +1,129 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_NAMESPACE = "ImageProcessorDemoApp"
+# Each histogram bucket is this much wider than the one below it, so a latency reported as its bucket's midpoint is
+# off by at most about 12%, and 0.01 ms to 10 minutes fits in the 100 values an EMF metric may carry
+BUCKET_GROWTH = 1.25
+_LOG_GROWTH = math.log(BUCKET_GROWTH)
+MIN_MILLISECONDS = 0.01
+
+
+class Histogram:
+    """
+    Counts of values (milliseconds) per exponentially sized bucket, plus their exact count, sum, min and max.
+    Recording a value is a logarithm and a dictionary update, however many values there are.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, value):
+        index = math.floor(math.log(max(value, MIN_MILLISECONDS)) / _LOG_GROWTH)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @staticmethod
+    def _midpoint(index):
+        return BUCKET_GROWTH ** (index + 0.5)
+
+    def to_emf(self):
+        # EMF's histogram form: distinct values with how often each occurred, and the exact statistics
+        indexes = sorted(self.buckets)
+        return {"Values": [round(self._midpoint(index), 3) for index in indexes],
+                "Counts": [self.buckets[index] for index in indexes],
+                "Min": round(self.min, 3), "Max": round(self.max, 3), "Count": self.count, "Sum": round(self.sum, 3)}
+
+
+class StageMetrics:
+    """
+    Where the time of an invocation goes: a latency histogram per stage of a message (receive, download, decode,
+    transform, encode, upload, ack, and the message as a whole) and counters of processed, skipped and failed
+    messages. Everything is kept in memory and flush() writes it as one CloudWatch Embedded Metric Format line, which
+    CloudWatch turns into metrics from the function's logs, so measuring costs no PutMetricData calls.
+
+    Safe to record from the processing threads (or greenlets) and the acknowledger thread at the same time.
+    """
+
+    def __init__(self, implementation, namespace=None, emit=print):
+        self.implementation = implementation
+        self.namespace = namespace or os.environ.get("DEMO_APP_METRICS_NAMESPACE", DEFAULT_NAMESPACE)
+        self.emit = emit
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.record(seconds * 1000)
+
+    def record_all(self, timings):
+        """
+        Record a {stage: seconds} dict, as filled in by ImageEditor.apply.
+        """
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+
+    @contextmanager
+    def time(self, stage):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started_at)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @staticmethod
+    def metric_name(stage):
+        return stage.capitalize() + "Time"
+
+    def _document(self, histograms, counters, timestamp):
+        metrics = [{"Name": self.metric_name(stage), "Unit": "Milliseconds"} for stage in sorted(histograms)]
+        metrics += [{"Name": name, "Unit": "Count"} for name in sorted(counters)]
+        document = {
+            "_aws": {
+                "Timestamp": int((time.time() if timestamp is None else timestamp) * 1000),
+                "CloudWatchMetrics": [{"Namespace": self.namespace, "Dimensions": [["Implementation"]],
+                                       "Metrics": metrics}],
+            },
+            "Implementation": self.implementation,
+        }
+        for stage, histogram in histograms.items():
+            document[self.metric_name(stage)] = histogram.to_emf()
+        document.update(counters)
+        return document
+
+    def to_emf(self, timestamp=None):
+        with self.lock:
+            return self._document(self.histograms, self.counters, timestamp)
+
+    def flush(self):
+        """
+        Emit everything recorded since the last flush as one EMF line and start over. Nothing is emitted if
+        nothing was recorded.
+        """
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+            counters, self.counters = self.counters, {}
+        if histograms or counters:
+            self.emit(json.dumps(self._document(histograms, counters, None), separators=(",", ":")))
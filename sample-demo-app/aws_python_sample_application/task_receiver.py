@@ -0,0 +1,321 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# SQS returns at most 10 messages per ReceiveMessage call and long polls for at most 20 seconds
+MAX_MESSAGES_PER_RECEIVE = 10
+MAX_WAIT_TIME_SECONDS = 20
+# SQS default for new queues; requested explicitly on every receive so the heartbeat below knows what it is extending
+DEFAULT_VISIBILITY_TIMEOUT = 30
+# How long an acknowledgement may wait for a full DeleteMessageBatch before it is sent anyway
+DEFAULT_FLUSH_INTERVAL_SECONDS = 1
+
+DEFAULT_CONCURRENT_RECEIVES = 2
+DEFAULT_PREFETCH_SIZE = DEFAULT_CONCURRENT_RECEIVES * MAX_MESSAGES_PER_RECEIVE
+
+
+def _batches(messages):
+    for start in range(0, len(messages), MAX_MESSAGES_PER_RECEIVE):
+        yield messages[start:start + MAX_MESSAGES_PER_RECEIVE]
+
+
+def _report_failures(response, action):
+    for failure in response.get("Failed", []):
+        logger.warning("Failed to %s message %s: %s", action, failure["Id"], failure.get("Message", failure["Code"]))
+
+
+def change_visibility(sqs_client, sqs_queue_url, messages, visibility_timeout):
+    """
+    Set the visibility timeout of messages, ten per ChangeMessageVisibilityBatch call. A timeout of 0 hands them
+    back to the queue right away.
+    """
+    for batch in _batches(messages):
+        entries = [{"Id": str(i), "ReceiptHandle": message["ReceiptHandle"], "VisibilityTimeout": visibility_timeout}
+                   for i, message in enumerate(batch)]
+        try:
+            response = sqs_client.change_message_visibility_batch(QueueUrl=sqs_queue_url, Entries=entries)
+            _report_failures(response, "change visibility of")
+        except Exception as e:
+            logger.error("Failed to change visibility of %d messages in sqs queue: %s", len(batch), e)
+
+
+def delete_messages(sqs_client, sqs_queue_url, messages):
+    for batch in _batches(messages):
+        entries = [{"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]} for i, message in enumerate(batch)]
+        try:
+            response = sqs_client.delete_message_batch(QueueUrl=sqs_queue_url, Entries=entries)
+            _report_failures(response, "delete")
+        except Exception as e:
+            logger.error("Failed to delete %d messages from sqs queue: %s", len(batch), e)
+
+
+class TaskReceiver:
+    """
+    Prefetches SQS messages for the processing stage. A few poller threads each keep one long-polling
+    ReceiveMessage call for a full batch in flight and push what they get into a bounded local buffer, and
+    receive() hands out batches from that buffer. Empty queues therefore cost one API call per
+    wait_time_seconds per poller instead of a tight loop of empty receives, and the processing stage does not
+    wait on a receive round trip between batches.
+
+    A poller only starts a receive when the buffer has room for a full batch on top of the batches already in
+    flight, so buffered plus in-flight messages never exceed prefetch_size. Once a receive() has waited out its
+    timeout on an empty buffer the queue is drained, and the pollers start no new long polls until the next
+    receive(). Messages still buffered when the receiver is stopped are made visible again right away; stop()
+    does not wait for the receives in flight, which hand back whatever they get when they return.
+
+    Buffered messages wait behind the batch being processed. With an acknowledger (a TaskAcknowledger) they are
+    tracked as soon as they are received, so its heartbeat keeps them invisible while they wait; without one, a
+    message that waited out its visibility timeout is dropped instead of handed out with a stale receipt handle.
+    With a deadline (an InvocationDeadline, passed to receive()) the long polls are no longer than the time left
+    for processing what they return, and polling stops when no batch fits any more.
+    """
+
+    def __init__(self, sqs_client, sqs_queue_url, concurrent_receives=DEFAULT_CONCURRENT_RECEIVES,
+                 prefetch_size=DEFAULT_PREFETCH_SIZE, wait_time_seconds=MAX_WAIT_TIME_SECONDS,
+                 visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, acknowledger=None):
+        self.sqs_client = sqs_client
+        self.sqs_queue_url = sqs_queue_url
+        self.concurrent_receives = concurrent_receives
+        self.prefetch_size = max(prefetch_size, MAX_MESSAGES_PER_RECEIVE)
+        self.wait_time_seconds = wait_time_seconds
+        self.visibility_timeout = visibility_timeout
+        self.acknowledger = acknowledger
+        self.deadline = None
+        # (monotonic time of the receive, message)
+        self.buffer = collections.deque()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+        # Set when a receive() found the queue drained, until the next one
+        self.idle = False
+        self.pollers = []
+
+    def start(self):
+        if self.pollers:
+            return
+        for i in range(self.concurrent_receives):
+            poller = threading.Thread(target=self._poll, name="task-receiver-" + str(i), daemon=True)
+            poller.start()
+            self.pollers.append(poller)
+
+    def _reserve(self):
+        with self.condition:
+            while not self.stopped and (self.idle or
+                                        len(self.buffer) + self.in_flight + MAX_MESSAGES_PER_RECEIVE >
+                                        self.prefetch_size):
+                self.condition.wait()
+            if self.stopped:
+                return False
+            self.in_flight += MAX_MESSAGES_PER_RECEIVE
+            return True
+
+    def _poll_wait_seconds(self):
+        """
+        How long the next receive may long poll, or None when the deadline leaves no time for another batch. A
+        prefetched batch is processed after the one in hand, so it needs time for a full batch after the wait.
+        """
+        deadline = self.deadline
+        if deadline is None:
+            return self.wait_time_seconds
+        # A zero wait would turn polling into a loop of short polls for the last moments of the invocation
+        return min(self.wait_time_seconds, deadline.receive_wait_seconds(MAX_MESSAGES_PER_RECEIVE)) or None
+
+    def _poll(self):
+        while self._reserve():
+            wait_seconds = self._poll_wait_seconds()
+            if wait_seconds is None:
+                with self.condition:
+                    self.in_flight -= MAX_MESSAGES_PER_RECEIVE
+                    self.condition.notify_all()
+                logger.debug("Not enough time left in this invocation to prefetch another batch")
+                return
+            messages = []
+            try:
+                response = self.sqs_client.receive_message(QueueUrl=self.sqs_queue_url,
+                                                           MaxNumberOfMessages=MAX_MESSAGES_PER_RECEIVE,
+                                                           WaitTimeSeconds=wait_seconds,
+                                                           VisibilityTimeout=self.visibility_timeout)
+                messages = response.get("Messages", [])
+                if messages and self.acknowledger is not None:
+                    # Before they can be handed out, so an early ack is not followed by a stale heartbeat entry
+                    self.acknowledger.track(messages)
+            except Exception as e:
+                logger.error("Failed to receive messages from sqs queue - %s: %s", self.sqs_queue_url, e)
+            finally:
+                received_at = time.monotonic()
+                with self.condition:
+                    self.in_flight -= MAX_MESSAGES_PER_RECEIVE
+                    stopped = self.stopped
+                    if not stopped:
+                        self.buffer.extend((received_at, message) for message in messages)
+                    self.condition.notify_all()
+
+            if stopped:
+                # Stopped while this receive was in flight; nobody is going to process these messages
+                self._hand_back(messages)
+
+    def _hand_back(self, messages):
+        if self.acknowledger is None:
+            self.release(messages)
+            return
+        # The acknowledger stops heartbeating them and releases them on its next flush, or when it is closed
+        for message in messages:
+            self.acknowledger.nack(message)
+
+    def receive(self, max_messages=MAX_MESSAGES_PER_RECEIVE, timeout=MAX_WAIT_TIME_SECONDS, deadline=None):
+        """
+        Return up to max_messages buffered messages, waiting at most timeout seconds for the first one.
+        An empty list means the queue stayed empty for the whole wait, and the pollers stop long polling until
+        receive() is called again. A deadline (an InvocationDeadline) bounds the long polls of the pollers from
+        then on.
+        """
+        if deadline is not None:
+            self.deadline = deadline
+        self.start()
+        with self.condition:
+            self.idle = False
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: self.buffer or self.stopped, timeout)
+            # Nothing arrived for a whole wait; another round of long polls would most likely only keep an idle
+            # invocation running, or be left in flight when it ends
+            self.idle = not self.buffer
+            messages = []
+            expired = []
+            now = time.monotonic()
+            while self.buffer and len(messages) < max_messages:
+                received_at, message = self.buffer.popleft()
+                if self.acknowledger is None and now - received_at >= self.visibility_timeout:
+                    expired.append(message)
+                else:
+                    messages.append(message)
+            # Room was freed up for the pollers
+            self.condition.notify_all()
+        if expired:
+            # Already visible again and possibly redelivered; a delete with the old receipt handle could fail or
+            # remove another consumer's delivery
+            logger.warning("Dropping %d messages that waited out their visibility timeout in the buffer",
+                           len(expired))
+        return messages
+
+    def release(self, messages):
+        """
+        Make messages that will not be processed visible again immediately instead of after their visibility
+        timeout.
+        """
+        change_visibility(self.sqs_client, self.sqs_queue_url, messages, 0)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            buffered = [message for _, message in self.buffer]
+            self.buffer.clear()
+            self.condition.notify_all()
+        # A receive still in flight is not waited for: it can take up to wait_time_seconds, billed but idle. It
+        # hands back what it gets as soon as it returns, or when a frozen container is thawed
+        self._hand_back(buffered)
+
+
+class TaskAcknowledger:
+    """
+    Settles received messages with as few SQS calls as possible. Processed messages are acknowledged with
+    DeleteMessageBatch once ten of them are pending or flush_interval has passed, failed messages are handed back
+    to the queue on the next flush instead of after their visibility timeout, and a heartbeat extends the
+    visibility of messages that are still being processed a third of the way into their timeout so slow images
+    are not redelivered to another consumer.
+
+    ack() and nack() only record the message; all SQS calls are made from one background thread. With metrics
+    (a StageMetrics), the time each DeleteMessageBatch round takes is recorded as the ack stage.
+    """
+
+    def __init__(self, sqs_client, sqs_queue_url, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL_SECONDS, metrics=None):
+        self.sqs_client = sqs_client
+        self.sqs_queue_url = sqs_queue_url
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = visibility_timeout / 3
+        self.flush_interval = min(flush_interval, self.heartbeat_interval)
+        self.metrics = metrics
+        # Receipt handle -> [message, monotonic time of the next visibility extension]
+        self.in_progress = {}
+        self.pending_deletes = []
+        self.pending_releases = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.flusher = None
+
+    def start(self):
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_periodically, name="task-acknowledger", daemon=True)
+            self.flusher.start()
+
+    def track(self, messages):
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        with self.condition:
+            for message in messages:
+                self.in_progress[message["ReceiptHandle"]] = [message, next_heartbeat]
+        self.start()
+
+    def ack(self, message):
+        with self.condition:
+            self.in_progress.pop(message["ReceiptHandle"], None)
+            self.pending_deletes.append(message)
+            if len(self.pending_deletes) >= MAX_MESSAGES_PER_RECEIVE:
+                self.condition.notify_all()
+
+    def nack(self, message):
+        with self.condition:
+            self.in_progress.pop(message["ReceiptHandle"], None)
+            self.pending_releases.append(message)
+            self.condition.notify_all()
+
+    def _take_due(self, now):
+        deletes, self.pending_deletes = self.pending_deletes, []
+        releases, self.pending_releases = self.pending_releases, []
+        extensions = []
+        for entry in self.in_progress.values():
+            if entry[1] <= now:
+                extensions.append(entry[0])
+                entry[1] = now + self.heartbeat_interval
+        return deletes, releases, extensions
+
+    def _settle(self, deletes, releases, extensions):
+        if deletes and self.metrics is not None:
+            with self.metrics.time("ack"):
+                delete_messages(self.sqs_client, self.sqs_queue_url, deletes)
+        else:
+            delete_messages(self.sqs_client, self.sqs_queue_url, deletes)
+        change_visibility(self.sqs_client, self.sqs_queue_url, releases, 0)
+        change_visibility(self.sqs_client, self.sqs_queue_url, extensions, self.visibility_timeout)
+
+    def _flush_periodically(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self.pending_releases or
+                                        len(self.pending_deletes) >= MAX_MESSAGES_PER_RECEIVE, self.flush_interval)
+                if self.stopped:
+                    return
+                due = self._take_due(time.monotonic())
+            self._settle(*due)
+
+    def close(self):
+        """
+        Send the pending acknowledgements and hand back any message that was tracked but never settled.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        with self.condition:
+            deletes, releases, _ = self._take_due(time.monotonic())
+            releases.extend(message for message, _ in self.in_progress.values())
+            self.in_progress.clear()
+            self.stopped = False
+        self._settle(deletes, releases, [])
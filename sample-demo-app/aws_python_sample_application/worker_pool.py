@@ -0,0 +1,68 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import math
+import time
+
+import gevent
+from gevent.queue import Queue, Empty
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+MAX_POOL_SIZE = 32
+# Share of a batch's wall time spent on CPU below which the hub was mostly waiting on sockets
+LOW_CPU_UTILISATION = 0.75
+# Share above which the batch was CPU bound and extra greenlets only hold more images in memory
+HIGH_CPU_UTILISATION = 0.95
+
+
+class WorkerPool:
+    """
+    Work-queue scheduler for greenlets. Every message of a batch goes onto one shared queue and each worker pulls
+    the next message as soon as it is idle, so batches of any size (including a single message) are processed in
+    full, with at most pool_size messages in flight.
+
+    When no pool_size is given the pool adapts between batches: if the batch left the CPU idle while greenlets
+    were blocked on I/O it grows, and if the batch was CPU bound it shrinks again.
+    """
+
+    def __init__(self, pool_size=None, max_pool_size=MAX_POOL_SIZE):
+        self.adaptive = pool_size is None
+        self.max_pool_size = max_pool_size
+        self.pool_size = min(pool_size or DEFAULT_POOL_SIZE, max_pool_size)
+
+    @staticmethod
+    def _worker(tasks, handler):
+        while True:
+            try:
+                message = tasks.get_nowait()
+            except Empty:
+                return
+            try:
+                handler(message)
+            except Exception as e:
+                logger.error("Worker failed to process message %s: %s", message, e)
+
+    def _adapt(self, workers, cpu_seconds, wall_seconds):
+        if not self.adaptive or wall_seconds <= 0:
+            return
+        utilisation = cpu_seconds / wall_seconds
+        if utilisation < LOW_CPU_UTILISATION:
+            # Every greenlet was waiting on I/O for part of the batch; enough extra greenlets keep the CPU busy
+            self.pool_size = min(self.max_pool_size,
+                                 max(self.pool_size, math.ceil(workers / max(utilisation, 0.1))))
+        elif utilisation > HIGH_CPU_UTILISATION:
+            self.pool_size = max(1, min(self.pool_size, workers) - 1)
+
+    def map(self, handler, messages):
+        tasks = Queue()
+        for message in messages:
+            tasks.put(message)
+
+        number_of_workers = min(len(messages), self.pool_size)
+        start_cpu, start_wall = time.process_time(), time.perf_counter()
+        greenlets = [gevent.spawn(self._worker, tasks, handler) for _ in range(number_of_workers)]
+        gevent.joinall(greenlets)
+        self._adapt(number_of_workers, time.process_time() - start_cpu, time.perf_counter() - start_wall)
@@ -0,0 +1,95 @@
+"""
+Times the CPU-intensive part of lambda_handler, counting the primes among num random values below num, with the
+trial division the handler used before and with each mode of primes.py, e.g.
+
+    python benchmarks/primes_benchmark.py --content-lengths 10000,50000,200000 --runs 5
+
+Every mode gets the same candidates, drawn with randrange as in the handler, and must find the same count. The
+sieve is dropped before every run, so each time includes building it, as on a cold start.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from random import Random
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+import primes  # noqa: E402
+
+
+def check_prime(num):
+    # lambda_handler's primality test before primes.py
+    if num == 1 or num == 0:
+        return False
+    sq_root = 2
+    while sq_root * sq_root <= num:
+        if num % sq_root == 0:
+            return False
+        sq_root += 1
+    return True
+
+
+def trial_division(candidates):
+    count = 0
+    for x in candidates:
+        if check_prime(x):
+            count += 1
+    return count
+
+
+MODES = {
+    'trial-division': trial_division,
+    'python-batch': primes.count_primes_python,
+}
+if primes.np is not None:
+    MODES['numpy-batch'] = primes.count_primes
+
+
+def time_mode(count_function, candidates, runs):
+    seconds = []
+    for _ in range(runs):
+        primes._sieve_flags = bytearray()
+        started_at = time.perf_counter()
+        count = count_function(candidates)
+        seconds.append(time.perf_counter() - started_at)
+    return count, min(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--content-lengths', default='10000,50000',
+                        help='comma separated response sizes, the bound of num in the handler')
+    parser.add_argument('--runs', type=int, default=3, help='timed runs per mode, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    for content_length in [int(value) for value in args.content_lengths.split(',')]:
+        random = Random(args.seed)
+        num = random.randrange(content_length)
+        candidates = [random.randrange(num) for _ in range(num)]
+        timings = {mode: time_mode(count_function, candidates, args.runs) for mode, count_function in MODES.items()}
+        counts = {count for count, _ in timings.values()}
+        if len(counts) != 1:
+            raise AssertionError('modes disagree on the count: {}'.format(timings))
+        baseline = timings['trial-division'][1]
+        for mode, (count, seconds) in timings.items():
+            results.append({'content_length': content_length, 'candidates': num, 'mode': mode, 'count': count,
+                            'seconds': seconds, 'speedup': baseline / seconds if seconds else None})
+
+    print('{:>14} {:>10} {:>15} {:>8} {:>10} {:>8}'.format(
+        'content length', 'candidates', 'mode', 'count', 'ms', 'speedup'))
+    for result in results:
+        print('{content_length:>14} {candidates:>10} {mode:>15} {count:>8} {:>10.2f} {:>7.1f}x'.format(
+            result['seconds'] * 1000, result['speedup'] or 0, **result))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'config': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
-import boto3
 import logging
 import os
 
 from random import randrange
-from urllib.request import urlopen
+
+from metrics_buffer import MetricsBuffer
+from primes import count_primes
+from site_cache import SiteCache
 
 # It is not recommended to enable DEBUG logs in production,
 # this is just to show an example of a recommendation
@@ -14,43 +16,28 @@ SITE = 'http://www.python.org/'
 CW_NAMESPACE = 'ProfilerPythonDemo'
 S3_BUCKET = os.environ['S3_BUCKET']
 
+# Kept while the container is warm, so later invocations send conditional requests
+site = SiteCache(SITE, S3_BUCKET, 'response.txt')
+
 
 def lambda_handler(event, context):
-    # Make some network calls using urllib and s3 client.
-    with urlopen(SITE) as response:
-        s3_client = boto3.client('s3')
-        s3_client.put_object(Body=response.read(),
-                             Bucket=S3_BUCKET,
-                             Key='response.txt')
-
-    # Publish metrics.
-    content_length = int(response.headers['Content-Length'])
-    put_metric('ResponseContentLength', content_length)
-    put_metric(str(response.status)[0] + 'xxStatus', 1)
+    # Make some network calls using urllib and s3 client,
+    # uploading the response only when it changed.
+    response = site.fetch()
+
+    # Publish metrics, in the background while the CPU-intensive work runs
+    # (or as EMF log lines when METRICS_MODE is emf).
+    content_length = response.content_length
+    metrics = MetricsBuffer(CW_NAMESPACE)
+    metrics.put('ResponseContentLength', content_length)
+    # A 304 revalidates the last response, and is counted with that response's status
+    metrics.put(str(response.status)[0] + 'xxStatus', 1)
+    metrics.flush()
 
     # Generate some CPU-intensive work.
     num = randrange(content_length)
-    count = 0
-    for _ in range(num):
-        x = randrange(num)
-        if check_prime(x):
-            count += 1
+    count = count_primes([randrange(num) for _ in range(num)])
 
+    # Nothing may still be running once the handler returns and the container is frozen.
+    metrics.wait()
     return count
-
-
-def put_metric(name, value):
-    cw_client = boto3.client('cloudwatch')
-    metric_data_num = [{'MetricName': name, 'Value': value}]
-    cw_client.put_metric_data(Namespace=CW_NAMESPACE, MetricData=metric_data_num)
-
-
-def check_prime(num):
-    if num == 1 or num == 0:
-        return False
-    sq_root = 2
-    while sq_root * sq_root <= num:
-        if num % sq_root == 0:
-            return False
-        sq_root += 1
-    return True
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import boto3
+
+# PutMetricData accepts up to 1000 metrics per call
+MAX_METRICS_PER_CALL = 1000
+# An EMF document declares at most 100 metrics, and each of them carries at most 100 distinct values
+MAX_EMF_METRICS = 100
+MAX_EMF_VALUES = 100
+# 'api' publishes with PutMetricData, 'emf' writes Embedded Metric Format lines to stdout instead
+DEFAULT_MODE = 'api'
+
+logger = logging.getLogger(__name__)
+
+_cloudwatch_client = None
+
+
+def cloudwatch_client():
+    # One client per container, created on first use and reused by every invocation after it
+    global _cloudwatch_client
+    if _cloudwatch_client is None:
+        _cloudwatch_client = boto3.client('cloudwatch')
+    return _cloudwatch_client
+
+
+class MetricsBuffer:
+    """
+    Collects metric values during an invocation and publishes them together. Values of the same metric (name,
+    unit and dimensions) are aggregated, as a statistic set for PutMetricData and as distinct values with their
+    counts for EMF, so repeating a value does not add to what is published.
+
+    In 'api' mode flush() sends everything in as few PutMetricData calls as the API allows, on a background thread,
+    and wait() blocks until they are done; start the flush as soon as the metrics are known and wait just before
+    the handler returns, so the calls overlap the rest of the work and none is left running in a frozen container.
+    In 'emf' mode flush() writes Embedded Metric Format lines to stdout, which CloudWatch Logs turns into the
+    same metrics without any API call.
+    """
+
+    def __init__(self, namespace, mode=None, client=None, emit=print):
+        self.namespace = namespace
+        self.mode = mode or os.environ.get('METRICS_MODE', DEFAULT_MODE)
+        if self.mode not in ('api', 'emf'):
+            raise ValueError('METRICS_MODE must be api or emf, not ' + self.mode)
+        self.client = client
+        self.emit = emit
+        self.lock = threading.Lock()
+        # (name, unit, dimensions) -> {value: number of times it was put}
+        self.values = {}
+        self.flusher = None
+
+    def put(self, name, value, unit='None', dimensions=None):
+        key = (name, unit, tuple(sorted((dimensions or {}).items())))
+        with self.lock:
+            counts = self.values.setdefault(key, {})
+            counts[value] = counts.get(value, 0) + 1
+
+    def _take(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    @staticmethod
+    def _metric_datum(key, counts):
+        name, unit, dimensions = key
+        datum = {'MetricName': name, 'Unit': unit}
+        if dimensions:
+            datum['Dimensions'] = [{'Name': dimension, 'Value': value} for dimension, value in dimensions]
+        if len(counts) == 1 and sum(counts.values()) == 1:
+            datum['Value'] = next(iter(counts))
+        else:
+            datum['StatisticValues'] = {'SampleCount': sum(counts.values()),
+                                        'Sum': sum(value * count for value, count in counts.items()),
+                                        'Minimum': min(counts), 'Maximum': max(counts)}
+        return datum
+
+    def _publish(self, values):
+        metric_data = [self._metric_datum(key, counts) for key, counts in values.items()]
+        client = self.client or cloudwatch_client()
+        try:
+            for start in range(0, len(metric_data), MAX_METRICS_PER_CALL):
+                client.put_metric_data(Namespace=self.namespace,
+                                       MetricData=metric_data[start:start + MAX_METRICS_PER_CALL])
+        except Exception:
+            logger.exception('Failed to publish %d metrics', len(metric_data))
+
+    def _emf_lines(self, values):
+        # EMF declares dimensions per document, so metrics are grouped by their dimensions, and long value lists
+        # and long metric lists go out over several documents
+        documents = {}
+        for (name, unit, dimensions), counts in values.items():
+            distinct = sorted(counts)
+            for part, start in enumerate(range(0, len(distinct), MAX_EMF_VALUES)):
+                chunk = distinct[start:start + MAX_EMF_VALUES]
+                if len(counts) == 1 and counts[chunk[0]] == 1:
+                    value = chunk[0]
+                else:
+                    value = {'Values': chunk, 'Counts': [counts[distinct_value] for distinct_value in chunk]}
+                documents.setdefault((dimensions, part), []).append((name, unit, value))
+        for (dimensions, _), metrics in documents.items():
+            for start in range(0, len(metrics), MAX_EMF_METRICS):
+                yield self._emf_line(dimensions, metrics[start:start + MAX_EMF_METRICS])
+
+    def _emf_line(self, dimensions, metrics):
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{'Namespace': self.namespace,
+                                       'Dimensions': [[dimension for dimension, _ in dimensions]],
+                                       'Metrics': [{'Name': name, 'Unit': unit} for name, unit, _ in metrics]}],
+            },
+        }
+        document.update(dimensions)
+        document.update((name, value) for name, _, value in metrics)
+        return json.dumps(document, separators=(',', ':'))
+
+    def flush(self):
+        """
+        Publish everything put since the last flush.
+        """
+        values = self._take()
+        if not values:
+            return
+        if self.mode == 'emf':
+            for line in self._emf_lines(values):
+                self.emit(line)
+            return
+        self.wait()
+        self.flusher = threading.Thread(target=self._publish, args=(values,), name='metrics-flush')
+        self.flusher.start()
+
+    def wait(self):
+        """
+        Block until the PutMetricData calls of the last flush are done.
+        """
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
@@ -0,0 +1,92 @@
+from math import isqrt
+
+try:
+    import numpy as np
+except ImportError:
+    # The Lambda Python runtime does not ship NumPy; without it count_primes looks the candidates up one by one
+    np = None
+
+# Values below this are looked up in a sieve of Eratosthenes (one byte per value, so at most 1 MiB)
+SIEVE_LIMIT = 1 << 20
+# Miller-Rabin with these bases has no false positives below 3.3 * 10**24, which covers every 64-bit value
+MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+MAX_VALUE = (1 << 64) - 1
+
+# Grown on demand and kept for the life of the container
+_sieve_flags = bytearray()
+
+
+def sieve(limit):
+    """
+    Flags (1 for a prime, 0 otherwise) for at least the values below min(limit, SIEVE_LIMIT).
+    """
+    global _sieve_flags
+    if len(_sieve_flags) >= min(limit, SIEVE_LIMIT):
+        return _sieve_flags
+    # Grow geometrically, so a rising limit does not rebuild the sieve for every new value
+    size = min(max(limit, 2 * len(_sieve_flags), 1024), SIEVE_LIMIT)
+    flags = bytearray([1]) * size
+    flags[:2] = b'\0\0'
+    for factor in range(2, isqrt(size - 1) + 1):
+        if flags[factor]:
+            flags[factor * factor::factor] = bytes(len(range(factor * factor, size, factor)))
+    _sieve_flags = flags
+    return flags
+
+
+def _miller_rabin(num):
+    exponent = num - 1
+    shift = (exponent & -exponent).bit_length() - 1
+    exponent >>= shift
+    for base in MILLER_RABIN_BASES:
+        x = pow(base, exponent, num)
+        if x == 1 or x == num - 1:
+            continue
+        for _ in range(shift - 1):
+            x = x * x % num
+            if x == num - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def is_prime(num):
+    if num < SIEVE_LIMIT:
+        return num >= 0 and sieve(num + 1)[num] == 1
+    if num > MAX_VALUE:
+        raise ValueError('is_prime is exact for 64-bit values only, not {}'.format(num))
+    if any(num % base == 0 for base in MILLER_RABIN_BASES):
+        return False
+    return _miller_rabin(num)
+
+
+def count_primes_python(candidates):
+    """
+    count_primes without NumPy: the sieve is built once for the largest candidate, then looked up for each.
+    """
+    candidates = list(candidates)
+    if not candidates:
+        return 0
+    flags = sieve(max(candidates) + 1)
+    limit = len(flags)
+    return sum(flags[x] if 0 <= x < limit else is_prime(x) for x in candidates)
+
+
+def count_primes(candidates):
+    """
+    Number of primes among candidates, a sequence or NumPy array of integers. With NumPy the ones below SIEVE_LIMIT
+    are looked up in the sieve all at once; the rest go through Miller-Rabin one by one.
+    """
+    if np is None:
+        return count_primes_python(candidates)
+    candidates = np.asarray(candidates)
+    if candidates.size == 0:
+        return 0
+    if candidates.dtype.kind not in 'iu':
+        return count_primes_python(candidates.tolist())
+    flags = np.frombuffer(sieve(int(candidates.max()) + 1), dtype=np.uint8)
+    in_sieve = candidates < len(flags)
+    small = candidates[in_sieve]
+    count = int(np.count_nonzero(flags[small[small >= 0]]))
+    return count + sum(map(is_prime, candidates[~in_sieve].tolist()))
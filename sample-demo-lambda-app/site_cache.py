@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import tempfile
+from collections import namedtuple
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import boto3
+
+READ_SIZE = 64 * 1024
+# Bodies up to this size are held in memory on their way to S3; larger ones spill to a temporary file
+MAX_SPOOLED_BODY = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+FetchResult = namedtuple('FetchResult', 'status content_length changed revalidated')
+
+
+class SiteCache:
+    """
+    Fetches url and stores its body in S3 under bucket/key, remembering across the invocations of a warm container
+    what it last fetched: the ETag and Last-Modified validators, the status, length and SHA-256 of the body. The
+    body itself is not kept; S3 has it.
+
+    Every fetch after the first is a conditional request, so a server that knows the content has not changed answers
+    304 without a body. A server that sends the body anyway is caught by its hash. Either way, unchanged content is
+    not uploaded to S3 again.
+    """
+
+    def __init__(self, url, bucket, key, s3_client=None, timeout=None):
+        self.url = url
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client
+        self.timeout = timeout
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.status = None
+        self.content_length = None
+
+    def _request(self):
+        headers = {}
+        if self.digest is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        return Request(self.url, headers=headers)
+
+    def _upload(self, body):
+        if self.s3_client is None:
+            self.s3_client = boto3.client('s3')
+        # upload_fileobj reads the body in parts and switches to a multipart upload when it is large
+        self.s3_client.upload_fileobj(body, self.bucket, self.key)
+
+    def fetch(self):
+        """
+        Fetch url, upload the body if it changed since the last fetch, and return a FetchResult: the HTTP status
+        and the length of the current body, whether it changed, and whether the server answered 304 Not Modified,
+        in which case status and length are those of the response it revalidated.
+        """
+        try:
+            response = urlopen(self._request(), timeout=self.timeout)
+        except HTTPError as error:
+            if error.code != 304 or self.digest is None:
+                raise
+            error.close()
+            logger.debug('%s not modified', self.url)
+            return FetchResult(self.status, self.content_length, False, True)
+        with response, tempfile.SpooledTemporaryFile(max_size=MAX_SPOOLED_BODY) as body:
+            digest = hashlib.sha256()
+            content_length = 0
+            for chunk in iter(lambda: response.read(READ_SIZE), b''):
+                digest.update(chunk)
+                body.write(chunk)
+                content_length += len(chunk)
+            digest = digest.hexdigest()
+            changed = digest != self.digest
+            if changed:
+                body.seek(0)
+                self._upload(body)
+            else:
+                logger.debug('%s unchanged, %d bytes with SHA-256 %s', self.url, content_length, digest)
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.digest = digest
+        self.status = response.status
+        self.content_length = content_length
+        return FetchResult(response.status, content_length, changed, False)
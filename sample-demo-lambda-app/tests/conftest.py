@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The function's modules are imported flat, as they are laid out in the Lambda console
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,124 @@
+import json
+import threading
+
+import pytest
+
+import metrics_buffer
+from metrics_buffer import MetricsBuffer
+
+
+class FakeCloudWatch:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+        self.threads = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.threads.append(threading.current_thread())
+        self.calls.append((Namespace, MetricData))
+        if self.fail:
+            raise RuntimeError('throttled')
+
+
+def datums(client):
+    return {datum['MetricName']: datum for _, metric_data in client.calls for datum in metric_data}
+
+
+def test_repeated_values_are_published_as_one_statistic_set():
+    client = FakeCloudWatch()
+    metrics = MetricsBuffer('Demo', mode='api', client=client)
+    for value in (4, 1, 4, 10):
+        metrics.put('ResponseContentLength', value, 'Bytes')
+    metrics.put('2xxStatus', 1)
+
+    metrics.flush()
+    metrics.wait()
+
+    assert len(client.calls) == 1 and client.calls[0][0] == 'Demo'
+    assert client.threads[0] is not threading.current_thread()
+    published = datums(client)
+    assert published['ResponseContentLength'] == {
+        'MetricName': 'ResponseContentLength', 'Unit': 'Bytes',
+        'StatisticValues': {'SampleCount': 4, 'Sum': 19, 'Minimum': 1, 'Maximum': 10}}
+    assert published['2xxStatus'] == {'MetricName': '2xxStatus', 'Unit': 'None', 'Value': 1}
+
+
+def test_dimensions_keep_metrics_apart():
+    client = FakeCloudWatch()
+    metrics = MetricsBuffer('Demo', mode='api', client=client)
+    metrics.put('Latency', 5, dimensions={'Stage': 'fetch'})
+    metrics.put('Latency', 7, dimensions={'Stage': 'upload'})
+
+    metrics.flush()
+    metrics.wait()
+
+    metric_data = client.calls[0][1]
+    assert sorted((datum['Dimensions'][0]['Value'], datum['Value']) for datum in metric_data) == \
+        [('fetch', 5), ('upload', 7)]
+
+
+def test_publishing_is_split_into_calls_of_at_most_1000_metrics():
+    client = FakeCloudWatch()
+    metrics = MetricsBuffer('Demo', mode='api', client=client)
+    for i in range(2500):
+        metrics.put('Metric' + str(i), i)
+
+    metrics.flush()
+    metrics.wait()
+
+    assert [len(metric_data) for _, metric_data in client.calls] == [1000, 1000, 500]
+    assert len(datums(client)) == 2500
+
+
+def test_flush_starts_over_and_failures_do_not_raise():
+    client = FakeCloudWatch(fail=True)
+    metrics = MetricsBuffer('Demo', mode='api', client=client)
+    metrics.put('2xxStatus', 1)
+
+    metrics.flush()
+    metrics.wait()
+    metrics.flush()
+    metrics.wait()
+
+    assert len(client.calls) == 1
+
+
+def test_emf_documents_are_split_by_dimensions_metrics_and_values(monkeypatch):
+    monkeypatch.setattr(metrics_buffer, 'MAX_EMF_METRICS', 3)
+    monkeypatch.setattr(metrics_buffer, 'MAX_EMF_VALUES', 4)
+    lines = []
+    metrics = MetricsBuffer('Demo', mode='emf', emit=lines.append)
+    for i in range(5):
+        metrics.put('Metric' + str(i), 1)
+    metrics.put('Metric0', 1)
+    for value in range(6):
+        metrics.put('Spread', value, 'Milliseconds')
+    metrics.put('Latency', 5, dimensions={'Stage': 'fetch'})
+
+    metrics.flush()
+
+    documents = [json.loads(line) for line in lines]
+    for document in documents:
+        directive = document['_aws']['CloudWatchMetrics'][0]
+        assert directive['Namespace'] == 'Demo'
+        assert len(directive['Metrics']) <= 3
+        assert all(metric['Name'] in document for metric in directive['Metrics'])
+    without_dimensions = [document for document in documents
+                          if document['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [[]]]
+    assert sum(len(document['_aws']['CloudWatchMetrics'][0]['Metrics']) for document in without_dimensions) == 7
+    assert [document['Metric0'] for document in documents if 'Metric0' in document] == [
+        {'Values': [1], 'Counts': [2]}]
+    assert [document['Metric1'] for document in documents if 'Metric1' in document] == [1]
+    assert [document['Spread'] for document in documents if 'Spread' in document] == [
+        {'Values': [0, 1, 2, 3], 'Counts': [1, 1, 1, 1]}, {'Values': [4, 5], 'Counts': [1, 1]}]
+    fetch = [document for document in documents if 'Latency' in document]
+    assert len(fetch) == 1 and fetch[0]['Stage'] == 'fetch'
+    assert fetch[0]['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Stage']]
+
+
+def test_mode_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv('METRICS_MODE', 'emf')
+    assert MetricsBuffer('Demo').mode == 'emf'
+    monkeypatch.setenv('METRICS_MODE', 'statsd')
+    with pytest.raises(ValueError):
+        MetricsBuffer('Demo')
@@ -0,0 +1,84 @@
+from random import Random
+
+import numpy as np
+import pytest
+
+import primes
+from primes import MAX_VALUE, SIEVE_LIMIT, count_primes, count_primes_python, is_prime
+
+
+def trial_division(num):
+    if num < 2:
+        return False
+    factor = 2
+    while factor * factor <= num:
+        if num % factor == 0:
+            return False
+        factor += 1
+    return True
+
+
+@pytest.fixture(autouse=True)
+def fresh_sieve(monkeypatch):
+    monkeypatch.setattr(primes, '_sieve_flags', bytearray())
+
+
+# Above the sieve, small enough for trial division: primes, products of two large primes, squares of primes and
+# strong pseudoprimes to several of the smaller bases
+ABOVE_SIEVE = [SIEVE_LIMIT, SIEVE_LIMIT + 1, 1048583, 1048589, 1000003 * 1000033, 1048583 ** 2, 3215031751,
+               2152302898747, 3474749660383, 341550071728321]
+
+
+def test_is_prime_matches_trial_division_below_the_sieve_limit():
+    assert [is_prime(num) for num in range(-5, 5000)] == [trial_division(num) for num in range(-5, 5000)]
+    values = Random(7).sample(range(5000, SIEVE_LIMIT), 2000) + [SIEVE_LIMIT - 1]
+    assert [is_prime(num) for num in values] == [trial_division(num) for num in values]
+
+
+def test_miller_rabin_matches_trial_division_above_the_sieve_limit():
+    values = ABOVE_SIEVE + Random(11).sample(range(SIEVE_LIMIT, 10 ** 10), 300)
+    assert [is_prime(num) for num in values] == [trial_division(num) for num in values]
+
+
+def test_miller_rabin_covers_64_bit_values():
+    assert is_prime(2 ** 61 - 1)
+    assert is_prime(MAX_VALUE - 58)
+    assert not is_prime(MAX_VALUE)
+    # The largest strong pseudoprime to the bases up to 37 (and not 41)
+    assert not is_prime(3825123056546413051)
+    with pytest.raises(ValueError):
+        is_prime(MAX_VALUE + 1)
+
+
+def test_sieve_grows_but_stays_within_its_limit():
+    assert len(primes.sieve(10)) == 1024
+    assert len(primes.sieve(5000)) == 5000
+    assert len(primes.sieve(6000)) == 10000
+    assert len(primes.sieve(SIEVE_LIMIT * 4)) == SIEVE_LIMIT
+
+
+@pytest.mark.parametrize('count', [count_primes, count_primes_python])
+def test_counts_match_trial_division(count):
+    candidates = [-7, -1, 0, 1, 2, 3, 4] + Random(3).choices(range(200000), k=3000) + ABOVE_SIEVE
+    expected = sum(map(trial_division, candidates))
+
+    assert count(candidates) == expected
+    assert count([]) == 0
+    assert count([0, 1]) == 0
+
+
+def test_numpy_batch_mode_takes_arrays_of_any_integer_type():
+    candidates = Random(5).choices(range(SIEVE_LIMIT + 10000), k=3000)
+    expected = sum(map(trial_division, candidates))
+
+    assert count_primes(np.array(candidates, dtype=np.int64)) == expected
+    assert count_primes(np.array(candidates, dtype=np.uint64)) == expected
+    assert count_primes(np.array([-3, 2, 5], dtype=np.int8)) == 2
+    assert count_primes(np.array([], dtype=np.int64)) == 0
+
+
+def test_without_numpy_count_primes_falls_back_to_python(monkeypatch):
+    monkeypatch.setattr(primes, 'np', None)
+    candidates = Random(9).choices(range(100000), k=1000)
+
+    assert count_primes(candidates) == sum(map(trial_division, candidates))
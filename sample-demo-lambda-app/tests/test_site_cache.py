@@ -0,0 +1,105 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import site_cache
+from site_cache import SiteCache
+
+
+class StandInSite(BaseHTTPRequestHandler):
+    # Set on the server: body and its etag, validators (send ETag and Last-Modified, honour If-None-Match) and
+    # the headers of the requests made
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.validators and self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(server.body)))
+        if server.validators:
+            self.send_header('ETag', server.etag)
+            self.send_header('Last-Modified', 'Sun, 18 Oct 2026 10:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeS3:
+    def __init__(self):
+        self.uploads = []
+
+    def upload_fileobj(self, body, bucket, key):
+        self.uploads.append((bucket, key, body.read()))
+
+
+@pytest.fixture
+def site():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInSite)
+    server.requests = []
+    server.validators = True
+
+    def set_body(body):
+        server.body = body
+        server.etag = '"{}"'.format(hash(body))
+
+    server.set_body = set_body
+    set_body(b'<html>python</html>')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def site_cache_for(site, s3):
+    return SiteCache('http://127.0.0.1:{}/'.format(site.server_address[1]), 'bucket', 'response.txt', s3_client=s3)
+
+
+def test_unchanged_content_is_revalidated_and_not_uploaded(site):
+    s3 = FakeS3()
+    cache = site_cache_for(site, s3)
+
+    first = cache.fetch()
+    etag = site.etag
+    second = cache.fetch()
+    site.set_body(b'<html>python 3</html>')
+    third = cache.fetch()
+
+    assert first == (200, 19, True, False)
+    # A revalidated fetch reports the status of the response it revalidated
+    assert second == (200, 19, False, True)
+    assert third == (200, 21, True, False)
+    assert 'If-None-Match' not in site.requests[0]
+    assert site.requests[1]['If-None-Match'] == etag
+    assert site.requests[1]['If-Modified-Since'] == 'Sun, 18 Oct 2026 10:00:00 GMT'
+    assert s3.uploads == [('bucket', 'response.txt', b'<html>python</html>'),
+                          ('bucket', 'response.txt', b'<html>python 3</html>')]
+
+
+def test_same_body_without_validators_is_not_uploaded_again(site):
+    site.validators = False
+    s3 = FakeS3()
+    cache = site_cache_for(site, s3)
+
+    results = [cache.fetch(), cache.fetch()]
+
+    assert results == [(200, 19, True, False), (200, 19, False, False)]
+    assert len(s3.uploads) == 1
+
+
+def test_large_bodies_are_streamed_through_a_temporary_file(site, monkeypatch):
+    monkeypatch.setattr(site_cache, 'MAX_SPOOLED_BODY', 1000)
+    monkeypatch.setattr(site_cache, 'READ_SIZE', 256)
+    body = bytes(range(256)) * 20
+    site.set_body(body)
+    s3 = FakeS3()
+    cache = site_cache_for(site, s3)
+
+    assert cache.fetch() == (200, len(body), True, False)
+    assert s3.uploads[0][2] == body
+    assert cache.fetch() == (200, len(body), False, True)